@@ -0,0 +1,323 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load test of the dashboard and prediction endpoints of the API.
+
+The API is served by uvicorn against stand-ins of S3 and DynamoDB: moto in the
+process by default, or the services at `--endpoint-url` (moto server, DynamoDB Local
+with MinIO, ...). `--latency` delays every call to AWS, as real services do, so that
+requests waiting on storage compete for the threads of the API.
+
+Every client sends its requests one after the other, alternating between a page of
+the dashboard and the downsampled prediction of a random metric. Latencies are
+reported by endpoint as JSON lines, which can be compared to a previous run with
+`--baseline`.
+
+Usage: python -m benchmarks.load_api --clients 100 --requests 5000 --latency 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from typing import Optional
+
+import httpx
+import numpy as np
+from loguru import logger
+
+ORGANIZATION = "load-test"
+
+
+def seed_storage(metrics: int, points: int) -> list[str]:
+    """Write the dashboard of `ORGANIZATION` and its predictions, returns the uuids."""
+    from predictive_capacity import ML_RESULTS_BUCKET, ML_RESULTS_TABLE, dynamodb, s3
+    from predictive_capacity.predictions import encode_prediction, prediction_key
+    from predictive_capacity.upload import create_dynamodb_table, create_s3_bucket
+
+    create_dynamodb_table(ML_RESULTS_TABLE)
+    create_s3_bucket(ML_RESULTS_BUCKET)
+    rng = np.random.default_rng(0)
+    start = int(time.time()) // 3600 * 3600 - points * 3600
+    uuids = [f"{ORGANIZATION}-{i:05}" for i in range(metrics)]
+    with dynamodb.Table(ML_RESULTS_TABLE).batch_writer() as batch:
+        for i, uuid in enumerate(uuids):
+            saturation = Decimal(str(round(rng.uniform(0, 1), 3)))
+            batch.put_item(
+                Item={
+                    "source": ORGANIZATION,
+                    "source#host_id#service_id": f"{ORGANIZATION}#{i}#1",
+                    "class": f"metric{i % 10}",
+                    "host_name": f"host{i}",
+                    "service_name": "service1",
+                    "days_to_full": int(rng.integers(1, 365)),
+                    "current_saturation": saturation,
+                    "saturation_3_months": {
+                        "current_saturation": saturation,
+                        "forecast": saturation,
+                    },
+                    "saturation_6_months": {
+                        "current_saturation": saturation,
+                        "forecast": saturation,
+                    },
+                    "saturation_12_months": {
+                        "current_saturation": saturation,
+                        "forecast": saturation,
+                    },
+                    "confidence_level": int(rng.integers(0, 3)),
+                    "uuid": uuid,
+                }
+            )
+    for uuid in uuids:
+        history = np.cumsum(rng.normal(size=points)).astype(np.float32)
+        arrays = {
+            "data_scaled": history,
+            "data_dates": start + 3600 * np.arange(points, dtype=np.int64),
+            "forecast": history[-1] + np.linspace(0, 1, points, dtype=np.float32),
+            "forecast_dates": start + 3600 * np.arange(points, 2 * points),
+        }
+        s3.meta.client.put_object(
+            Bucket=ML_RESULTS_BUCKET,
+            Key=prediction_key(uuid),
+            Body=encode_prediction(arrays),
+        )
+    return uuids
+
+
+def add_latency(latency: float) -> None:
+    """Delay every call of the AWS clients of the API by `latency` seconds."""
+    from predictive_capacity import dynamodb, s3
+
+    def delay(**kwargs) -> None:
+        time.sleep(latency)
+
+    for client in (dynamodb.meta.client, s3.meta.client):
+        # First, so that it also runs before the responses of moto
+        client.meta.events.register_first("before-send", delay)
+
+
+def serve(port: int):
+    """Start the API in a thread, returns its uvicorn server."""
+    import uvicorn
+
+    from predictive_capacity.api import app
+
+    # Connections are not closed while clients wait in line to reuse them
+    config = uvicorn.Config(
+        app, host="127.0.0.1", port=port, log_level="warning", timeout_keep_alive=60
+    )
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def run_clients(
+    base_url: str, uuids: list[str], args: argparse.Namespace
+) -> dict[str, list[float]]:
+    """Send `args.requests` requests from `args.clients` concurrent clients."""
+    latencies: dict[str, list[float]] = {"/metrics": [], "/predictions/{uuid}": []}
+    errors = {route: 0 for route in latencies}
+    remaining = args.requests
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.clients)
+
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=60
+    ) as client:
+
+        async def run_client(index: int) -> None:
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                if (remaining + index) % 2:
+                    route = "/metrics"
+                    request = client.get(
+                        route,
+                        params={
+                            "organization": ORGANIZATION,
+                            "limit": 50,
+                            "sort": "days_to_full",
+                        },
+                    )
+                else:
+                    route = "/predictions/{uuid}"
+                    request = client.get(
+                        f"/predictions/{rng.choice(uuids)}",
+                        params={"points": args.points_returned},
+                    )
+                start = time.perf_counter()
+                try:
+                    response = await request
+                    ok = response.status_code == 200
+                    if not ok:
+                        logger.debug(f"{route}: {response.status_code}")
+                except httpx.HTTPError as e:
+                    logger.debug(f"{route}: {e!r}")
+                    ok = False
+                latencies[route].append(time.perf_counter() - start)
+                errors[route] += not ok
+
+        await asyncio.gather(*(run_client(i) for i in range(args.clients)))
+    for route, count in errors.items():
+        if count:
+            logger.warning(f"{count} requests to {route} failed")
+    return latencies
+
+
+def load(base_url: str, uuids: list[str], args: argparse.Namespace) -> tuple:
+    """Latencies by route and duration of the load test."""
+    start = time.perf_counter()
+    latencies = asyncio.run(run_clients(base_url, uuids, args))
+    return latencies, time.perf_counter() - start
+
+
+def summarize(
+    latencies: dict[str, list[float]], elapsed: float, args: argparse.Namespace
+) -> list[dict]:
+    from predictive_capacity import __version__
+
+    results = []
+    for route, values in latencies.items():
+        values_ms = np.array(values) * 1000
+        results.append(
+            {
+                "benchmark": "load_api",
+                "route": route,
+                "clients": args.clients,
+                "requests": len(values),
+                "latency_s": args.latency,
+                "throughput_rps": len(values) / elapsed,
+                "p50_ms": float(np.percentile(values_ms, 50)),
+                "p90_ms": float(np.percentile(values_ms, 90)),
+                "p99_ms": float(np.percentile(values_ms, 99)),
+                "max_ms": float(values_ms.max()),
+                "mean_ms": statistics.fmean(values_ms),
+                "version": __version__,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+            }
+        )
+    return results
+
+
+def compare(results: list[dict], baseline: list[dict]) -> str:
+    """Table of the ratios of latency percentiles to a baseline run."""
+    previous = {(r["route"], r["clients"]): r for r in baseline}
+    lines = [f"{'route':<24}{'clients':>8}{'p50':>10}{'p99':>10}"]
+    for result in results:
+        before = previous.get((result["route"], result["clients"]))
+        if before is None:
+            continue
+        p50_ratio = result["p50_ms"] / max(before["p50_ms"], 1e-9)
+        p99_ratio = result["p99_ms"] / max(before["p99_ms"], 1e-9)
+        lines.append(
+            f"{result['route']:<24}{result['clients']:>8}"
+            f"{p50_ratio:>9.2f}x{p99_ratio:>9.2f}x"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=5000, help="Total requests.")
+    parser.add_argument("--metrics", type=int, default=500, help="Metrics stored.")
+    parser.add_argument(
+        "--points", type=int, default=8760, help="Points of each stored series."
+    )
+    parser.add_argument(
+        "--points-returned", type=int, default=500, help="Points of the responses."
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to AWS calls."
+    )
+    parser.add_argument(
+        "--endpoint-url",
+        help="URL of the S3 and DynamoDB stand-ins, moto in the process by default.",
+    )
+    parser.add_argument("--port", type=int, default=7001)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON lines file the results are added to.")
+    parser.add_argument("--baseline", help="JSON lines file of a previous run.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    args = parse_args(argv)
+    logger.remove()
+    logger.add(sys.stderr, level=os.environ.get("LOG_LEVEL", "INFO").upper())
+    logger.disable("predictive_capacity")
+
+    # The AWS clients and the job queue are created when the package is imported
+    os.environ.setdefault("ML_JOBS_DB", os.path.join(tempfile.mkdtemp(), "jobs.db"))
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    if args.endpoint_url:
+        os.environ["AWS_ENDPOINT_URL"] = args.endpoint_url
+    else:
+        from moto import mock_aws
+
+        for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+            os.environ.setdefault(name, "testing")
+        mock_aws().start()
+
+    uuids = seed_storage(args.metrics, args.points)
+    if args.latency:
+        add_latency(args.latency)
+    server = serve(args.port)
+    logger.info(
+        f"Sending {args.requests} requests from {args.clients} clients to "
+        f"{len(uuids)} metrics"
+    )
+    # Clients run in another process, so that they do not compete with the API for
+    # the GIL
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        base_url = f"http://127.0.0.1:{args.port}"
+        latencies, elapsed = executor.submit(load, base_url, uuids, args).result()
+    results = summarize(latencies, elapsed, args)
+    server.should_exit = True
+
+    for result in results:
+        logger.info(
+            f"{result['route']}: p50 {result['p50_ms']:.1f}ms, "
+            f"p99 {result['p99_ms']:.1f}ms, {result['throughput_rps']:.0f} req/s"
+        )
+    lines = "".join(json.dumps(result) + "\n" for result in results)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(lines)
+    else:
+        sys.stdout.write(lines)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        print(compare(results, baseline), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
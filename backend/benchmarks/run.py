@@ -0,0 +1,263 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks of the forecasting pipeline on synthetic series.
+
+Every benchmark is timed over `--repeat` runs, then run once more under tracemalloc
+to measure its peak memory. Results are written as JSON lines, one per benchmark
+and series length, so that runs of two versions can be compared with
+`--baseline`.
+
+Usage: python -m benchmarks.run --lengths 1000,10000 --output results.jsonl
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from benchmarks.series import synthetic_series
+from predictive_capacity import HORIZON_PREDICTION_HOURS, __version__
+from predictive_capacity.forecast.metric import Metric, MetricForecasting
+from predictive_capacity.forecast.models import auto_ml
+from predictive_capacity.warp10.fetch_metrics_bulk import MetricData
+
+DEFAULT_LENGTHS = [1_000, 10_000, 100_000, 500_000]
+
+
+@dataclass
+class Benchmark:
+    """Step of the pipeline: `run` is timed on the state returned by `setup`."""
+
+    name: str
+    setup: Callable[[MetricData, argparse.Namespace], Any]
+    run: Callable[[Any, argparse.Namespace], Any]
+
+
+def new_metric(series: MetricData) -> Metric:
+    return Metric(
+        metric=series.metric,
+        host_id=series.labels["host_id"],
+        service_id=series.labels["service_id"],
+        platform_uuid=series.labels["platform_uuid"],
+        token="",
+        prefetched=series,
+    )
+
+
+def forecast_state(series: MetricData, horizon: int) -> Metric:
+    """Metric as left by `Metric.forecast`, with a forecast reaching saturation."""
+    metric = new_metric(series)
+    training = metric.training_metric.preprocess()
+    metric.current_saturation = training.current_saturation
+    metric.last_timestamp = training.data.index[-1]
+    metric.forecast_metric = MetricForecasting(
+        start=metric.last_timestamp + pd.Timedelta("1 H"), horizon=horizon
+    )
+    metric.forecast_dates = metric.forecast_metric.data.index
+    last_value = float(training.data.iloc[-1, 0])
+    metric.forecast_values = pd.Series(
+        np.linspace(last_value, last_value + 0.5, horizon),
+        index=metric.forecast_dates,
+    )
+    metric.saturation_3_months = float(metric.forecast_values.iloc[24 * 31 * 3])
+    metric.saturation_6_months = float(metric.forecast_values.iloc[24 * 31 * 6])
+    metric.saturation_12_months = float(metric.forecast_values.iloc[-1])
+    return metric
+
+
+def setup_forecasting(series: MetricData, args: argparse.Namespace):
+    training = new_metric(series).training_metric.preprocess()
+    start = training.data.index[-1] + pd.Timedelta("1 H")
+    return start, training.features, training.time_scaler
+
+
+BENCHMARKS = [
+    Benchmark(
+        name="training_preprocess",
+        setup=lambda series, args: new_metric(series).training_metric,
+        run=lambda training, args: training.preprocess(),
+    ),
+    Benchmark(
+        name="auto_ml",
+        setup=lambda series, args: new_metric(series).training_metric.preprocess().data,
+        run=lambda data, args: auto_ml(
+            data, timeout=None, n_trials=args.trials, n_jobs=1  # type: ignore
+        ),
+    ),
+    Benchmark(
+        name="forecasting_preprocess",
+        setup=setup_forecasting,
+        run=lambda state, args: MetricForecasting(
+            start=state[0], horizon=args.horizon
+        ).preprocess(state[1], state[2]),
+    ),
+    Benchmark(
+        name="calculate_days_until_full",
+        setup=lambda series, args: forecast_state(series, args.horizon),
+        run=lambda metric, args: metric.calculate_days_until_full(),
+    ),
+    Benchmark(
+        name="to_dict",
+        setup=lambda series, args: forecast_state(
+            series, args.horizon
+        ).calculate_days_until_full(),
+        run=lambda metric, args: metric.to_dict(uuid="benchmark"),
+    ),
+]
+
+
+def hourly_points(series: MetricData) -> int:
+    """Number of points of the series once resampled hourly."""
+    index = series.data.index
+    return (index[-1].floor("H") - index[0].floor("H")) // pd.Timedelta("1 H") + 1
+
+
+def measure(benchmark: Benchmark, series: MetricData, args: argparse.Namespace) -> dict:
+    """
+    Time a benchmark and measure its peak memory.
+
+    The peak memory only accounts for the allocations traced by tracemalloc, i.e.
+    Python objects and NumPy arrays, not the native buffers of LightGBM.
+    """
+    repeat = 1 if benchmark.name == "auto_ml" else args.repeat
+    walls, cpus = [], []
+    for _ in range(repeat):
+        state = benchmark.setup(series, args)
+        gc.collect()
+        wall, cpu = time.perf_counter(), time.process_time()
+        benchmark.run(state, args)
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+
+    state = benchmark.setup(series, args)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        benchmark.run(state, args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "benchmark": benchmark.name,
+        "points": len(series.data),
+        "hourly_points": hourly_points(series),
+        "trials": args.trials if benchmark.name == "auto_ml" else None,
+        "repeat": repeat,
+        "wall_min_s": min(walls),
+        "wall_median_s": statistics.median(walls),
+        "cpu_median_s": statistics.median(cpus),
+        "peak_memory_mb": peak / 2**20,
+        "version": __version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_benchmarks(
+    lengths: list[int], names: Optional[list[str]], args: argparse.Namespace
+) -> list[dict]:
+    """Run the benchmarks named `names` (all by default) on series of `lengths`."""
+    results = []
+    for length in lengths:
+        series = synthetic_series(length, seed=args.seed)
+        for benchmark in BENCHMARKS:
+            if names and benchmark.name not in names:
+                continue
+            result = {"length": length, **measure(benchmark, series, args)}
+            logger.info(
+                f"{benchmark.name} on {length} points: "
+                f"{result['wall_median_s']:.3f}s, {result['peak_memory_mb']:.1f}MB"
+            )
+            results.append(result)
+    return results
+
+
+def compare(results: list[dict], baseline: list[dict]) -> str:
+    """Table of the ratios of wall time and peak memory to a baseline run."""
+    previous = {(r["benchmark"], r["length"]): r for r in baseline}
+    lines = [f"{'benchmark':<28}{'length':>10}{'time':>10}{'memory':>10}"]
+    for result in results:
+        before = previous.get((result["benchmark"], result["length"]))
+        if before is None:
+            continue
+        time_ratio = result["wall_median_s"] / max(before["wall_median_s"], 1e-9)
+        memory_ratio = result["peak_memory_mb"] / max(before["peak_memory_mb"], 1e-9)
+        lines.append(
+            f"{result['benchmark']:<28}{result['length']:>10}"
+            f"{time_ratio:>9.2f}x{memory_ratio:>9.2f}x"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--lengths",
+        type=lambda value: [int(x) for x in value.split(",")],
+        default=DEFAULT_LENGTHS,
+        help="Comma-separated numbers of raw points of the series.",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        type=lambda value: value.split(","),
+        default=None,
+        help=f"Comma-separated benchmarks among {[b.name for b in BENCHMARKS]}.",
+    )
+    parser.add_argument("--trials", type=int, default=20, help="Trials of auto_ml.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs.")
+    parser.add_argument("--horizon", type=int, default=HORIZON_PREDICTION_HOURS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON lines file the results are added to.")
+    parser.add_argument("--baseline", help="JSON lines file of a previous run.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    args = parse_args(argv)
+    logger.remove()
+    logger.add(sys.stderr, level=os.environ.get("LOG_LEVEL", "INFO").upper())
+    logger.disable("predictive_capacity")
+
+    results = run_benchmarks(args.lengths, args.benchmarks, args)
+    lines = "".join(json.dumps(result) + "\n" for result in results)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(lines)
+    else:
+        sys.stdout.write(lines)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        print(compare(results, baseline), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import pandas as pd
+
+from predictive_capacity.warp10.fetch_metrics_bulk import MetricData
+
+METRIC = "bench:used"
+LABELS = {"host_id": "1", "service_id": "1", "platform_uuid": "bench"}
+
+
+def synthetic_series(
+    n_points: int,
+    frequency: str = "5min",
+    maximum_allowed: float = 100.0,
+    missing: float = 0.01,
+    seed: int = 0,
+) -> MetricData:
+    """
+    Generate a series shaped like a capacity metric.
+
+    The series has a linear growth, daily and weekly seasonalities, gaussian noise
+    and randomly missing points, and reaches about 80% of `maximum_allowed` at the
+    end.
+
+    Parameters
+    ----------
+    n_points: int
+        Number of raw points, before removing the missing ones.
+    frequency: str
+        Interval between two points.
+    maximum_allowed: float
+        Saturation of the metric.
+    missing: float
+        Share of the points removed from the series.
+    seed: int
+        Seed of the random generator.
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(end="2024-01-01", periods=n_points, freq=frequency)
+    hours = (index - index[0]).total_seconds().to_numpy() / 3600
+    values = (
+        0.2
+        + 0.5 * hours / max(hours[-1], 1)
+        + 0.05 * np.sin(2 * np.pi * hours / 24)
+        + 0.03 * np.sin(2 * np.pi * hours / (24 * 7))
+        + rng.normal(0, 0.01, n_points)
+    ) * maximum_allowed
+    keep = rng.random(n_points) >= missing
+    keep[-1] = True
+    return MetricData(
+        metric=METRIC,
+        labels=LABELS,
+        data=pd.DataFrame({METRIC: values[keep]}, index=index[keep]),
+        maximum_allowed=maximum_allowed,
+        host_name="bench-host",
+        service_name="bench-service",
+    )
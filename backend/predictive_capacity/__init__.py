@@ -16,6 +16,7 @@
 import os
 
 import boto3
+from botocore.config import Config
 from mypy_boto3_dynamodb.service_resource import DynamoDBServiceResource
 from mypy_boto3_s3.service_resource import S3ServiceResource
 
@@ -23,21 +24,114 @@ from mypy_boto3_s3.service_resource import S3ServiceResource
 HORIZON_PREDICTION_HOURS = 365 * 24
 
 ML_TRAINING_TIMEOUT = int(os.environ.get("ML_TRAINING_TIMEOUT", 600))
+# Number of worker processes used to train metrics in parallel (1 = sequential)
+ML_TRAINING_WORKERS = int(os.environ.get("ML_TRAINING_WORKERS", 1))
+# Wall-clock budget in seconds shared by all the metrics of a run (0 = every metric
+# is trained for ML_TRAINING_TIMEOUT)
+ML_TRAINING_BUDGET = int(os.environ.get("ML_TRAINING_BUDGET", 0))
+# Train first the metrics closest to saturation, never forecast or with the oldest
+# forecasts
+ML_TRAINING_PRIORITY = os.getenv("ML_TRAINING_PRIORITY", "T").lower() in (
+    "true",
+    "t",
+    "1",
+)
+# Shortest training timeout the scheduler gives to a metric
+ML_TRAINING_MIN_TIMEOUT = int(os.environ.get("ML_TRAINING_MIN_TIMEOUT", 30))
+# Trials run concurrently in the search of a long series, whose CPUs are shared by
+# the trials. Shorter series rely on ML_TRAINING_WORKERS.
+ML_TRIAL_JOBS = int(os.environ.get("ML_TRIAL_JOBS", 1))
+# Number of hourly points from which a series is considered long
+ML_TRIAL_JOBS_MIN_LENGTH = int(os.environ.get("ML_TRIAL_JOBS_MIN_LENGTH", 10000))
+# Pruner of the hyperparameter search: asha, hyperband or none
+ML_OPTUNA_PRUNER = os.environ.get("ML_OPTUNA_PRUNER", "asha")
+
+# Number of best trials kept to warm start the next search of a metric (0 disables)
+ML_WARM_START_TOP_K = int(os.environ.get("ML_WARM_START_TOP_K", 5))
+# Trials without improvement after which a warm started search stops
+ML_WARM_START_PATIENCE = int(os.environ.get("ML_WARM_START_PATIENCE", 50))
+
+# Reuse the previous model of a metric while it still fits the new data
+ML_MODEL_REUSE = os.getenv("ML_MODEL_REUSE", "F").lower() in ("true", "t", "1")
+# Retrain when the error on new data exceeds this ratio of the validation error
+ML_MODEL_MAX_ERROR_RATIO = float(os.environ.get("ML_MODEL_MAX_ERROR_RATIO", 1.2))
+ML_MODEL_MAX_AGE_DAYS = int(os.environ.get("ML_MODEL_MAX_AGE_DAYS", 7))
+# Local directory where the models are stored instead of the S3 bucket
+ML_MODEL_STORE_DIR = os.environ.get("ML_MODEL_STORE_DIR", "")
+
+# Fit the 1% and 99% quantile models and serve them as prediction intervals
+ML_PREDICTION_INTERVALS = os.getenv("ML_PREDICTION_INTERVALS", "F").lower() in (
+    "true",
+    "t",
+    "1",
+)
+
+# Local cache of the hourly history of the series ("" disables the cache)
+ML_CACHE_DIR = os.environ.get("ML_CACHE_DIR", "")
+ML_CACHE_MAX_BYTES = int(os.environ.get("ML_CACHE_MAX_BYTES", 1024**3))
+
+# File where the timings of the stages of each forecast are appended as JSON lines
+ML_SPANS_FILE = os.environ.get("ML_SPANS_FILE", "")
+
+# SQLite database of the queue of forecast runs, shared by the API and the workers
+ML_JOBS_DB = os.environ.get("ML_JOBS_DB", "jobs.sqlite")
+# Seconds without heartbeat after which a running job is requeued
+ML_JOBS_STALE_SECONDS = int(os.environ.get("ML_JOBS_STALE_SECONDS", 300))
+# Seconds between two polls of the queue by an idle worker
+ML_JOBS_POLL_SECONDS = float(os.environ.get("ML_JOBS_POLL_SECONDS", 5))
+# Attempts of a metric in a run before it is given up, and seconds before its first
+# retry, doubled after every attempt
+ML_RUN_MAX_ATTEMPTS = int(os.environ.get("ML_RUN_MAX_ATTEMPTS", 3))
+ML_RUN_RETRY_BACKOFF_SECONDS = float(os.environ.get("ML_RUN_RETRY_BACKOFF_SECONDS", 60))
+# Port where a worker serves its internal metrics (0 disables)
+ML_WORKER_METRICS_PORT = int(os.environ.get("ML_WORKER_METRICS_PORT", 0))
 
 # Warp10
 WARP10_SSL_VERIFY = os.getenv("WARP10_SSL_VERIFY", "F").lower() in ("true", "t", "1")
 
 WARP10_READ_TOKEN = os.environ.get("WARP10_READ_TOKEN", "readTokenCI")
 ML_WARP10_URL = os.environ.get("ML_WARP10_URL", "http://localhost")
+# Number of metrics fetched per WarpScript execution (0 = one fetch per metric)
+WARP10_FETCH_BATCH_SIZE = int(os.environ.get("WARP10_FETCH_BATCH_SIZE", 0))
 
 # AWS
 ML_RESULTS_TABLE = os.environ.get("ML_RESULTS_TABLE", "PredictiveCapacityResults")
 ML_RESULTS_BUCKET = os.environ.get(
     "ML_RESULTS_BUCKET", "eu-west-1-ml-predictive-capacity-results"
 )
+# Longest time in seconds the metadata of a forecast waits to be written to DynamoDB
+# with the next ones
+ML_METADATA_FLUSH_SECONDS = float(os.environ.get("ML_METADATA_FLUSH_SECONDS", 30))
+# Number of threads uploading predictions to S3 while the next metrics train, and
+# number of predictions waiting for them before training blocks
+ML_UPLOAD_WORKERS = int(os.environ.get("ML_UPLOAD_WORKERS", 4))
+ML_UPLOAD_QUEUE_SIZE = int(os.environ.get("ML_UPLOAD_QUEUE_SIZE", 8))
+# Connections kept open and attempts of each call by the AWS clients
+ML_AWS_MAX_POOL_CONNECTIONS = int(os.environ.get("ML_AWS_MAX_POOL_CONNECTIONS", 16))
+ML_AWS_MAX_ATTEMPTS = int(os.environ.get("ML_AWS_MAX_ATTEMPTS", 5))
+# Threads of the API blocking on S3 and DynamoDB, other requests wait in the event
+# loop without holding a thread
+ML_API_STORAGE_THREADS = int(
+    os.environ.get("ML_API_STORAGE_THREADS", ML_AWS_MAX_POOL_CONNECTIONS)
+)
+
+# Seconds the dashboard of an organization is served from the memory of the API
+ML_DASHBOARD_CACHE_SECONDS = float(os.environ.get("ML_DASHBOARD_CACHE_SECONDS", 60))
+
+# Bytes of predictions kept in the memory of the API
+ML_PREDICTIONS_CACHE_BYTES = int(
+    os.environ.get("ML_PREDICTIONS_CACHE_BYTES", 64 * 1024**2)
+)
+# Metrics whose predictions can be requested at once
+ML_PREDICTIONS_BATCH_SIZE = int(os.environ.get("ML_PREDICTIONS_BATCH_SIZE", 100))
+
+aws_config = Config(
+    max_pool_connections=ML_AWS_MAX_POOL_CONNECTIONS,
+    retries={"max_attempts": ML_AWS_MAX_ATTEMPTS, "mode": "standard"},
+)
 
-dynamodb: DynamoDBServiceResource = boto3.resource("dynamodb")
-s3: S3ServiceResource = boto3.resource("s3")
+dynamodb: DynamoDBServiceResource = boto3.resource("dynamodb", config=aws_config)
+s3: S3ServiceResource = boto3.resource("s3", config=aws_config)
 
 
 with open("pyproject.toml") as f:
@@ -13,29 +13,48 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import functools
 import json
 import os
 import sys
+import time
+from typing import AsyncIterator, Callable, Generator, Optional, TypeVar
 
+import anyio
 import botocore.exceptions
-from boto3.dynamodb import conditions
-from fastapi import BackgroundTasks, FastAPI, HTTPException, Response, status
+from fastapi import FastAPI, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 from loguru import logger
 from starlette.middleware.cors import CORSMiddleware
 
+import predictive_capacity.monitoring as monitoring
 import predictive_capacity.schemas as schemas
 from predictive_capacity import (
     HORIZON_PREDICTION_HOURS,
-    ML_RESULTS_BUCKET,
-    ML_RESULTS_TABLE,
-    WARP10_READ_TOKEN,
+    ML_API_STORAGE_THREADS,
     __version__,
     dynamodb,
     s3,
 )
-from predictive_capacity.forecast.forecast import make_forecasts
-from predictive_capacity.utils import JSONEcoder
-from predictive_capacity.warp10.find_set_metrics import find_set_metrics
+from predictive_capacity.dashboard import (
+    DashboardCache,
+    SortField,
+    SortOrder,
+    filter_dashboard,
+    paginate,
+)
+from predictive_capacity.jobs import JobQueue
+from predictive_capacity.predictions import (
+    PREDICTION_MEDIA_TYPE,
+    DownsamplingMethod,
+    PredictionCache,
+    align,
+    downsample,
+    encode_prediction,
+    open_prediction,
+    to_json,
+)
 
 logger.remove()
 logger.add(sys.stderr, level=os.environ.get("LOG_LEVEL", "INFO").upper())
@@ -47,55 +66,157 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count", "X-Next-Cursor", "ETag"],
 )
 
+monitoring.instrument_client(dynamodb.meta.client)
+monitoring.instrument_client(s3.meta.client)
+
+job_queue = JobQueue()
+dashboard_cache = DashboardCache()
+prediction_cache = PredictionCache()
+# Limits the threads of the blocking calls to S3 and DynamoDB, so that they never
+# wait for a connection of the AWS clients
+storage_limiter = anyio.CapacityLimiter(ML_API_STORAGE_THREADS)
+
+T = TypeVar("T")
+
+
+async def run_storage(func: Callable[..., T], *args, **kwargs) -> T:
+    """Run a blocking call to S3 or DynamoDB in a thread."""
+    return await anyio.to_thread.run_sync(
+        functools.partial(func, *args, **kwargs), limiter=storage_limiter
+    )
+
+
+async def iterate_storage(chunks: Generator[bytes, None, None]) -> AsyncIterator[bytes]:
+    """Iterate over a body streamed from S3 without blocking the event loop."""
+    try:
+        while (chunk := await run_storage(next, chunks, None)) is not None:
+            yield chunk
+    finally:
+        chunks.close()
+
+
+@app.middleware("http")
+async def observe_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # Labelled by route template so that uuids do not create new series
+        route = request.scope.get("route")
+        monitoring.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=status_code,
+        )
+
 
 @app.get("/healthcheck", status_code=status.HTTP_200_OK)
 def perform_healthcheck():
     return {"healthcheck": "OK"}
 
 
+@app.get("/metrics_internal")
+def read_internal_metrics() -> Response:
+    """
+    Internal metrics of the service in the Prometheus text format.
+
+    Reports the forecast jobs in the queue, the latency and errors of the calls to
+    S3 and DynamoDB and the latency of the requests served by the API. The progress
+    of the forecasts and the latency of their stages are served by the workers (see
+    `ML_WORKER_METRICS_PORT`).
+    """
+    counts = job_queue.count_by_status()
+    for job_status in ("queued", "running", "succeeded", "failed"):
+        monitoring.JOBS.set(counts.get(job_status, 0), status=job_status)
+    return Response(
+        content=monitoring.REGISTRY.render(), media_type=monitoring.CONTENT_TYPE
+    )
+
+
 @app.get("/metrics", response_model=list[schemas.Dashboard])
-def read_dashboard(
-    response: Response, organization: str = "test"
+async def read_dashboard(
+    response: Response,
+    organization: str = "test",
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    sort: SortField = "metric_name",
+    order: SortOrder = "asc",
+    search: Optional[str] = None,
+    max_days_to_full: Optional[int] = None,
+    min_saturation: Optional[float] = None,
 ) -> list[schemas.Dashboard]:
-    logger.debug(f"Organization: {organization}")
+    """
+    Forecasts of all the metrics of an organization.
 
-    table = dynamodb.Table(ML_RESULTS_TABLE)
+    Without `limit`, all the metrics matching the filters are returned. Otherwise,
+    the cursor of the next page is returned in the `X-Next-Cursor` header, until the
+    last page. `X-Total-Count` holds the number of metrics matching the filters.
 
-    query = table.query(
-        IndexName="source-class-index",
-        KeyConditionExpression=conditions.Key("source").eq(organization),
-    )
-    logger.trace(f"Query: {json.dumps(query, indent=2, cls=JSONEcoder)}")
-    if query["Count"] == 0:
+    Dashboards are cached in memory for `ML_DASHBOARD_CACHE_SECONDS`, or until a run
+    of the organization uploads new forecasts.
+    """
+    logger.debug(f"Organization: {organization}")
+
+    try:
+        version = await anyio.to_thread.run_sync(
+            job_queue.results_version, organization
+        )
+    except Exception as e:
+        logger.warning(f"Failed to get the version of the results: {e}")
+        version = None
+    dashboard = dashboard_cache.peek(organization, version)
+    if dashboard is None:
+        dashboard = await run_storage(dashboard_cache.get, organization, version)
+    if not dashboard:
         raise HTTPException(status_code=404, detail="No dashboard found")
-    dashboard = []
-    for item in query["Items"]:
-        item = json.loads(json.dumps(item, cls=JSONEcoder))
-        index = item["source#host_id#service_id"]
-        assert isinstance(index, str)
-        item["host_id"] = index.split("#")[1]
-        item["service_id"] = index.split("#")[2]
-        item["metric_name"] = item["class"]
-        del item["source#host_id#service_id"]
-        del item["class"]
-        dashboard.append(schemas.Dashboard.parse_obj(item))
-    logger.trace(f"Dashboard: {dashboard}")
-    return dashboard
-
-
-@app.get("/predictions/{uuid}", response_model=schemas.Prediction)
-def read_predictions(uuid: str) -> schemas.Prediction:
+    dashboard = filter_dashboard(dashboard, search, max_days_to_full, min_saturation)
+    try:
+        page, next_cursor = paginate(dashboard, sort, order, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    response.headers["X-Total-Count"] = str(len(dashboard))
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    logger.trace(f"Dashboard: {page}")
+    return page
+
+
+@app.get(
+    "/predictions/{uuid}",
+    response_model=schemas.Prediction,
+    response_model_exclude_none=True,
+    responses={200: {"content": {PREDICTION_MEDIA_TYPE: {}}}},
+)
+async def read_predictions(
+    uuid: str,
+    request: Request,
+    points: Optional[int] = Query(None, ge=4),
+    downsampling: DownsamplingMethod = "lttb",
+) -> Response:
     """
     Retrieve Forecasts from S3 bucket
+
+    `forecast_lower` and `forecast_upper` are only returned for forecasts made with
+    prediction intervals.
+
+    With `points`, the history and the forecast are each downsampled to about that
+    number of points, preserving their shape with the Largest-Triangle-Three-Buckets
+    algorithm (`lttb`) or their extremes (`minmax`). Predictions are returned in
+    their compact binary format when the `Accept` header includes
+    `application/vnd.predictive-capacity.prediction`.
+
+    Responses carry an `ETag`, a request with a matching `If-None-Match` header gets
+    a 304 without content.
     """
     try:
-        s3_client = s3.meta.client
-        obj = s3_client.get_object(Bucket=ML_RESULTS_BUCKET, Key=f"{uuid}.json")[
-            "Body"
-        ].read()
-        logger.trace(f"Predictions: {json.dumps(json.loads(obj), indent=2)}")
+        prediction = await run_storage(open_prediction, uuid, cache=prediction_cache)
     except botocore.exceptions.ClientError as e:
         if e.response["Error"]["Code"] == "NoSuchKey":
             raise HTTPException(status_code=404, detail="No prediction found")
@@ -103,41 +224,133 @@ def read_predictions(uuid: str) -> schemas.Prediction:
             raise HTTPException(
                 status_code=500, detail=f"Failed to get predictions with error {e}"
             )
-    return json.loads(obj)
+    if PREDICTION_MEDIA_TYPE in request.headers.get("accept", ""):
+        media_type = PREDICTION_MEDIA_TYPE
+    else:
+        media_type = "application/json"
+    variant = ["bin" if media_type == PREDICTION_MEDIA_TYPE else "json"]
+    if points is not None:
+        variant += [downsampling, points]
+    # Predictions change on every run, clients must revalidate them
+    headers = {"ETag": prediction.variant_etag(*variant), "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    if headers["ETag"] in tags or "*" in tags:
+        prediction.close()
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if points is None and prediction.media_type == media_type:
+        # Served as stored, without decoding
+        if prediction.body is not None:
+            return Response(prediction.body, media_type=media_type, headers=headers)
+        return StreamingResponse(
+            iterate_storage(prediction.iter_bytes()),
+            media_type=media_type,
+            headers=headers,
+        )
+
+    def render() -> bytes:
+        arrays = prediction.arrays()
+        if points is not None:
+            arrays = downsample(arrays, points, downsampling)
+        if media_type == PREDICTION_MEDIA_TYPE:
+            return encode_prediction(arrays)
+        # Serialized directly, the values are already those of a `Prediction`
+        return json.dumps(to_json(arrays)).encode()
+
+    content = await run_storage(render)
+    return Response(content, media_type=media_type, headers=headers)
+
+
+@app.post(
+    "/predictions:batch",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}}},
+)
+async def read_predictions_batch(batch: schemas.PredictionsBatch) -> StreamingResponse:
+    """
+    Retrieve the forecasts of several metrics, read concurrently from S3.
 
+    Predictions are streamed as JSON lines in the order they are read, so that the
+    first ones can be drawn before the last ones are read. Each line holds the
+    `uuid` of a metric with either the fields of its `Prediction` or an `error`.
 
-@app.post("/forecast")
+    With `points`, predictions are downsampled as by `/predictions/{uuid}`. With
+    `step`, they are averaged over buckets of `step` seconds aligned on the epoch,
+    so that all of them share the same dates.
+    """
+
+    def render(uuid: str) -> bytes:
+        try:
+            arrays = open_prediction(uuid, cache=prediction_cache).arrays()
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                line = {"uuid": uuid, "error": "No prediction found"}
+            else:
+                line = {"uuid": uuid, "error": f"Failed to get predictions: {e}"}
+        except Exception as e:
+            logger.warning(f"Failed to read the prediction {uuid}: {e}")
+            line = {"uuid": uuid, "error": f"Failed to get predictions: {e}"}
+        else:
+            if batch.step is not None:
+                arrays = align(arrays, batch.step)
+            if batch.points is not None:
+                arrays = downsample(arrays, batch.points, batch.downsampling)
+            line = {"uuid": uuid, **to_json(arrays)}
+        return (json.dumps(line) + "\n").encode()
+
+    async def lines() -> AsyncIterator[bytes]:
+        tasks = [
+            asyncio.ensure_future(run_storage(render, uuid))
+            for uuid in dict.fromkeys(batch.uuids)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            # The client is gone, reads not started yet are skipped
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post(
+    "/forecast",
+    response_model=schemas.Job,
+    status_code=status.HTTP_202_ACCEPTED,
+    responses={200: {"description": "A run of the organization is already queued"}},
+)
 def forecast(
-    background_tasks: BackgroundTasks,
+    response: Response,
     organization: str = "test",
     forecasting_horizon: int = HORIZON_PREDICTION_HOURS,
-) -> Response:
+    retrain: bool = True,
+) -> schemas.Job:
     """
-    Make forecasts for all metrics in the database.
+    Queue forecasts for all metrics in the database.
 
     Models are trained on all the historical data available for each metric and
     forecasts are stored in the S3 bucket and metadata are stored in Dynamodb.
+    With `retrain=false`, metrics with a stored model are forecast with it, which
+    allows changing the horizon without retraining.
 
-    Note that models are calculated in a background task, so the response is
-    returned immediately.
+    Runs are executed by a separate worker process (`python -m
+    predictive_capacity.worker`), so the response is returned immediately with the
+    job to follow with `GET /forecast/{job_id}`. An organization has at most one
+    queued or running job: while it has one, that job is returned with a 200 status
+    instead of queuing a duplicate run.
     """
+    job, created = job_queue.enqueue(organization, forecasting_horizon, retrain)
+    if not created:
+        response.status_code = status.HTTP_200_OK
+    return job
 
-    try:
-        unique_labels = find_set_metrics(token=WARP10_READ_TOKEN)
-    except Exception as e:
-        raise HTTPException(
-            status_code=500, detail=f"Failed to get Warp10 data with error {e}"
-        )
-
-    if len(unique_labels) == 0:
-        raise HTTPException(status_code=404, detail="No metrics found")
-
-    background_tasks.add_task(
-        make_forecasts,
-        unique_labels=unique_labels,
-        read_token=WARP10_READ_TOKEN,
-        organization=organization,
-        forecasting_horizon=forecasting_horizon,
-    )
 
-    return Response(status_code=202)
+@app.get("/forecast/{job_id}", response_model=schemas.Job)
+def read_forecast_job(job_id: str) -> schemas.Job:
+    """Status and progress of a forecast job."""
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No job found")
+    return job
@@ -0,0 +1,288 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import binascii
+import json
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+from typing import Any, Callable, Hashable, Literal, Optional
+
+from boto3.dynamodb import conditions
+from loguru import logger
+
+from predictive_capacity import ML_DASHBOARD_CACHE_SECONDS, ML_RESULTS_TABLE, dynamodb
+from predictive_capacity.schemas import Dashboard
+
+SortField = Literal[
+    "metric_name",
+    "host_name",
+    "service_name",
+    "days_to_full",
+    "current_saturation",
+    "confidence_level",
+]
+SortOrder = Literal["asc", "desc"]
+
+# Attributes of the items read for the dashboard, the others (e.g. training_time)
+# are not transferred
+DASHBOARD_ATTRIBUTES = (
+    "class",
+    "source#host_id#service_id",
+    "uuid",
+    "host_name",
+    "service_name",
+    "days_to_full",
+    "current_saturation",
+    "saturation_3_months",
+    "saturation_6_months",
+    "saturation_12_months",
+    "confidence_level",
+)
+
+
+def to_native(value: Any) -> Any:
+    """Convert the Decimals of a DynamoDB item to ints and floats."""
+    if isinstance(value, Decimal):
+        return int(value) if value % 1 == 0 else float(value)
+    if isinstance(value, dict):
+        return {k: to_native(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [to_native(v) for v in value]
+    return value
+
+
+def dashboard_item(item: dict) -> Dashboard:
+    """Row of the dashboard from the DynamoDB item of a metric."""
+    item = to_native(item)
+    _, host_id, service_id = item.pop("source#host_id#service_id").split("#", 2)
+    return Dashboard(
+        metric_name=item.pop("class"), host_id=host_id, service_id=service_id, **item
+    )
+
+
+def load_dashboard(
+    organization: str, table_name: str = ML_RESULTS_TABLE
+) -> list[Dashboard]:
+    """
+    Read the dashboard of an organization from DynamoDB.
+
+    The query is paginated, so that organizations with more than 1 MB of metadata
+    get all their metrics.
+    """
+    table = dynamodb.Table(table_name)
+    names = {f"#a{i}": name for i, name in enumerate(DASHBOARD_ATTRIBUTES)}
+    kwargs: dict[str, Any] = {
+        "IndexName": "source-class-index",
+        "KeyConditionExpression": conditions.Key("source").eq(organization),
+        "ProjectionExpression": ", ".join(names),
+        "ExpressionAttributeNames": names,
+    }
+    dashboard = []
+    while True:
+        query = table.query(**kwargs)
+        dashboard.extend(dashboard_item(item) for item in query["Items"])
+        if "LastEvaluatedKey" not in query:
+            break
+        kwargs["ExclusiveStartKey"] = query["LastEvaluatedKey"]
+    logger.debug(f"Dashboard of {organization}: {len(dashboard)} metrics")
+    return dashboard
+
+
+class DashboardCache:
+    """
+    In-process cache of the dashboards of the organizations.
+
+    A dashboard is read again when it is older than `ttl` seconds or when the
+    version of the results of its organization changed, e.g. when a training run
+    uploaded new forecasts (see `JobQueue.results_version`). Concurrent requests of
+    an organization wait for a single read.
+
+    Parameters
+    ----------
+    loader: Callable[[str], list[Dashboard]]
+        Reads the dashboard of an organization.
+    ttl: float
+        Seconds a dashboard is served from the cache. 0 disables the cache.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[str], list[Dashboard]] = load_dashboard,
+        ttl: float = ML_DASHBOARD_CACHE_SECONDS,
+    ):
+        self.loader = loader
+        self.ttl = ttl
+        self._entries: dict[str, tuple[float, Hashable, list[Dashboard]]] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def peek(
+        self, organization: str, version: Hashable = None
+    ) -> Optional[list[Dashboard]]:
+        """Dashboard of `organization` if it is cached and fresh, without blocking."""
+        entry = self._entries.get(organization)
+        if (
+            entry is not None
+            and time.monotonic() - entry[0] < self.ttl
+            and entry[1] == version
+        ):
+            return entry[2]
+        return None
+
+    def get(self, organization: str, version: Hashable = None) -> list[Dashboard]:
+        """Dashboard of `organization`, read if it is not cached or stale."""
+        with self._lock:
+            lock = self._locks.setdefault(organization, threading.Lock())
+        with lock:
+            dashboard = self.peek(organization, version)
+            if dashboard is not None:
+                return dashboard
+            dashboard = self.loader(organization)
+            if self.ttl > 0:
+                self._entries[organization] = (time.monotonic(), version, dashboard)
+            return dashboard
+
+    def invalidate(self, organization: Optional[str] = None) -> None:
+        """Forget the dashboard of `organization`, or of all of them."""
+        with self._lock:
+            if organization is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(organization, None)
+
+
+def filter_dashboard(
+    dashboard: list[Dashboard],
+    search: Optional[str] = None,
+    max_days_to_full: Optional[int] = None,
+    min_saturation: Optional[float] = None,
+) -> list[Dashboard]:
+    """
+    Rows of the dashboard matching all the given filters.
+
+    Parameters
+    ----------
+    dashboard: list[Dashboard]
+    search: Optional[str]
+        Case-insensitive substring of the name of the metric, host or service.
+    max_days_to_full: Optional[int]
+        Keep the metrics full in at most this number of days.
+    min_saturation: Optional[float]
+        Keep the metrics whose current saturation is at least this value.
+    """
+    if search:
+        search = search.lower()
+        dashboard = [
+            row
+            for row in dashboard
+            if search in row.metric_name.lower()
+            or search in row.host_name.lower()
+            or search in row.service_name.lower()
+        ]
+    if max_days_to_full is not None:
+        dashboard = [
+            row
+            for row in dashboard
+            if row.days_to_full is not None and row.days_to_full <= max_days_to_full
+        ]
+    if min_saturation is not None:
+        dashboard = [
+            row
+            for row in dashboard
+            if row.current_saturation is not None
+            and row.current_saturation >= min_saturation
+        ]
+    return dashboard
+
+
+def _sort_key(row: Dashboard, sort: SortField) -> tuple:
+    # Missing values come last in ascending order and the uuid makes keys unique
+    value = getattr(row, sort)
+    return (value is None, 0 if value is None else value, row.uuid)
+
+
+def _encode_cursor(sort: SortField, order: SortOrder, key: tuple) -> str:
+    cursor = json.dumps({"sort": sort, "order": order, "key": list(key)})
+    return base64.urlsafe_b64encode(cursor.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str, sort: SortField, order: SortOrder) -> tuple:
+    try:
+        decoded = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        )
+        key = tuple(decoded["key"])
+        valid = decoded["sort"] == sort and decoded["order"] == order and len(key) == 3
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        valid = False
+    if not valid:
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def paginate(
+    dashboard: list[Dashboard],
+    sort: SortField = "metric_name",
+    order: SortOrder = "asc",
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> tuple[list[Dashboard], Optional[str]]:
+    """
+    Sort the dashboard and return a page of it.
+
+    Cursors point to the last row of the previous page rather than to an offset,
+    so that pages do not skip nor repeat rows when the dashboard changes between
+    two requests.
+
+    Parameters
+    ----------
+    dashboard: list[Dashboard]
+    sort: SortField
+        Field the rows are sorted by, rows without value come last in ascending
+        order.
+    order: SortOrder
+    limit: Optional[int]
+        Number of rows of the page. All the remaining rows if None.
+    cursor: Optional[str]
+        Cursor returned with the previous page, None for the first page.
+
+    Returns
+    -------
+    tuple[list[Dashboard], Optional[str]]
+        Rows of the page and the cursor of the next page, None for the last page.
+
+    Raises
+    ------
+    ValueError
+        If the cursor is invalid or was returned for another sort.
+    """
+    after = None if cursor is None else _decode_cursor(cursor, sort, order)
+    rows = sorted(dashboard, key=lambda row: _sort_key(row, sort))
+    keys = [_sort_key(row, sort) for row in rows]
+    if order == "asc":
+        start = 0 if after is None else bisect_right(keys, after)
+        end = len(rows) if limit is None else min(len(rows), start + limit)
+        page, more = rows[start:end], end < len(rows)
+    else:
+        end = len(rows) if after is None else bisect_left(keys, after)
+        start = 0 if limit is None else max(0, end - limit)
+        page, more = rows[start:end][::-1], start > 0
+    next_cursor = None
+    if more and page:
+        next_cursor = _encode_cursor(sort, order, _sort_key(page[-1], sort))
+    return page, next_cursor
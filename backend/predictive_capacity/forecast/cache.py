@@ -0,0 +1,202 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from predictive_capacity import ML_CACHE_DIR, ML_CACHE_MAX_BYTES
+
+
+@dataclass
+class CachedSeries:
+    """Hourly history of a series up to its high-water mark."""
+
+    data: pd.DataFrame
+    last_value: float
+    maximum_allowed: float
+
+    @property
+    def high_water_mark(self) -> pd.Timestamp:
+        """First hour that is not in the cache."""
+        return self.data.index[-1] + pd.Timedelta("1H")
+
+
+class SeriesCache:
+    """
+    On-disk cache of the hourly resampled history of each series.
+
+    Every series is stored in its own compressed columnar `.npz` file holding the
+    hourly means of all the complete hours fetched so far. Only the points after
+    the last complete hour need to be fetched from Warp10 on the next run. The
+    last, possibly incomplete, hour is always fetched again.
+
+    The total size of the cache is bounded: the least recently used series are
+    evicted first. The size is kept as a running total, the directory is only
+    scanned when it is built and when the total exceeds `max_bytes`. Entries
+    written by other processes sharing the directory are counted at the next scan.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = ML_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def path(self, metric: str, labels: dict[str, str]) -> str:
+        key = json.dumps([metric, labels], sort_keys=True).encode()
+        return os.path.join(self.directory, f"{hashlib.sha1(key).hexdigest()}.npz")
+
+    def load(self, metric: str, labels: dict[str, str]) -> Optional[CachedSeries]:
+        """Return the cached history of a series, or None if it is not cached."""
+        path = self.path(metric, labels)
+        try:
+            with np.load(path) as npz:
+                data = pd.DataFrame(
+                    {metric: npz["values"]},
+                    index=pd.DatetimeIndex(npz["index"].astype("datetime64[ns]")),
+                )
+                cached = CachedSeries(
+                    data=data,
+                    last_value=float(npz["last_value"]),
+                    maximum_allowed=float(npz["maximum_allowed"]),
+                )
+            # Update the access time used by the eviction policy
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Dropping unreadable cache entry {path}: {e}")
+            self.invalidate(metric, labels)
+            return None
+        if len(cached.data) == 0:
+            return None
+        return cached
+
+    def store(
+        self,
+        metric: str,
+        labels: dict[str, str],
+        data: pd.DataFrame,
+        maximum_allowed: float,
+    ) -> None:
+        """
+        Store the history of a series.
+
+        Parameters
+        ----------
+        metric: str
+            Name of the metric.
+        labels: dict[str, str]
+            Labels of the metric.
+        data: pd.DataFrame
+            History of the metric, either raw points or hourly means. Only the
+            complete hours are stored.
+        maximum_allowed: float
+            Saturation of the metric, used to invalidate the cache when it changes.
+        """
+        assert isinstance(data.index, pd.DatetimeIndex)
+        if len(data) == 0:
+            return
+        last_hour = data.index[-1].floor("H")
+        hourly = data.iloc[:, 0].resample("H").mean()
+        hourly = hourly[hourly.index < last_hour]
+        if len(hourly) == 0:
+            return
+
+        path = self.path(metric, labels)
+        previous_size = _file_size(path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(
+                    f,
+                    index=hourly.index.values.astype(np.int64),
+                    values=hourly.to_numpy(dtype=np.float64),
+                    last_value=np.float64(data.iloc[-1, 0]),
+                    maximum_allowed=np.float64(maximum_allowed),
+                )
+            size = os.path.getsize(tmp_path)
+            # Atomic so that concurrent workers never read a partial file
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self.size += size - previous_size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def invalidate(self, metric: str, labels: dict[str, str]) -> None:
+        """Remove a series from the cache."""
+        path = self.path(metric, labels)
+        size = _file_size(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        self.size -= size
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        """Access time, size and path of every series in the cache."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self) -> None:
+        """Remove the least recently used series until the cache fits in size."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.debug(f"Evicted {path} from the series cache.")
+        self.size = total
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+@functools.lru_cache(maxsize=None)
+def default_series_cache() -> Optional[SeriesCache]:
+    """
+    Return the series cache configured with `ML_CACHE_DIR`, if any, shared by the
+    metrics trained in the process.
+    """
+    if not ML_CACHE_DIR:
+        return None
+    return SeriesCache(ML_CACHE_DIR, ML_CACHE_MAX_BYTES)
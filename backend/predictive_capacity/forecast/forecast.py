@@ -13,23 +13,59 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from typing import List
+import math
+import multiprocessing
+import multiprocessing.queues
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from functools import partial
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from uuid import uuid4
 
+import pandas as pd
 import tqdm
 from botocore.exceptions import ClientError
 from loguru import logger
+from threadpoolctl import threadpool_limits
 
 from predictive_capacity import (
+    ML_MODEL_MAX_AGE_DAYS,
+    ML_MODEL_MAX_ERROR_RATIO,
+    ML_MODEL_REUSE,
     ML_RESULTS_BUCKET,
     ML_RESULTS_TABLE,
+    ML_TRAINING_BUDGET,
+    ML_TRAINING_PRIORITY,
     ML_TRAINING_TIMEOUT,
+    ML_TRAINING_WORKERS,
+    ML_WARM_START_TOP_K,
+    WARP10_FETCH_BATCH_SIZE,
     dynamodb,
     s3,
 )
+from predictive_capacity.forecast.cache import default_series_cache
 from predictive_capacity.forecast.metric import Metric
-from predictive_capacity.schemas import ResponseFindSetMetrics
-from predictive_capacity.upload import create_dynamodb_table, upload_all
-from predictive_capacity.utils import get_uuid
+from predictive_capacity.forecast.registry import load_model, save_model
+from predictive_capacity.forecast.scheduler import (
+    TrainingHistory,
+    TrainingScheduler,
+    priority_order,
+)
+from predictive_capacity.forecast.trials import load_trials, save_trials
+from predictive_capacity.instrumentation import collect_spans, log_summary, span
+from predictive_capacity.jobs import RunLedger
+from predictive_capacity.monitoring import RunMonitor, observe_spans
+from predictive_capacity.schemas import ForecastOutcome, ResponseFindSetMetrics
+from predictive_capacity.upload import (
+    MetadataWriter,
+    UploadPipeline,
+    create_dynamodb_table,
+    metadata_item,
+    prediction_body,
+    upload_all,
+)
+from predictive_capacity.utils import batch_get_metadata, get_uuid
+from predictive_capacity.warp10.fetch_metrics_bulk import MetricData, fetch_metrics_bulk
 
 
 def list_all_tables():
@@ -70,17 +106,234 @@ def bucket_exists(bucket_name):
         raise e
 
 
+def _init_worker(cpu_sets: multiprocessing.queues.Queue) -> None:
+    """
+    Pin a training worker to its own set of CPUs.
+
+    Each worker pops a disjoint set of CPUs from the queue and limits the native
+    thread pools (OpenMP used by LightGBM and HistGradientBoosting, BLAS) to the
+    size of that set, so that workers do not oversubscribe the machine.
+    """
+    cpus = cpu_sets.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    threadpool_limits(limits=len(cpus))
+    logger.debug(f"Training worker {os.getpid()} pinned to CPUs {sorted(cpus)}")
+
+
+def split_cpus(n_workers: int) -> List[set[int]]:
+    """
+    Split the CPUs available to the current process into `n_workers` disjoint sets.
+
+    Parameters
+    ----------
+    n_workers: int
+        Number of worker processes.
+
+    Returns
+    -------
+    List[set[int]]
+        One set of CPUs per worker. When there are more workers than CPUs, CPUs
+        are shared in a round-robin fashion.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    if n_workers >= len(cpus):
+        return [{cpus[i % len(cpus)]} for i in range(n_workers)]
+    return [set(cpus[i::n_workers]) for i in range(n_workers)]
+
+
+def forecast_metric(
+    item: ResponseFindSetMetrics,
+    read_token: str,
+    organization: str,
+    forecasting_horizon: int,
+    timeout: int = ML_TRAINING_TIMEOUT,
+    prefetched: Optional[MetricData] = None,
+    retrain: bool = True,
+    ledger: Optional[RunLedger] = None,
+    uuid: Optional[str] = None,
+    defer_upload: bool = False,
+) -> ForecastOutcome:
+    """
+    Train, forecast and upload the results of a single metric.
+
+    Exceptions are caught and reported in the returned outcome so that a failing
+    metric does not stop the whole run.
+
+    Parameters
+    ----------
+    item: ResponseFindSetMetrics
+        Metric to forecast.
+    read_token: str
+        Token to read the metrics from Warp10.
+    organization: str
+        Source of the data.
+    forecasting_horizon: int
+        Number of hours to forecast.
+    timeout: int
+        Training timeout in seconds.
+    prefetched: Optional[MetricData]
+        Data already fetched from Warp10. If None, the metric is fetched here.
+    retrain: bool
+        If False, the stored model of the metric is used to forecast without
+        retraining, whatever its age or error.
+    ledger: Optional[RunLedger]
+        Ledger of the run where the progress of the metric is recorded.
+    uuid: Optional[str]
+        uuid of the metric, already resolved by the caller. If None, it is
+        retrieved from DynamoDB here.
+    defer_upload: bool
+        If True, nothing is uploaded: the prediction and the DynamoDB item of the
+        forecast are returned in the outcome, for the caller to upload them while
+        the next metrics train and record the metric as uploaded.
+
+    Returns
+    -------
+    ForecastOutcome
+        uuid of the uploaded forecast or the error that occurred.
+    """
+    with collect_spans(
+        metric=item.metric, host_id=item.host_id, service_id=item.service_id
+    ) as spans:
+        error, prediction, metadata = None, None, None
+        try:
+            if uuid is None:
+                uuid = get_uuid(
+                    organization, item.metric, item.host_id, item.service_id
+                )
+            warm_start_trials = []
+            if ML_WARM_START_TOP_K > 0:
+                try:
+                    warm_start_trials = load_trials(uuid)
+                except Exception as e:
+                    logger.warning(f"Failed to load the previous trials of {uuid}: {e}")
+            previous_model = None
+            if ML_MODEL_REUSE or not retrain:
+                try:
+                    previous_model = load_model(uuid)
+                except Exception as e:
+                    logger.warning(f"Failed to load the previous model of {uuid}: {e}")
+            metric = Metric(
+                metric=item.metric,
+                host_id=item.host_id,
+                service_id=item.service_id,
+                platform_uuid=item.platform_uuid,
+                token=read_token,
+                prefetched=prefetched,
+                cache=default_series_cache(),
+            )
+            if ledger is not None:
+                ledger.record(item, "fetched")
+            metric.forecast(
+                horizon=forecasting_horizon,
+                timeout=timeout,
+                warm_start_trials=warm_start_trials,
+                previous_model=previous_model,
+                max_error_ratio=ML_MODEL_MAX_ERROR_RATIO if retrain else math.inf,
+                max_age=(
+                    pd.Timedelta(days=ML_MODEL_MAX_AGE_DAYS)
+                    if retrain
+                    else pd.Timedelta.max
+                ),
+            )
+            if ledger is not None:
+                ledger.record(item, "trained")
+            with span("days_to_full"):
+                metric.calculate_days_until_full()
+            result = metric.to_dict(uuid=uuid)
+            if defer_upload:
+                prediction = prediction_body(result)
+                metadata = metadata_item(organization, result)
+            else:
+                upload_all(metric=result, source=organization)
+                if ledger is not None:
+                    ledger.record(item, "uploaded")
+            if metric.reg is not None and not metric.reused:
+                if ML_WARM_START_TOP_K > 0:
+                    try:
+                        save_trials(uuid, metric.reg.study)
+                    except Exception as e:
+                        logger.warning(f"Failed to save the trials of {uuid}: {e}")
+                # Always saved, so that the model can be reused once
+                # ML_MODEL_REUSE is set or predictions refreshed without retraining.
+                try:
+                    save_model(uuid, metric.model_artifact())
+                except Exception as e:
+                    logger.warning(f"Failed to save the model of {uuid}: {e}")
+        except Exception as e:
+            logger.error(
+                f"Something went wrong while making forecasts for key {item}: {e}"
+            )
+            error = str(e)
+            if ledger is not None:
+                ledger.record(item, "failed", error)
+    return ForecastOutcome(
+        metric=item,
+        uuid=uuid,
+        error=error,
+        spans=spans,
+        prediction=prediction,
+        metadata=metadata,
+    )
+
+
+def iter_prefetched(
+    unique_labels: List[ResponseFindSetMetrics],
+    read_token: str,
+    fetch_batch_size: int,
+    spans: Optional[List[dict]] = None,
+) -> Iterator[Tuple[ResponseFindSetMetrics, Optional[MetricData]]]:
+    """
+    Pair every metric with its data fetched in bulk from Warp10.
+
+    When bulk fetching is disabled (`fetch_batch_size` is 0) or a batch fails, the
+    metrics are paired with None and are fetched one by one while training. The
+    spans of the bulk fetches are appended to `spans`, if given.
+    """
+    if fetch_batch_size <= 0:
+        for item in unique_labels:
+            yield item, None
+        return
+
+    for start in range(0, len(unique_labels), fetch_batch_size):
+        batch = unique_labels[start : start + fetch_batch_size]
+        try:
+            with collect_spans(spans=spans), span(
+                "warp10_fetch_bulk", metrics=len(batch)
+            ):
+                fetched = list(fetch_metrics_bulk(read_token, batch, fetch_batch_size))
+        except Exception as e:
+            logger.warning(f"Bulk fetch failed, fetching metrics one by one: {e}")
+            fetched = [None] * len(batch)  # type: ignore
+        yield from zip(batch, fetched)
+
+
 def make_forecasts(
     unique_labels: List[ResponseFindSetMetrics],
     read_token: str,
     organization: str,
     forecasting_horizon: int,
     timeout: int = ML_TRAINING_TIMEOUT,
-):
+    n_workers: int = ML_TRAINING_WORKERS,
+    fetch_batch_size: int = WARP10_FETCH_BATCH_SIZE,
+    retrain: bool = True,
+    budget: int = ML_TRAINING_BUDGET,
+    on_outcome: Optional[Callable[[ForecastOutcome], None]] = None,
+    ledger: Optional[RunLedger] = None,
+    prioritize: bool = ML_TRAINING_PRIORITY,
+) -> List[ForecastOutcome]:
     """
     Forecasts for all metrics in the database.
 
     Loop over all the metrics in the database and make forecasts for each of them.
+    When `n_workers` is greater than 1, metrics are trained in a pool of worker
+    processes, each pinned to its own set of CPUs. The metadata of the metrics is
+    read from DynamoDB at once before the run. Predictions are uploaded to S3 in a
+    pool of threads while the next metrics train, and their metadata is then written
+    to DynamoDB by batches. The run waits for the last uploads before returning.
 
     Parameters
     ----------
@@ -88,10 +341,44 @@ def make_forecasts(
         List of all the metrics in the database.
     read_token: str
         Token to read the metrics from Warp10.
-    forecasting_horizon: int
-        Number of days to forecast.
-    source: str
+    organization: str
         Source of the data.
+    forecasting_horizon: int
+        Number of hours to forecast.
+    timeout: int
+        Training timeout in seconds for each metric. When a budget is given, it is
+        the longest timeout of a metric.
+    n_workers: int
+        Number of worker processes. 1 trains the metrics sequentially in the
+        current process.
+    fetch_batch_size: int
+        Number of metrics fetched from Warp10 in a single WarpScript execution.
+        0 fetches each metric separately.
+    retrain: bool
+        If False, metrics are forecast with their stored model when they have one,
+        e.g. to forecast at another horizon without retraining.
+    budget: int
+        Wall-clock budget of the whole run in seconds, shared between the metrics
+        by a `TrainingScheduler`. 0 trains every metric for `timeout` seconds.
+    on_outcome: Optional[Callable[[ForecastOutcome], None]]
+        Called with the outcome of every metric as soon as it is known, e.g. to
+        report the progress of the run.
+    ledger: Optional[RunLedger]
+        Ledger where the state of every metric is recorded, to resume the run if
+        it is interrupted. The metrics to forecast are selected by the caller, see
+        `RunLedger.due`.
+    prioritize: bool
+        Train first the metrics closest to saturation, never forecast or with the
+        oldest forecasts, according to their metadata in DynamoDB, so that they are
+        up to date if the run is cut short. Otherwise metrics are trained in the
+        order of `unique_labels`.
+
+    Returns
+    -------
+    List[ForecastOutcome]
+        Outcome of every metric, in the same order as `unique_labels`, with the
+        spans of its stages. A summary of the time spent in each stage is logged at
+        the end of the run.
     """
 
     # Ensure the bucket exists
@@ -114,28 +401,172 @@ def make_forecasts(
         create_dynamodb_table(ML_RESULTS_TABLE)
         logger.debug(f"Table {ML_RESULTS_TABLE} created successfully.")
 
-    for item in tqdm.tqdm(unique_labels):
-        metric_name = item.metric
-        host_id = item.host_id
-        service_id = item.service_id
-        platform_uuid = item.platform_uuid
-        uuid = get_uuid(organization, metric_name, host_id, service_id)
-        try:
-            result = (
-                Metric(
-                    metric=metric_name,
-                    host_id=host_id,
-                    service_id=service_id,
-                    platform_uuid=platform_uuid,
-                    token=read_token,
+    train = partial(
+        forecast_metric,
+        read_token=read_token,
+        organization=organization,
+        forecasting_horizon=forecasting_horizon,
+        timeout=timeout,
+        retrain=retrain,
+        ledger=ledger,
+        defer_upload=True,
+    )
+    # Spans of the run outside of the metrics
+    run_spans: List[dict] = []
+
+    # The metadata of all the metrics is read at once, to resolve their uuids and
+    # to schedule the run
+    uuids: List[Optional[str]] = [None] * len(unique_labels)
+    histories = [TrainingHistory()] * len(unique_labels)
+    try:
+        with collect_spans(spans=run_spans), span(
+            "dynamodb_batch_get", metrics=len(unique_labels)
+        ):
+            metadata = batch_get_metadata(organization, unique_labels)
+        uuids = [str(m["uuid"]) if m else str(uuid4()) for m in metadata]
+        histories = [TrainingHistory.from_metadata(m) for m in metadata]
+    except Exception as e:
+        logger.warning(f"Failed to get the metadata of the metrics at once: {e}")
+    order = list(range(len(unique_labels)))
+    if prioritize:
+        order = priority_order(histories)
+        unique_labels = [unique_labels[i] for i in order]
+        uuids = [uuids[i] for i in order]
+        histories = [histories[i] for i in order]
+
+    prefetched = iter_prefetched(unique_labels, read_token, fetch_batch_size, run_spans)
+    n_workers = max(1, min(n_workers, len(unique_labels)))
+
+    scheduler = None
+    if budget > 0:
+        scheduler = TrainingScheduler(
+            histories,
+            budget,
+            n_workers=n_workers,
+            max_timeout=timeout,
+        )
+
+    def timeout_of(index: int) -> int:
+        return timeout if scheduler is None else scheduler.timeout(index)
+
+    with RunMonitor(organization, len(unique_labels)) as monitor, MetadataWriter(
+        spans=run_spans
+    ) as writer, UploadPipeline() as uploads:
+
+        def report(outcome: ForecastOutcome) -> None:
+            monitor.record(outcome)
+            if on_outcome is not None:
+                on_outcome(outcome)
+
+        def written(outcome: ForecastOutcome, error: Optional[Exception]) -> None:
+            if error is not None:
+                outcome.error = str(error)
+            if ledger is not None:
+                if error is not None:
+                    ledger.record(outcome.metric, "failed", outcome.error)
+                else:
+                    ledger.record(outcome.metric, "uploaded")
+            report(outcome)
+
+        def uploaded(outcome: ForecastOutcome, error: Optional[Exception]) -> None:
+            # The metadata is written, with the next ones, once the prediction it
+            # points to is stored
+            if error is not None:
+                written(outcome, error)
+            else:
+                writer.put(outcome.metadata, partial(written, outcome))  # type: ignore
+            outcome.metadata = None
+
+        def done(outcome: ForecastOutcome) -> None:
+            # Uploaded in the background while the next metrics train
+            if outcome.prediction is not None:
+                uploads.submit(
+                    str(outcome.uuid),
+                    outcome.prediction,
+                    partial(uploaded, outcome),
+                    spans=outcome.spans,
+                    metric=outcome.metric.metric,
+                    host_id=outcome.metric.host_id,
+                    service_id=outcome.metric.service_id,
                 )
-                .forecast(horizon=forecasting_horizon, timeout=timeout)
-                .calculate_days_until_full()
-                .to_dict(uuid=uuid)
-            )
-            upload_all(metric=result, source=organization)
-        except Exception as e:
-            logger.error(
-                f"Something went wrong while making forecasts for key {item}: {e}"
+                outcome.prediction = None
+            else:
+                report(outcome)
+
+        if n_workers == 1:
+            outcomes = []
+            for index, (item, data) in enumerate(
+                tqdm.tqdm(prefetched, total=len(unique_labels))
+            ):
+                outcomes.append(
+                    train(
+                        item,
+                        prefetched=data,
+                        timeout=timeout_of(index),
+                        uuid=uuids[index],
+                    )
+                )
+                done(outcomes[-1])
+        else:
+            logger.info(
+                f"Training {len(unique_labels)} metrics with {n_workers} workers"
             )
-            break
+            # `spawn` avoids forking a process holding OpenMP and boto3 threads.
+            context = multiprocessing.get_context("spawn")
+            cpu_sets = context.Queue()
+            for cpus in split_cpus(n_workers):
+                cpu_sets.put(cpus)
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(cpu_sets,),
+            ) as executor, tqdm.tqdm(total=len(unique_labels)) as progress:
+                results: dict[int, ForecastOutcome] = {}
+                pending: dict[Future, int] = {}
+
+                def collect(finished: Iterable[Future]) -> None:
+                    for future in finished:
+                        index = pending.pop(future)
+                        try:
+                            results[index] = future.result()
+                        except Exception as e:
+                            # The worker process itself died (e.g. OOM killer)
+                            item = unique_labels[index]
+                            logger.error(f"Worker failed while forecasting {item}: {e}")
+                            results[index] = ForecastOutcome(metric=item, error=str(e))
+                            if ledger is not None:
+                                ledger.record(item, "failed", str(e))
+                        done(results[index])
+                        progress.update()
+
+                # Bound the number of series held in memory waiting for a worker.
+                # With a budget, a metric is only submitted once a worker is free, so
+                # that its timeout is computed when it starts training.
+                ahead = n_workers if scheduler is not None else 2 * n_workers
+                for index, (item, data) in enumerate(prefetched):
+                    if len(pending) >= ahead:
+                        collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                    future = executor.submit(
+                        train,
+                        item,
+                        prefetched=data,
+                        timeout=timeout_of(index),
+                        uuid=uuids[index],
+                    )
+                    pending[future] = index
+                collect(wait(pending).done)
+                outcomes = [results[index] for index in range(len(unique_labels))]
+
+    failures = [outcome for outcome in outcomes if outcome.error is not None]
+    logger.info(
+        f"Forecasts done: {len(outcomes) - len(failures)} succeeded, "
+        f"{len(failures)} failed."
+    )
+    observe_spans(run_spans)
+    log_summary(run_spans + [s for outcome in outcomes for s in outcome.spans])
+    # Back to the order of the metrics given
+    ordered: List[ForecastOutcome] = [None] * len(outcomes)  # type: ignore
+    for position, index in enumerate(order):
+        ordered[index] = outcomes[position]
+    return ordered
@@ -15,6 +15,7 @@
 
 from __future__ import annotations
 
+import time
 from abc import abstractmethod
 from typing import Callable, Optional
 
@@ -25,12 +26,23 @@ from sklearn.preprocessing import MinMaxScaler  # type: ignore
 
 from predictive_capacity import (
     HORIZON_PREDICTION_HOURS,
+    ML_MODEL_MAX_AGE_DAYS,
+    ML_MODEL_MAX_ERROR_RATIO,
+    ML_PREDICTION_INTERVALS,
     ML_TRAINING_TIMEOUT,
     __version__,
 )
-from predictive_capacity.forecast.models import auto_ml
+from predictive_capacity.forecast.cache import SeriesCache
+from predictive_capacity.forecast.models import (
+    MutliGBMTunedDetrended,
+    auto_ml,
+    error_metric,
+)
+from predictive_capacity.forecast.registry import ModelArtifact
+from predictive_capacity.instrumentation import span
 from predictive_capacity.schemas import MetricBase, SaturationForecast
 from predictive_capacity.warp10.fetch_metric import fetch_metric
+from predictive_capacity.warp10.fetch_metrics_bulk import MetricData
 from predictive_capacity.warp10.get_label_name import get_label_name
 from predictive_capacity.warp10.get_metric_saturation import get_metric_saturation
 
@@ -41,6 +53,8 @@ class MetricCommon:
     )
     features: list[str]
     interpolate: Callable[[], MetricCommon]
+    # Prefix of the spans of the preprocessing
+    stage: str
 
     def preprocess(
         self,
@@ -50,9 +64,10 @@ class MetricCommon:
         """
         Function that preprocesses the data.
         """
-        self.interpolate().add_temporal_features().scale(scaler).remove_features(
-            features
-        )
+        with span(f"{self.stage}.resample"):
+            self.interpolate()
+        with span(f"{self.stage}.scale"):
+            self.add_temporal_features().scale(scaler).remove_features(features)
         return self
 
     def add_temporal_features(self):
@@ -81,28 +96,106 @@ class MetricCommon:
 
 
 class MetricTraining(MetricCommon):
-    def __init__(self, token, metric, labels):
-        self.data = pd.DataFrame(
-            fetch_metric(token, metric, labels).loc[:, metric]  # ignore type
-        ).sort_index()
+    stage = "training"
+
+    def __init__(
+        self,
+        token,
+        metric,
+        labels,
+        prefetched: Optional[MetricData] = None,
+        cache: Optional[SeriesCache] = None,
+    ):
+        if prefetched is None:
+            with span("saturation_fetch"):
+                self.maximum_allowed = get_metric_saturation(token, metric, labels)
+            with span("warp10_fetch", cached=cache is not None) as attributes:
+                data, last_value = self.fetch(token, metric, labels, cache)
+                attributes["points"] = len(data)
+        elif prefetched.maximum_allowed is None:
+            msg = f"No maximum value found for metric {metric}{{{labels}}}."
+            logger.error(msg)
+            raise ValueError(msg)
+        else:
+            self.maximum_allowed = prefetched.maximum_allowed
+            data = pd.DataFrame(prefetched.data.loc[:, metric]).sort_index()
+            last_value = data[metric].values[-1]
+            if cache is not None:
+                cache.store(metric, labels, data, self.maximum_allowed)
+        self.data = data.sort_index()
         assert metric == self.data.columns[0]
         assert isinstance(self.data.index, pd.DatetimeIndex)
-        self.maximum_allowed = get_metric_saturation(token, metric, labels)
-        self.current_saturation = self.data[metric].values[-1] / self.maximum_allowed
+        self.current_saturation = last_value / self.maximum_allowed
 
-    def remove_features(self, features: list[str]):
+    def fetch(
+        self,
+        token: str,
+        metric: str,
+        labels: dict[str, str],
+        cache: Optional[SeriesCache] = None,
+    ) -> tuple[pd.DataFrame, float]:
+        """
+        Fetch the history of the metric, using the cache when available.
+
+        When the metric is cached, only the points after the cached high-water mark
+        are fetched and appended to the cached hourly history. The cache is dropped
+        when the saturation of the metric has changed.
+
+        Returns
+        -------
+        tuple[pd.DataFrame, float]
+            History of the metric and its last raw value.
+        """
+        cached = None if cache is None else cache.load(metric, labels)
+        if cached is not None and cached.maximum_allowed != self.maximum_allowed:
+            logger.info(f"Saturation of {metric} changed, invalidating its cache.")
+            cache.invalidate(metric, labels)  # type: ignore
+            cached = None
+
+        if cached is None:
+            data = pd.DataFrame(
+                fetch_metric(token, metric, labels).loc[:, metric]  # ignore type
+            ).sort_index()
+            if cache is not None:
+                cache.store(metric, labels, data, self.maximum_allowed)
+            return data, data[metric].values[-1]
+
+        start = int(cached.high_water_mark.value // 1000)
+        delta = fetch_metric(token, metric, labels, start=start)
+        logger.debug(f"Fetched {len(delta)} new points for {metric} from cache.")
+        if len(delta) == 0 or metric not in delta.columns:
+            return cached.data, cached.last_value
+
+        delta = pd.DataFrame(delta.loc[:, metric]).sort_index()
+        if delta.index.tz is not None:  # type: ignore
+            cached.data.index = cached.data.index.tz_localize("UTC").tz_convert(
+                delta.index.tz  # type: ignore
+            )
+        data = pd.concat([cached.data, delta])
+        cache.store(metric, labels, data, self.maximum_allowed)  # type: ignore
+        return data, delta[metric].values[-1]
+
+    def remove_features(self, features: Optional[list[str]] = None):
+        """
+        Remove the constant features, or keep only `features` if given.
+        """
+        if features is not None:
+            self.data = self.data[[self.data.columns[0], *features]]
+            self.features = list(features)
+            return self
         unique_counts = self.data.iloc[:, 1:].nunique()
         columns_to_drop = unique_counts[unique_counts == 1].index
         self.data = self.data.drop(columns=columns_to_drop)
         self.features = self.data.columns[1:].tolist()
         return self
 
-    def scale(self, *args, **kwargs):
+    def scale(self, scaler: Optional[MinMaxScaler] = None, *args, **kwargs):
         """
         Scale the metric and all of its features.
 
         The metric is scaled to [0 - 1] using a MinMaxScaler.
-        The features are scaled using a QuantileTransformer.
+        The features are scaled using a QuantileTransformer, or with `scaler` if
+        given, e.g. to reuse the scaling of a previously trained model.
         """
         # Fit the metric
         self.metric_scaler = MinMaxScaler(feature_range=(0, 1))
@@ -114,6 +207,12 @@ class MetricTraining(MetricCommon):
         )
 
         # Fit the features
+        if scaler is not None:
+            self.time_scaler = scaler
+            self.data[self.data.columns[1:]] = scaler.transform(
+                self.data[self.data.columns[1:]]
+            )
+            return self
         self.time_scaler = MinMaxScaler(feature_range=(0, 1))
         # No reshape because we send a matrix as input (multiple columns)
         self.data[self.data.columns[1:]] = self.time_scaler.fit_transform(
@@ -134,6 +233,8 @@ class MetricTraining(MetricCommon):
 
 
 class MetricForecasting(MetricCommon):
+    stage = "forecasting"
+
     def __init__(self, start: pd.Timestamp, horizon=HORIZON_PREDICTION_HOURS):
         self.data = pd.DataFrame(
             [],
@@ -156,7 +257,12 @@ class MetricForecasting(MetricCommon):
 class Metric:
     current_saturation: Optional[float] = None
     days_until_full: Optional[float] = None
+    reg: Optional[MutliGBMTunedDetrended] = None
+    reused: bool = False
+    training_time: Optional[float] = None
     forecast_values: pd.Series = pd.Series(index=pd.DatetimeIndex([]), dtype="float64")
+    forecast_lower: Optional[pd.Series] = None
+    forecast_upper: Optional[pd.Series] = None
 
     def __init__(
         self,
@@ -165,6 +271,8 @@ class Metric:
         service_id: str,
         platform_uuid: str,
         token: str,
+        prefetched: Optional[MetricData] = None,
+        cache: Optional[SeriesCache] = None,
     ):
         # Description of the metric
         self.metric = metric
@@ -177,15 +285,34 @@ class Metric:
             "platform_uuid": platform_uuid,
         }
         self.token = token
-        self.host_name, self.service_name = get_label_name(token, metric, self.labels)
+        if prefetched is None:
+            with span("label_lookup"):
+                self.host_name, self.service_name = get_label_name(
+                    token, metric, self.labels
+                )
+        else:
+            self.host_name = prefetched.host_name
+            self.service_name = prefetched.service_name
         self.confidence_level = 0
-        self.training_metric = MetricTraining(token, metric, self.labels)
+        self.training_metric = MetricTraining(
+            token, metric, self.labels, prefetched, cache
+        )
 
     def forecast(
         self,
         horizon: int = HORIZON_PREDICTION_HOURS,
         timeout: int = ML_TRAINING_TIMEOUT,
+        warm_start_trials: Optional[list[dict]] = None,
+        previous_model: Optional[ModelArtifact] = None,
+        max_error_ratio: float = ML_MODEL_MAX_ERROR_RATIO,
+        max_age: pd.Timedelta = pd.Timedelta(days=ML_MODEL_MAX_AGE_DAYS),
     ):
+        """
+        Train a model on the metric and forecast it over `horizon` hours.
+
+        If `previous_model` is given and still fits the data that arrived since it
+        was trained (see `reuse_model`), it is used as is and no search is run.
+        """
         # Properties based on metric values
         self.current_saturation = self.training_metric.current_saturation
         assert isinstance(self.training_metric.data.index, pd.DatetimeIndex)
@@ -209,18 +336,38 @@ class Metric:
 
         logger.info(f"first forecast date: {self.forecast_dates[0]}")
 
-        self.training_metric.preprocess()
+        reuse = False
+        if previous_model is not None:
+            with span("reuse_check") as attributes:
+                reuse = self.reuse_model(previous_model, max_error_ratio, max_age)
+                attributes["reused"] = reuse
+        if reuse:
+            reg = previous_model.model
+            self.confidence_level = reg.confidence_level
+            self.training_time = previous_model.training_time
+            self.reused = True
+        else:
+            self.training_metric.preprocess()
+            start = time.monotonic()
+            reg, self.confidence_level = auto_ml(
+                self.training_metric.data,
+                timeout=timeout,
+                warm_start_trials=warm_start_trials,
+            )
+            self.training_time = time.monotonic() - start
+        self.reg = reg
 
         features = self.training_metric.features
         scaler = self.training_metric.time_scaler
-        reg, self.confidence_level = auto_ml(self.training_metric.data, timeout=timeout)
-
         self.forecast_metric.preprocess(features, scaler)
 
-        self.forecast_values = pd.Series(
-            np.array(reg.predict(self.forecast_metric.data.to_numpy())),
-            index=self.forecast_dates,
-        )
+        with span("predict", intervals=ML_PREDICTION_INTERVALS):
+            self.forecast_values = pd.Series(
+                np.array(reg.predict(self.forecast_metric.data.to_numpy())),
+                index=self.forecast_dates,
+            )
+            if ML_PREDICTION_INTERVALS:
+                self.predict_intervals()
 
         logger.debug(f"Confidence level: {self.confidence_level}")
         logger.debug(
@@ -235,6 +382,94 @@ class Metric:
 
         return self
 
+    def reuse_model(
+        self,
+        previous_model: ModelArtifact,
+        max_error_ratio: float,
+        max_age: pd.Timedelta,
+    ) -> bool:
+        """
+        Function that checks whether a previously trained model can be reused.
+
+        The model is reused if it is younger than `max_age`, the saturation of the
+        metric did not change and its MASE on the data that arrived since it was
+        trained is at most `max_error_ratio` times its cross-validation MASE.
+
+        When the model is reused, the training data is preprocessed with the
+        features and the scaler of the model.
+        """
+        age = pd.Timestamp.now(tz="UTC") - previous_model.trained_at
+        if age > max_age:
+            logger.info(f"Previous model is {age} old, retraining.")
+            return False
+        if previous_model.maximum_allowed != self.training_metric.maximum_allowed:
+            logger.info("Saturation changed since the previous model, retraining.")
+            return False
+
+        raw_data = self.training_metric.data.copy()
+        self.training_metric.preprocess(
+            previous_model.features, previous_model.time_scaler
+        )
+        data = self.training_metric.data
+        new = data.index > previous_model.trained_until
+        if new.sum() > 0:
+            y = data.iloc[:, 0].to_numpy()
+            y_pred = previous_model.model.predict(data.iloc[:, 1:].to_numpy()[new])
+            error = (
+                error_metric(y[new], y_pred, y_train=y[~new])
+                if (~new).sum() > 1
+                else np.inf
+            )
+            if error > max_error_ratio * previous_model.best_value:
+                logger.info(
+                    f"Previous model error {error:.3f} exceeds "
+                    f"{max_error_ratio} x {previous_model.best_value:.3f}, retraining."
+                )
+                self.training_metric.data = raw_data
+                return False
+            logger.debug(f"Previous model error on {new.sum()} new points: {error}")
+
+        logger.info(f"Reusing the model trained at {previous_model.trained_at}.")
+        return True
+
+    def predict_intervals(self):
+        """
+        Function that forecasts the 1% and 99% quantiles of the metric.
+
+        The quantile models are fitted on the training data if the model does not
+        have them yet.
+        """
+        assert self.reg is not None, "The metric must be forecast first."
+        if self.reg.best_gbm_low is None or self.reg.best_gbm_high is None:
+            data = self.training_metric.data
+            self.reg.fit_intervals(
+                data.iloc[:, 1:].to_numpy(), data.iloc[:, 0].to_numpy()
+            )
+        X = self.forecast_metric.data.to_numpy()
+        self.forecast_lower = pd.Series(
+            np.array(self.reg.predict_low(X)), index=self.forecast_dates
+        )
+        self.forecast_upper = pd.Series(
+            np.array(self.reg.predict_high(X)), index=self.forecast_dates
+        )
+        return self
+
+    def model_artifact(self) -> ModelArtifact:
+        """
+        Function that returns the fitted model with what is needed to reuse it.
+        """
+        assert self.reg is not None, "The metric must be forecast first."
+        return ModelArtifact(
+            model=self.reg,
+            features=self.training_metric.features,
+            time_scaler=self.training_metric.time_scaler,
+            maximum_allowed=self.training_metric.maximum_allowed,
+            best_value=float(self.reg.study.best_value),
+            trained_until=self.last_timestamp,
+            trained_at=pd.Timestamp.now(tz="UTC"),
+            training_time=self.training_time,
+        )
+
     def calculate_days_until_full(self):
         """
         Function that gets the number of days until the metric is full according to the
@@ -267,6 +502,13 @@ class Metric:
             self.forecast_values = forecast_until_full
         else:
             self.hours_until_full = len(self.forecast_values) + 1
+        if self.forecast_lower is not None and self.forecast_upper is not None:
+            self.forecast_lower = self.forecast_lower.reindex(
+                self.forecast_values.index
+            )
+            self.forecast_upper = self.forecast_upper.reindex(
+                self.forecast_values.index
+            )
         return self
 
     def to_dict(self, uuid: str) -> MetricBase:
@@ -318,4 +560,16 @@ class Metric:
             ),
             confidence_level=self.confidence_level,
             uuid=uuid,
+            training_time=self.training_time,
+            history_length=len(data_scaled),
+            forecast_lower=(
+                self.forecast_lower.values.tolist()
+                if self.forecast_lower is not None
+                else None
+            ),
+            forecast_upper=(
+                self.forecast_upper.values.tolist()
+                if self.forecast_upper is not None
+                else None
+            ),
         )
@@ -14,9 +14,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import math
+import os
+import threading
 import warnings
-from typing import Tuple
+from typing import Callable, Optional, Tuple
 
+import lightgbm as lgb
 import numpy as np
 import optuna
 import pandas as pd
@@ -34,23 +37,349 @@ from sklearn.linear_model import HuberRegressor, Ridge  # type: ignore
 from sklearn.model_selection import TimeSeriesSplit  # type: ignore
 from sklearn.pipeline import make_pipeline  # type: ignore
 from sklearn.preprocessing import PolynomialFeatures  # type: ignore
+from threadpoolctl import threadpool_limits
+
+from predictive_capacity import (
+    ML_OPTUNA_PRUNER,
+    ML_TRIAL_JOBS,
+    ML_TRIAL_JOBS_MIN_LENGTH,
+    ML_WARM_START_PATIENCE,
+)
+from predictive_capacity.instrumentation import span
 
 optuna.logging.set_verbosity(optuna.logging.WARNING)
 
 seed = 0
 np.random.seed(seed)
 
+# Significant digits kept of the epsilon of the Huber trend. Trials whose epsilons
+# round to the same value share the same trend fits.
+HUBER_EPS_DIGITS = 2
+
+
+def round_significant(x: float, digits: int = HUBER_EPS_DIGITS) -> float:
+    """Round `x` to `digits` significant digits."""
+    return float(f"{x:.{digits - 1}e}")
+
+
+def make_trend_forecaster(degree: int, trend_model: str, param: float):
+    """
+    Polynomial trend of the series over time.
+
+    Parameters
+    ----------
+    degree: int
+        Degree of the polynomial.
+    trend_model: str
+        "huber" or "ridge".
+    param: float
+        Epsilon of the Huber regressor or alpha of the Ridge regressor.
+    """
+    if trend_model == "ridge":
+        return make_pipeline(PolynomialFeatures(degree), Ridge(alpha=param))
+    return make_pipeline(
+        PolynomialFeatures(degree), HuberRegressor(epsilon=round_significant(param))
+    )
+
+
+# Boosting rounds between two reports of the intermediate error of a trial
+PRUNING_ROUNDS = 100
+# Steps reported per fold, at least the largest number of boosting rounds
+FOLD_STEPS = 3000
+
+
+def make_pruner(name: str, n_splits: int) -> optuna.pruners.BasePruner:
+    """
+    Pruner of the hyperparameter search.
+
+    Parameters
+    ----------
+    name: str
+        "asha" for asynchronous successive halving, "hyperband" or "none".
+    n_splits: int
+        Number of cross-validation folds.
+    """
+    if name == "hyperband":
+        return optuna.pruners.HyperbandPruner(
+            min_resource=PRUNING_ROUNDS, max_resource=n_splits * FOLD_STEPS
+        )
+    if name == "none":
+        return optuna.pruners.NopPruner()
+    if name != "asha":
+        raise ValueError(f"Unknown pruner {name}, expected asha, hyperband or none.")
+    return optuna.pruners.SuccessiveHalvingPruner(min_resource=PRUNING_ROUNDS)
+
+
+def lgb_report_callback(report: Callable[[int, float], None]) -> Callable:
+    """LightGBM callback reporting the validation error every `PRUNING_ROUNDS`."""
+
+    def callback(env: lgb.callback.CallbackEnv) -> None:
+        rounds = env.iteration + 1
+        if rounds % PRUNING_ROUNDS == 0 and rounds < env.end_iteration:
+            report(rounds, env.evaluation_result_list[0][2])
+
+    return callback
+
+
+# Hyperparameters of the search that are not parameters of the gradient boosting
+TREND_PARAMS = [
+    "damped",
+    "trend_model",
+    "poly_degree",
+    "ridge_alpha",
+    "svr_C",
+    "huber_eps",
+    "gbm_type",
+]
+
+
+def make_gbm(best_params: dict, quantile: Optional[float] = None):
+    """
+    Gradient boosting model with the hyperparameters found by the search.
+
+    Parameters
+    ----------
+    best_params: dict
+        Best hyperparameters of the search.
+    quantile: Optional[float]
+        Quantile predicted by the model instead of the one found by the search.
+    """
+    gbm_params = {
+        "random_state": seed,
+        **{k: v for k, v in best_params.items() if k not in TREND_PARAMS},
+    }
+    if best_params["gbm_type"] == "lgbm":
+        if quantile is not None:
+            gbm_params["alpha"] = quantile
+        return LGBMRegressor(verbose=-1, **gbm_params)
+    if best_params["gbm_type"] == "gbr":
+        if quantile is not None:
+            gbm_params["alpha"] = quantile
+        return GradientBoostingRegressor(**gbm_params)
+    if quantile is not None:
+        gbm_params["quantile"] = quantile
+    return HistGradientBoostingRegressor(**gbm_params)
+
+
+def available_cpus() -> int:
+    """Number of CPUs the current process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def booster_params(gbm: LGBMRegressor) -> dict:
+    """Parameters of `lgb.train` equivalent to those of a LGBMRegressor."""
+    params = gbm.get_params()
+    return {
+        "objective": params["objective"],
+        "alpha": params["alpha"],
+        "learning_rate": params["learning_rate"],
+        "lambda_l1": params["reg_alpha"],
+        "lambda_l2": params["reg_lambda"],
+        "seed": params["random_state"],
+        "verbose": -1,
+    }
+
 
 class MutliGBMTunedDetrended(BaseEstimator, RegressorMixin):
-    def __init__(self, n_trials=400, timeout=300, n_splits=5):
+    # Models of the prediction intervals, fitted on demand by `fit_intervals`
+    best_gbm_low = None
+    best_gbm_high = None
+
+    def __init__(
+        self,
+        n_trials=400,
+        timeout=300,
+        n_splits=5,
+        warm_start_trials=None,
+        patience=ML_WARM_START_PATIENCE,
+        n_jobs=1,
+    ):
         self.n_trials = n_trials
         self.timeout = timeout
         self.n_splits = n_splits
+        self.warm_start_trials = warm_start_trials
+        self.patience = patience
+        self.n_jobs = n_jobs
+
+    @property
+    def lgb_datasets(self) -> dict[int, Tuple[lgb.Dataset, lgb.Dataset]]:
+        """
+        LightGBM datasets of the folds built by the current thread.
+
+        Trials running concurrently change the labels of the datasets, so each
+        thread has its own.
+        """
+        local = self.__dict__.setdefault("_thread_data", threading.local())
+        if not hasattr(local, "lgb_datasets"):
+            local.lgb_datasets = {}
+        return local.lgb_datasets
+
+    @property
+    def gil_lock(self) -> threading.Lock:
+        """
+        Lock held while fitting the models other than LightGBM.
+
+        Only LightGBM releases the GIL for the whole training, so the models of the
+        other trials running concurrently are fitted one at a time.
+        """
+        return self.__dict__.setdefault("_gil_lock", threading.Lock())
+
+    def stop_when_confirmed(
+        self, study: optuna.Study, trial: optuna.trial.FrozenTrial
+    ) -> None:
+        """
+        Stop a warm started search once the previous optimum is confirmed.
+
+        The trials of the previous search are evaluated first. The search stops when
+        none of the `patience` trials sampled after the best one improved on it.
+        """
+        if trial.number < len(self.warm_start_trials or []):
+            return
+        try:
+            best_number = study.best_trial.number
+        except ValueError:
+            return
+        if trial.number - best_number >= self.patience:
+            logger.debug(f"No improvement since trial {best_number}, stopping.")
+            study.stop()
+
+    def fold_trend(
+        self, fold: int, degree: int, trend_model: str, param: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Trend of a cross-validation fold on its training and validation points.
+
+        The trend only depends on the fold and on the trend hyperparameters, not on
+        the gradient boosting ones, so it is fitted once per fold for all the trials
+        sharing them. The epsilon of the Huber regressor is rounded to
+        `HUBER_EPS_DIGITS` significant digits.
+        """
+        if trend_model == "huber":
+            param = round_significant(param)
+        key = (fold, degree, trend_model, param)
+        train_end, valid_end = self.folds[fold]
+        trend_forecaster = self.trend_cache.get(key)
+        if trend_forecaster is None:
+            trend_forecaster = make_trend_forecaster(degree, trend_model, param)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                trend_forecaster.fit(self.time[:train_end], self.y[:train_end])
+            self.trend_cache[key] = trend_forecaster
+        # A single prediction covers both sets
+        trend = np.asarray(trend_forecaster.predict(self.time[:valid_end]))
+        return trend[:train_end], trend[train_end:]
+
+    def fold_datasets(self, fold: int) -> Tuple[lgb.Dataset, lgb.Dataset]:
+        """
+        LightGBM datasets of the training and validation points of a fold.
+
+        Features are binned once per fold and reused by all the LightGBM trials, only
+        the labels change with the trend removed from the target.
+        """
+        datasets = self.lgb_datasets.get(fold)
+        if datasets is None:
+            train_end, valid_end = self.folds[fold]
+            train = lgb.Dataset(
+                self.X[:train_end],
+                label=self.y[:train_end],
+                params={"verbose": -1, "num_threads": self.threads_per_trial},
+                free_raw_data=False,
+            ).construct()
+            valid = lgb.Dataset(
+                self.X[train_end:valid_end],
+                label=self.y[train_end:valid_end],
+                reference=train,
+                free_raw_data=False,
+            ).construct()
+            datasets = self.lgb_datasets[fold] = (train, valid)
+        return datasets
+
+    def fit_predict_fold(
+        self,
+        gbm,
+        fold: int,
+        target: np.ndarray,
+        valid_target: Optional[np.ndarray] = None,
+        report: Optional[Callable[[int, float], None]] = None,
+    ) -> np.ndarray:
+        """
+        Fit `gbm` on `target` over the training points of a fold and predict its
+        validation points.
+
+        If `report` is given, it is called every `PRUNING_ROUNDS` boosting rounds with
+        the number of rounds and the mean absolute error on `valid_target` so far. It
+        raises `optuna.TrialPruned` to stop the training.
+        """
+        train_end, valid_end = self.folds[fold]
+        train_x, valid_x = self.X[:train_end], self.X[train_end:valid_end]
+        if isinstance(gbm, LGBMRegressor):
+            train, valid = self.fold_datasets(fold)
+            train.set_label(target)
+            callbacks = []
+            if report is not None:
+                valid.set_label(valid_target)
+                callbacks.append(lgb_report_callback(report))
+            booster = lgb.train(
+                {
+                    **booster_params(gbm),
+                    "metric": "l1",
+                    "num_threads": self.threads_per_trial,
+                },
+                train,
+                num_boost_round=gbm.n_estimators,
+                valid_sets=[valid] if report is not None else None,
+                callbacks=callbacks,
+            )
+            return np.asarray(booster.predict(valid_x))
+
+        with self.gil_lock:
+            if report is None:
+                gbm.fit(train_x, target)
+                return np.asarray(gbm.predict(valid_x))
+            # Grow the ensemble by chunks of trees to evaluate it while it is trained
+            n_rounds_param = (
+                "max_iter"
+                if isinstance(gbm, HistGradientBoostingRegressor)
+                else "n_estimators"
+            )
+            n_rounds = gbm.get_params()[n_rounds_param]
+            gbm.set_params(warm_start=False)
+            for rounds in range(PRUNING_ROUNDS, n_rounds, PRUNING_ROUNDS):
+                gbm.set_params(**{n_rounds_param: rounds}).fit(train_x, target)
+                gbm.set_params(warm_start=True)
+                report(
+                    rounds, float(np.mean(np.abs(valid_target - gbm.predict(valid_x))))
+                )
+            gbm.set_params(**{n_rounds_param: n_rounds}).fit(train_x, target)
+            gbm.set_params(warm_start=False)
+            return np.asarray(gbm.predict(valid_x))
+
+    def fold_reporter(
+        self, trial: optuna.Trial, fold: int, mae_scores: list[float]
+    ) -> Callable[[int, float], None]:
+        """
+        Report the intermediate error of a trial while a fold is being trained.
+
+        The reported value is the mean of the MASE of the previous folds and of the
+        MASE of the current fold so far, at step `fold * FOLD_STEPS + rounds`.
+        """
+        train_end, _ = self.folds[fold]
+        scale = max(
+            float(np.mean(np.abs(np.diff(self.y[:train_end])))), np.finfo(float).eps
+        )
+
+        def report(rounds: int, mae: float) -> None:
+            value = float(np.mean([*mae_scores, mae / scale]))
+            trial.report(value, fold * FOLD_STEPS + rounds)
+            if trial.should_prune():
+                raise optuna.TrialPruned()
+
+        return report
 
     def objective(self, trial: optuna.Trial) -> float:
-        X = self.X
         y = self.y
-        tscv = TimeSeriesSplit(n_splits=self.n_splits, test_size=int(0.1 * len(X)))
 
         gbm_type = trial.suggest_categorical("gbm_type", ["lgbm", "gbr", "hgbr"])
 
@@ -100,45 +429,34 @@ class MutliGBMTunedDetrended(BaseEstimator, RegressorMixin):
             )
 
             if trend_model == "ridge":
-                trend_forecaster = make_pipeline(
-                    PolynomialFeatures(degree),
-                    Ridge(alpha=trial.suggest_float("ridge_alpha", 0.0001, 1000.0)),
-                )
+                trend_param = trial.suggest_float("ridge_alpha", 0.0001, 1000.0)
             else:
-                trend_forecaster = make_pipeline(
-                    PolynomialFeatures(degree),
-                    HuberRegressor(epsilon=trial.suggest_float("huber_eps", 1, 1000.0)),
-                )
+                trend_param = trial.suggest_float("huber_eps", 1, 1000.0)
 
             damped = trial.suggest_float("damped", -1.0, 1.0, step=0.01)
 
             mae_scores = []
-            for k, (train_index, valid_index) in enumerate(tscv.split(X)):
-                train_x, valid_x = X[train_index], X[valid_index]
-                train_y, valid_y = y[train_index], y[valid_index]
-
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    trend_forecaster.fit(train_x[:, 0].reshape(-1, 1), train_y)
-
-                gbm.fit(
-                    train_x,
-                    train_y
-                    - damped
-                    * np.array(trend_forecaster.predict(train_x[:, 0].reshape(-1, 1))),
+            for k, (train_end, valid_end) in enumerate(self.folds):
+                train_y, valid_y = y[:train_end], y[train_end:valid_end]
+                trend_train, trend_valid = self.fold_trend(
+                    k, degree, trend_model, trend_param
                 )
 
-                preds = np.array(gbm.predict(valid_x))
+                preds = self.fit_predict_fold(
+                    gbm,
+                    k,
+                    train_y - damped * trend_train,
+                    valid_target=valid_y - damped * trend_valid,
+                    report=self.fold_reporter(trial, k, mae_scores),
+                )
                 mae = error_metric(
                     valid_y,
-                    preds
-                    + damped
-                    * np.array(trend_forecaster.predict(valid_x[:, 0].reshape(-1, 1))),
+                    preds + damped * trend_valid,
                     y_train=train_y,
                 )
                 mae_scores.append(mae)
 
-                trial.report(float(np.mean(mae_scores)), k)
+                trial.report(float(np.mean(mae_scores)), (k + 1) * FOLD_STEPS)
                 if trial.should_prune():
                     raise optuna.TrialPruned()
 
@@ -149,12 +467,16 @@ class MutliGBMTunedDetrended(BaseEstimator, RegressorMixin):
             return mean_mae
         else:
             mae_scores = []
-            for k, (train_index, valid_index) in enumerate(tscv.split(X)):
-                train_x, valid_x = X[train_index], X[valid_index]
-                train_y, valid_y = y[train_index], y[valid_index]
-
-                gbm.fit(train_x, train_y)
-                preds = gbm.predict(valid_x)
+            for k, (train_end, valid_end) in enumerate(self.folds):
+                train_y, valid_y = y[:train_end], y[train_end:valid_end]
+
+                preds = self.fit_predict_fold(
+                    gbm,
+                    k,
+                    train_y,
+                    valid_target=valid_y,
+                    report=self.fold_reporter(trial, k, mae_scores),
+                )
 
                 mae = error_metric(
                     valid_y,
@@ -163,7 +485,7 @@ class MutliGBMTunedDetrended(BaseEstimator, RegressorMixin):
                 )
                 mae_scores.append(mae)
 
-                trial.report(float(np.mean(mae_scores)), k)
+                trial.report(float(np.mean(mae_scores)), (k + 1) * FOLD_STEPS)
                 if trial.should_prune():
                     raise optuna.TrialPruned()
 
@@ -174,133 +496,72 @@ class MutliGBMTunedDetrended(BaseEstimator, RegressorMixin):
             return mean_mae
 
     def fit(self, X, y):
-        self.X = X
-        self.y = y
+        # Row-major so that the folds are contiguous views of the data
+        self.X = np.ascontiguousarray(X)
+        self.y = np.ascontiguousarray(y)
+        self.time = np.ascontiguousarray(self.X[:, :1])
+        # The folds of TimeSeriesSplit are contiguous: each one is stored as the end
+        # of its training points and the end of its validation points
+        tscv = TimeSeriesSplit(n_splits=self.n_splits, test_size=int(0.1 * len(X)))
+        self.folds = [
+            (len(train_index), valid_index[-1] + 1)
+            for train_index, valid_index in tscv.split(X)
+        ]
+        self.trend_cache: dict = {}
+        # Trials running concurrently share the CPUs available to the process
+        n_jobs = max(1, min(self.n_jobs, available_cpus()))
+        self.threads_per_trial = available_cpus() // n_jobs
         self.study = optuna.create_study(
             direction="minimize",
             study_name="forecast_dream",
             sampler=optuna.samplers.TPESampler(seed=seed),
-            pruner=optuna.pruners.SuccessiveHalvingPruner(),
+            pruner=make_pruner(ML_OPTUNA_PRUNER, self.n_splits),
         )
-        self.study.optimize(
-            self.objective, n_trials=self.n_trials, timeout=self.timeout
-        )
-
-        self.best_params = self.study.best_params
-
-        if self.best_params["poly_degree"] > 0:
-            self.damped = self.best_params["damped"]
-            if self.best_params["trend_model"] == "ridge":
-                self.trend_forecaster = make_pipeline(
-                    PolynomialFeatures(degree=self.best_params["poly_degree"]),
-                    Ridge(alpha=self.best_params["ridge_alpha"]),
-                )
-            else:
-                self.trend_forecaster = make_pipeline(
-                    PolynomialFeatures(degree=self.best_params["poly_degree"]),
-                    HuberRegressor(epsilon=self.best_params["huber_eps"]),
-                )
-
-            self.trend_forecaster.fit(X[:, 0].reshape(-1, 1), y)
-
-        if self.best_params["gbm_type"] == "lgbm":
-            gbm_params = {
-                "random_state": seed,
-                "verbose": -1,
-                **{
-                    k: v
-                    for k, v in self.best_params.items()
-                    if k
-                    not in [
-                        "damped",
-                        "trend_model",
-                        "poly_degree",
-                        "ridge_alpha",
-                        "svr_C",
-                        "huber_eps",
-                        "gbm_type",
-                    ]
-                },
-            }
-
-            self.best_gbm = LGBMRegressor(**gbm_params)
-            self.best_gbm_low = LGBMRegressor(
-                **{k: (v if k != "alpha" else 0.01) for k, v in gbm_params.items()}  # type: ignore
+        callbacks = []
+        if self.warm_start_trials:
+            for trial in self.warm_start_trials:
+                self.study.enqueue_trial(trial["params"], skip_if_exists=True)
+            callbacks.append(self.stop_when_confirmed)
+        # LightGBM releases the GIL while training, so trials can run in threads.
+        # The other models are fitted one at a time (see `gil_lock`) and their
+        # OpenMP pools are limited to the share of CPUs of a trial.
+        with span("search", n_jobs=n_jobs) as attributes, threadpool_limits(
+            limits=self.threads_per_trial
+        ):
+            self.study.optimize(
+                self.objective,
+                n_trials=self.n_trials,
+                timeout=self.timeout,
+                callbacks=callbacks,
+                n_jobs=n_jobs,
             )
-            self.best_gbm_high = LGBMRegressor(
-                **{k: (v if k != "alpha" else 0.99) for k, v in gbm_params.items()}  # type: ignore
+            trials = self.study.get_trials(deepcopy=False)
+            attributes["trials"] = len(trials)
+            attributes["pruned"] = sum(
+                trial.state == optuna.trial.TrialState.PRUNED for trial in trials
             )
+            attributes["best_value"] = self.study.best_value
+        self.trend_cache = {}
+        self.__dict__.pop("_thread_data", None)
+        self.__dict__.pop("_gil_lock", None)
 
-        elif self.best_params["gbm_type"] == "gbr":
-            gbm_params = {
-                "random_state": seed,
-                **{
-                    k: v
-                    for k, v in self.best_params.items()
-                    if k
-                    not in [
-                        "damped",
-                        "trend_model",
-                        "poly_degree",
-                        "ridge_alpha",
-                        "svr_C",
-                        "huber_eps",
-                        "gbm_type",
-                    ]
-                },
-            }
-            self.best_gbm = GradientBoostingRegressor(**gbm_params)
-            self.best_gbm_low = GradientBoostingRegressor(
-                **{k: (v if k != "alpha" else 0.01) for k, v in gbm_params.items()}  # type: ignore
-            )
-            self.best_gbm_high = GradientBoostingRegressor(
-                **{k: (v if k != "alpha" else 0.99) for k, v in gbm_params.items()}  # type: ignore
-            )
+        self.best_params = self.study.best_params
 
-        else:
-            gbm_params = {
-                "random_state": seed,
-                **{
-                    k: v
-                    for k, v in self.best_params.items()
-                    if k
-                    not in [
-                        "damped",
-                        "trend_model",
-                        "poly_degree",
-                        "ridge_alpha",
-                        "svr_C",
-                        "huber_eps",
-                        "gbm_type",
-                    ]
-                },
-            }
+        with span("final_fit"):
+            if self.best_params["poly_degree"] > 0:
+                self.damped = self.best_params["damped"]
+                self.trend_forecaster = make_trend_forecaster(
+                    self.best_params["poly_degree"],
+                    self.best_params["trend_model"],
+                    self.best_params.get(
+                        "ridge_alpha", self.best_params.get("huber_eps")
+                    ),
+                )
 
-            self.best_gbm = HistGradientBoostingRegressor(**gbm_params)
-            self.best_gbm_low = HistGradientBoostingRegressor(
-                **{k: (v if k != "quantile" else 0.01) for k, v in gbm_params.items()}  # type: ignore
-            )
-            self.best_gbm_high = HistGradientBoostingRegressor(
-                **{k: (v if k != "quantile" else 0.99) for k, v in gbm_params.items()}  # type: ignore
-            )
+                self.trend_forecaster.fit(X[:, 0].reshape(-1, 1), y)
 
-        if self.best_params["poly_degree"] > 0:
-            self.best_gbm.fit(
-                X,
-                y - self.damped * self.trend_forecaster.predict(X[:, 0].reshape(-1, 1)),
-            )
-            self.best_gbm_low.fit(
-                X,
-                y - self.damped * self.trend_forecaster.predict(X[:, 0].reshape(-1, 1)),
-            )
-            self.best_gbm_high.fit(
-                X,
-                y - self.damped * self.trend_forecaster.predict(X[:, 0].reshape(-1, 1)),
-            )
-        else:
-            self.best_gbm.fit(X, y)
-            self.best_gbm_low.fit(X, y)
-            self.best_gbm_high.fit(X, y)
+            self.best_gbm = make_gbm(self.best_params)
+            self.best_gbm.fit(X, self.detrend(X, y))
 
         # confidence level
 
@@ -331,7 +592,34 @@ class MutliGBMTunedDetrended(BaseEstimator, RegressorMixin):
 
         return y_pred
 
+    def detrend(self, X, y):
+        """Remove the damped trend from the target."""
+        if self.best_params["poly_degree"] > 0:
+            return y - self.damped * self.trend_forecaster.predict(
+                X[:, 0].reshape(-1, 1)
+            )
+        return y
+
+    def fit_intervals(self, X=None, y=None):
+        """
+        Fit the models of the 1% and 99% quantiles used by `predict_low` and
+        `predict_high`.
+
+        They are not fitted by `fit` since most forecasts do not need them. By
+        default, they are fitted on the training data of `fit`.
+        """
+        if X is None or y is None:
+            if not hasattr(self, "X"):
+                raise ValueError("Training data is required to fit the intervals.")
+            X, y = self.X, self.y
+        target = self.detrend(X, y)
+        self.best_gbm_low = make_gbm(self.best_params, quantile=0.01).fit(X, target)
+        self.best_gbm_high = make_gbm(self.best_params, quantile=0.99).fit(X, target)
+        return self
+
     def predict_low(self, X):
+        if self.best_gbm_low is None:
+            self.fit_intervals()
         if self.best_params["poly_degree"] > 0:
             y_pred = self.best_gbm_low.predict(
                 X
@@ -342,6 +630,8 @@ class MutliGBMTunedDetrended(BaseEstimator, RegressorMixin):
         return y_pred
 
     def predict_high(self, X):
+        if self.best_gbm_high is None:
+            self.fit_intervals()
         if self.best_params["poly_degree"] > 0:
             y_pred = self.best_gbm_high.predict(
                 X
@@ -356,6 +646,9 @@ def auto_ml(
     data: pd.DataFrame,
     n_splits=5,
     timeout=300,
+    warm_start_trials: Optional[list[dict]] = None,
+    n_jobs: Optional[int] = None,
+    n_trials: int = 1000,
 ) -> Tuple[
     MutliGBMTunedDetrended,
     int,
@@ -367,6 +660,15 @@ def auto_ml(
     ----------
     x: np.ndarray
         time series
+    warm_start_trials: Optional[list[dict]]
+        best trials of the previous search, evaluated first
+    n_jobs: Optional[int]
+        number of trials run concurrently, at most the number of available CPUs.
+        By default, `ML_TRIAL_JOBS` for series of at least `ML_TRIAL_JOBS_MIN_LENGTH`
+        points and 1 for shorter ones. Only the LightGBM models of concurrent
+        trials are fitted in parallel, the other ones are fitted one at a time.
+    n_trials: int
+        maximum number of trials of the search
 
     Returns
     -------
@@ -378,8 +680,16 @@ def auto_ml(
 
     y = data.iloc[:, 0].to_numpy()
     X = data.iloc[:, 1:].to_numpy()
-
-    gbm_det = MutliGBMTunedDetrended(n_trials=1000, timeout=timeout, n_splits=n_splits)
+    if n_jobs is None:
+        n_jobs = ML_TRIAL_JOBS if len(data) >= ML_TRIAL_JOBS_MIN_LENGTH else 1
+
+    gbm_det = MutliGBMTunedDetrended(
+        n_trials=n_trials,
+        timeout=timeout,
+        n_splits=n_splits,
+        warm_start_trials=warm_start_trials,
+        n_jobs=n_jobs,
+    )
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -0,0 +1,225 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import json
+import os
+import pickle
+import zipfile
+from dataclasses import dataclass
+from typing import Optional
+
+import lightgbm as lgb
+import pandas as pd
+from botocore.exceptions import ClientError
+from lightgbm import LGBMRegressor
+from loguru import logger
+from sklearn.preprocessing import MinMaxScaler  # type: ignore
+
+from predictive_capacity import (
+    ML_MODEL_STORE_DIR,
+    ML_RESULTS_BUCKET,
+    __version__,
+    s3,
+)
+from predictive_capacity.forecast.models import MutliGBMTunedDetrended
+
+# Version of the layout of the artifact, bumped on incompatible changes
+ARTIFACT_FORMAT = 1
+
+# Gradient boosting models of MutliGBMTunedDetrended
+GBM_NAMES = ("best_gbm", "best_gbm_low", "best_gbm_high")
+
+
+@dataclass
+class ModelArtifact:
+    """Fitted model of a metric with everything needed to forecast again."""
+
+    model: MutliGBMTunedDetrended
+    features: list[str]
+    time_scaler: MinMaxScaler
+    maximum_allowed: float
+    best_value: float
+    trained_until: pd.Timestamp
+    trained_at: pd.Timestamp
+    training_time: Optional[float] = None
+    version: str = __version__
+
+
+def is_compatible(version: str) -> bool:
+    """Whether a model saved by `version` can be used by the running version."""
+    return version.split(".")[:2] == __version__.split(".")[:2]
+
+
+def dump_artifact(artifact: ModelArtifact) -> bytes:
+    """
+    Serialize a model artifact into a compressed zip archive.
+
+    The archive contains:
+    - `manifest.json`: versions, hyperparameters, damped factor, confidence level,
+      features and metadata of the training;
+    - `<gbm>.txt`: LightGBM models in their native text format;
+    - `sklearn.pkl`: the other scikit-learn estimators (gradient boosting models,
+      trend pipeline and time scaler).
+
+    The training data and the hyperparameter study are not saved.
+    """
+    model = artifact.model
+    manifest = {
+        "format": ARTIFACT_FORMAT,
+        "version": artifact.version,
+        "best_params": model.best_params,
+        "damped": getattr(model, "damped", None),
+        "confidence_level": model.confidence_level,
+        "features": artifact.features,
+        "maximum_allowed": artifact.maximum_allowed,
+        "best_value": artifact.best_value,
+        "trained_until": artifact.trained_until.isoformat(),
+        "trained_at": artifact.trained_at.isoformat(),
+        "training_time": artifact.training_time,
+        "lightgbm": [],
+    }
+    estimators = {"time_scaler": artifact.time_scaler}
+    if hasattr(model, "trend_forecaster"):
+        estimators["trend_forecaster"] = model.trend_forecaster
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name in GBM_NAMES:
+            gbm = getattr(model, name, None)
+            if gbm is None:
+                continue
+            if isinstance(gbm, (LGBMRegressor, lgb.Booster)):
+                booster = gbm.booster_ if isinstance(gbm, LGBMRegressor) else gbm
+                archive.writestr(f"{name}.txt", booster.model_to_string())
+                manifest["lightgbm"].append(name)
+            else:
+                estimators[name] = gbm
+        archive.writestr("sklearn.pkl", pickle.dumps(estimators))
+        archive.writestr("manifest.json", json.dumps(manifest))
+    return buffer.getvalue()
+
+
+def parse_artifact(body: bytes) -> ModelArtifact:
+    """
+    Deserialize a model artifact created by `dump_artifact`.
+
+    Raises
+    ------
+    ValueError
+        If the artifact was saved with an incompatible format or version.
+    """
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        manifest = json.loads(archive.read("manifest.json"))
+        if manifest["format"] != ARTIFACT_FORMAT:
+            raise ValueError(f"Unsupported artifact format {manifest['format']}.")
+        if not is_compatible(manifest["version"]):
+            raise ValueError(
+                f"Artifact saved by version {manifest['version']} is not "
+                f"compatible with version {__version__}."
+            )
+        estimators = pickle.loads(archive.read("sklearn.pkl"))
+        model = MutliGBMTunedDetrended()
+        model.best_params = manifest["best_params"]
+        model.confidence_level = manifest["confidence_level"]
+        if manifest["damped"] is not None:
+            model.damped = manifest["damped"]
+        if "trend_forecaster" in estimators:
+            model.trend_forecaster = estimators["trend_forecaster"]
+        for name in GBM_NAMES:
+            if name in manifest["lightgbm"]:
+                model_str = archive.read(f"{name}.txt").decode()
+                setattr(model, name, lgb.Booster(model_str=model_str))
+            elif name in estimators:
+                setattr(model, name, estimators[name])
+
+    return ModelArtifact(
+        model=model,
+        features=manifest["features"],
+        time_scaler=estimators["time_scaler"],
+        maximum_allowed=manifest["maximum_allowed"],
+        best_value=manifest["best_value"],
+        trained_until=pd.Timestamp(manifest["trained_until"]),
+        trained_at=pd.Timestamp(manifest["trained_at"]),
+        training_time=manifest.get("training_time"),
+        version=manifest["version"],
+    )
+
+
+def model_key(uuid: str) -> str:
+    return f"models/{uuid}.zip"
+
+
+def save_model(
+    uuid: str,
+    artifact: ModelArtifact,
+    bucket_name: str = ML_RESULTS_BUCKET,
+    directory: str = ML_MODEL_STORE_DIR,
+) -> None:
+    """
+    Save the fitted model of a metric.
+
+    Parameters
+    ----------
+    uuid: str
+        uuid of the metric.
+    artifact: ModelArtifact
+        Model to save.
+    bucket_name: str
+        Bucket where the models are stored.
+    directory: str
+        If not empty, the models are stored in this local directory instead of S3.
+    """
+    body = dump_artifact(artifact)
+    if directory:
+        path = os.path.join(directory, model_key(uuid))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(body)
+    else:
+        s3.meta.client.put_object(Bucket=bucket_name, Key=model_key(uuid), Body=body)
+    logger.debug(f"Saved model of {uuid} ({len(body)} bytes).")
+
+
+def load_model(
+    uuid: str,
+    bucket_name: str = ML_RESULTS_BUCKET,
+    directory: str = ML_MODEL_STORE_DIR,
+) -> Optional[ModelArtifact]:
+    """
+    Load the fitted model of a metric.
+
+    Returns None if the metric has no model or if it was saved by an incompatible
+    version of predictive capacity.
+    """
+    if directory:
+        try:
+            with open(os.path.join(directory, model_key(uuid)), "rb") as f:
+                body = f.read()
+        except FileNotFoundError:
+            return None
+    else:
+        try:
+            obj = s3.meta.client.get_object(Bucket=bucket_name, Key=model_key(uuid))
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+        body = obj["Body"].read()
+    try:
+        return parse_artifact(body)
+    except ValueError as e:
+        logger.info(f"Ignoring model of {uuid}: {e}")
+        return None
@@ -0,0 +1,274 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import math
+import statistics
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+from loguru import logger
+
+from predictive_capacity import (
+    HORIZON_PREDICTION_HOURS,
+    ML_TRAINING_MIN_TIMEOUT,
+    ML_TRAINING_TIMEOUT,
+    ML_TRAINING_WORKERS,
+)
+
+# Share of the budget given to a metric relative to a confident one, by confidence
+# level of its last forecast. Metrics never forecast are treated as the least
+# confident ones.
+CONFIDENCE_WEIGHTS = {0: 2.0, 1: 1.5, 2: 1.0}
+
+# Days to full at which the urgency of a metric is 0.5
+URGENCY_DAYS = 30
+# Age in days from which a forecast is as stale as it gets
+STALE_AFTER_DAYS = 7
+
+
+@dataclass
+class TrainingHistory:
+    """What is known about the last training of a metric."""
+
+    history_length: Optional[int] = None
+    confidence_level: Optional[int] = None
+    training_time: Optional[float] = None
+    # Absolute change of saturation forecast over the next 3 months
+    growth: float = 0.0
+    # Whether the metric was already forecast
+    forecast: bool = False
+    days_to_full: Optional[int] = None
+    current_saturation: Optional[float] = None
+    # Time of the last forecast in seconds since the epoch
+    forecast_at: Optional[float] = None
+
+    @classmethod
+    def from_metadata(cls, item: Optional[dict]) -> TrainingHistory:
+        """Build the history from the dynamodb item of the metric, if any."""
+        if item is None:
+            return cls()
+        growth = 0.0
+        saturation = item.get("saturation_3_months") or {}
+        if saturation.get("forecast") is not None:
+            current = saturation.get("current_saturation") or 0
+            growth = abs(float(saturation["forecast"]) - float(current))
+        return cls(
+            history_length=(
+                int(item["history_length"]) if "history_length" in item else None
+            ),
+            confidence_level=(
+                int(item["confidence_level"]) if "confidence_level" in item else None
+            ),
+            training_time=(
+                float(item["training_time"]) if "training_time" in item else None
+            ),
+            growth=growth if math.isfinite(growth) else 0.0,
+            forecast=True,
+            days_to_full=(
+                int(item["days_to_full"])
+                if item.get("days_to_full") is not None
+                else None
+            ),
+            current_saturation=(
+                float(item["current_saturation"])
+                if item.get("current_saturation") is not None
+                else None
+            ),
+            forecast_at=(float(item["forecast_at"]) if "forecast_at" in item else None),
+        )
+
+
+def training_priority(history: TrainingHistory, now: float) -> float:
+    """
+    Priority of a metric in a run, the highest are trained first.
+
+    Metrics never forecast come first. The others are ranked by the sum of their
+    urgency, from 0 to 1 as they get closer to saturation, and of the staleness of
+    their forecast, from 0 to 1 as it gets `STALE_AFTER_DAYS` old.
+
+    Parameters
+    ----------
+    history: TrainingHistory
+        Last training of the metric.
+    now: float
+        Current time in seconds since the epoch.
+    """
+    if not history.forecast:
+        return math.inf
+    if history.days_to_full is not None:
+        urgency = 1 / (1 + max(history.days_to_full, 0) / URGENCY_DAYS)
+    else:
+        # Not full within the horizon: below the others, ranked by saturation
+        saturation = min(max(history.current_saturation or 0.0, 0.0), 1.0)
+        horizon_days = HORIZON_PREDICTION_HOURS / 24
+        urgency = saturation / (1 + horizon_days / URGENCY_DAYS)
+    if history.forecast_at is None:
+        staleness = 1.0
+    else:
+        age = (now - history.forecast_at) / 86400
+        staleness = min(max(age, 0.0) / STALE_AFTER_DAYS, 1.0)
+    return urgency + staleness
+
+
+def priority_order(histories: List[TrainingHistory]) -> List[int]:
+    """Indices of the metrics in the order they should be trained."""
+    now = time.time()
+    priorities = [training_priority(history, now) for history in histories]
+    # Stable: metrics of equal priority keep their order
+    return sorted(range(len(histories)), key=lambda i: -priorities[i])
+
+
+def training_weight(history: TrainingHistory, reference_length: float) -> float:
+    """
+    Relative share of the budget of a metric.
+
+    Long series are more expensive to train, low-confidence and fast-changing
+    series benefit the most from a longer search.
+
+    Parameters
+    ----------
+    history: TrainingHistory
+        Last training of the metric.
+    reference_length: float
+        Typical history length of the metrics of the run.
+    """
+    size = 1.0
+    if history.history_length and reference_length > 0:
+        size = min(4.0, max(0.25, math.sqrt(history.history_length / reference_length)))
+    need = CONFIDENCE_WEIGHTS.get(history.confidence_level, 2.0)  # type: ignore
+    return size * need * (1 + min(history.growth, 1.0))
+
+
+def allocate_budget(
+    weights: List[float],
+    capacity: float,
+    max_timeouts: List[float],
+    min_timeout: float = ML_TRAINING_MIN_TIMEOUT,
+) -> List[float]:
+    """
+    Split `capacity` seconds of training proportionally to `weights`.
+
+    Metrics whose share exceeds their maximum timeout are capped and the surplus is
+    shared among the others. Every metric gets at least `min_timeout`, even if the
+    capacity is then exceeded.
+
+    Parameters
+    ----------
+    weights: List[float]
+        Relative share of each metric.
+    capacity: float
+        Seconds of training to split.
+    max_timeouts: List[float]
+        Longest timeout of each metric.
+    min_timeout: float
+        Shortest timeout of a metric.
+
+    Returns
+    -------
+    List[float]
+        Timeout of each metric in seconds.
+    """
+    timeouts = [0.0] * len(weights)
+    free = set(range(len(weights)))
+    remaining = capacity
+    while free:
+        total = sum(weights[i] for i in free)
+        shares = {i: remaining * weights[i] / total for i in free}
+        capped = [i for i in free if shares[i] >= max_timeouts[i]]
+        if not capped:
+            for i in free:
+                timeouts[i] = shares[i]
+            break
+        for i in capped:
+            timeouts[i] = max_timeouts[i]
+            remaining -= max_timeouts[i]
+            free.remove(i)
+    return [max(min_timeout, min(t, m)) for t, m in zip(timeouts, max_timeouts)]
+
+
+class TrainingScheduler:
+    """
+    Share a wall-clock budget between the metrics of a run.
+
+    The budget is planned upfront with `allocate_budget`. As metrics are trained,
+    the planned timeouts of the remaining metrics are rescaled to the time actually
+    left, so that time lost on fetching, uploading or failing metrics is recovered
+    and time saved by early stopped searches is reused.
+
+    Parameters
+    ----------
+    histories: List[TrainingHistory]
+        Last training of each metric, in the order they are trained.
+    budget: float
+        Wall-clock budget of the run in seconds.
+    n_workers: int
+        Number of metrics trained in parallel.
+    max_timeout: float
+        Longest timeout of a metric.
+    min_timeout: float
+        Shortest timeout of a metric.
+    """
+
+    def __init__(
+        self,
+        histories: List[TrainingHistory],
+        budget: float,
+        n_workers: int = ML_TRAINING_WORKERS,
+        max_timeout: float = ML_TRAINING_TIMEOUT,
+        min_timeout: float = ML_TRAINING_MIN_TIMEOUT,
+    ):
+        self.n_workers = max(1, n_workers)
+        self.min_timeout = min_timeout
+        self.deadline = time.monotonic() + budget
+
+        lengths = [h.history_length for h in histories if h.history_length]
+        reference_length = statistics.median(lengths) if lengths else 0
+        weights = [training_weight(h, reference_length) for h in histories]
+        # A search that previously converged before its timeout does not need
+        # much more time
+        self.max_timeouts = [
+            (
+                min(max_timeout, max(min_timeout, 2 * h.training_time))
+                if h.training_time is not None
+                else max_timeout
+            )
+            for h in histories
+        ]
+        self.planned = allocate_budget(
+            weights, budget * self.n_workers, self.max_timeouts, min_timeout
+        )
+        self._planned_left = sum(self.planned)
+        if self._planned_left > budget * self.n_workers:
+            logger.warning(
+                f"Budget of {budget}s is too short to train {len(histories)} "
+                f"metrics for at least {min_timeout}s each."
+            )
+
+    def timeout(self, index: int) -> int:
+        """
+        Timeout of the `index`-th metric, to be called when it starts training.
+
+        Metrics must be started in order.
+        """
+        planned = self.planned[index]
+        capacity = max(0.0, self.deadline - time.monotonic()) * self.n_workers
+        ratio = capacity / self._planned_left if self._planned_left > 0 else 0.0
+        self._planned_left -= planned
+        timeout = max(self.min_timeout, min(planned * ratio, self.max_timeouts[index]))
+        logger.debug(f"Training timeout of metric {index}: {timeout:.0f}s")
+        return math.ceil(timeout)
@@ -0,0 +1,97 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+import optuna
+from botocore.exceptions import ClientError
+from loguru import logger
+
+from predictive_capacity import ML_RESULTS_BUCKET, ML_WARM_START_TOP_K, __version__, s3
+from predictive_capacity.forecast.registry import is_compatible
+
+
+def trials_key(uuid: str) -> str:
+    return f"trials/{uuid}.json"
+
+
+def load_trials(uuid: str, bucket_name: str = ML_RESULTS_BUCKET) -> list[dict]:
+    """
+    Load the best trials of the previous hyperparameter search of a metric.
+
+    Parameters
+    ----------
+    uuid: str
+        uuid of the metric.
+    bucket_name: str
+        Bucket where the trials are stored.
+
+    Returns
+    -------
+    list[dict]
+        Trials with their `params` and `value`, best first. Empty if the metric has
+        never been trained or if the trials were saved by an incompatible version
+        of predictive capacity, whose search space may differ.
+    """
+    try:
+        obj = s3.meta.client.get_object(Bucket=bucket_name, Key=trials_key(uuid))
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return []
+        raise
+    body = json.loads(obj["Body"].read())
+    if not is_compatible(body.get("version", "")):
+        logger.info(
+            f"Ignoring trials of {uuid} saved by version {body.get('version')}, "
+            f"not compatible with version {__version__}."
+        )
+        return []
+    trials = body["trials"]
+    logger.debug(f"Loaded {len(trials)} trials to warm start {uuid}.")
+    return trials
+
+
+def save_trials(
+    uuid: str,
+    study: optuna.Study,
+    top_k: int = ML_WARM_START_TOP_K,
+    bucket_name: str = ML_RESULTS_BUCKET,
+) -> None:
+    """
+    Save the `top_k` best trials of a hyperparameter search next to the prediction.
+
+    Parameters
+    ----------
+    uuid: str
+        uuid of the metric.
+    study: optuna.Study
+        Study of the hyperparameter search.
+    top_k: int
+        Number of trials to keep.
+    bucket_name: str
+        Bucket where the trials are stored.
+    """
+    completed = study.get_trials(
+        deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)
+    )
+    best = sorted(completed, key=lambda trial: trial.value)[:top_k]  # type: ignore
+    body = json.dumps(
+        {
+            "version": __version__,
+            "trials": [{"params": t.params, "value": t.value} for t in best],
+        }
+    )
+    s3.meta.client.put_object(Bucket=bucket_name, Key=trials_key(uuid), Body=body)
+    logger.debug(f"Saved {len(best)} trials of {uuid}.")
@@ -0,0 +1,174 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextvars
+import json
+import resource
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from loguru import logger
+
+from predictive_capacity import ML_SPANS_FILE
+
+# Spans of the metric being forecast and the attributes shared by all of them
+_spans: contextvars.ContextVar[Optional[tuple[list[dict], dict]]] = (
+    contextvars.ContextVar("spans", default=None)
+)
+
+
+def max_rss_mb() -> float:
+    """Peak resident set size of the current process so far, in MB."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+def emit(record: dict) -> None:
+    """Log a record and append it as a JSON line to `ML_SPANS_FILE`, if set."""
+    line = json.dumps(record, default=str)
+    logger.trace(line)
+    if ML_SPANS_FILE:
+        with open(ML_SPANS_FILE, "a") as f:
+            f.write(line + "\n")
+
+
+@contextmanager
+def collect_spans(
+    spans: Optional[list[dict]] = None, **attributes
+) -> Iterator[list[dict]]:
+    """
+    Collect the spans recorded in this context, e.g. those of a metric.
+
+    Parameters
+    ----------
+    spans: Optional[list[dict]]
+        List where the records are appended. A new list if None.
+    **attributes
+        Attributes added to every span, e.g. the name of the metric.
+
+    Yields
+    ------
+    list[dict]
+        Records of the spans, filled as they end.
+    """
+    if spans is None:
+        spans = []
+    token = _spans.set((spans, attributes))
+    try:
+        yield spans
+    finally:
+        _spans.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[dict]:
+    """
+    Measure a stage of the forecasts.
+
+    The record of the span follows the shape of OpenTelemetry spans: a name, start
+    and end times in nanoseconds since the epoch and attributes, with the wall time
+    and the CPU time of the process in seconds and its peak RSS so far in MB.
+
+    Parameters
+    ----------
+    name: str
+        Name of the stage.
+    **attributes
+        Attributes of the span.
+
+    Yields
+    ------
+    dict
+        Attributes of the span, that can be completed until it ends.
+    """
+    start_ns = time.time_ns()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        context = _spans.get()
+        record = {
+            "name": name,
+            "start_time_unix_nano": start_ns,
+            "end_time_unix_nano": time.time_ns(),
+            "attributes": {
+                **(context[1] if context is not None else {}),
+                **attributes,
+                "wall_s": time.perf_counter() - wall,
+                "cpu_s": time.process_time() - cpu,
+                "max_rss_mb": max_rss_mb(),
+            },
+        }
+        if context is not None:
+            context[0].append(record)
+        emit(record)
+
+
+def summarize_spans(spans: list[dict]) -> list[dict]:
+    """
+    Aggregate spans by stage.
+
+    Parameters
+    ----------
+    spans: list[dict]
+        Records of the spans.
+
+    Returns
+    -------
+    list[dict]
+        One summary per stage, the longest first: number of spans, total, mean and
+        maximum wall time, total CPU time, peak RSS and share of the total wall time.
+    """
+    stages: dict[str, list[dict]] = {}
+    for record in spans:
+        stages.setdefault(record["name"], []).append(record["attributes"])
+    total = sum(a["wall_s"] for attributes in stages.values() for a in attributes)
+    summary = [
+        {
+            "stage": name,
+            "count": len(attributes),
+            "wall_s": sum(a["wall_s"] for a in attributes),
+            "mean_wall_s": statistics.mean(a["wall_s"] for a in attributes),
+            "max_wall_s": max(a["wall_s"] for a in attributes),
+            "cpu_s": sum(a["cpu_s"] for a in attributes),
+            "max_rss_mb": max(a["max_rss_mb"] for a in attributes),
+            "share": sum(a["wall_s"] for a in attributes) / total if total else 0.0,
+        }
+        for name, attributes in stages.items()
+    ]
+    return sorted(summary, key=lambda stage: stage["wall_s"], reverse=True)
+
+
+def log_summary(spans: list[dict]) -> list[dict]:
+    """Log the summary of the spans of a run as a table and as a record."""
+    summary = summarize_spans(spans)
+    if not summary:
+        return summary
+    lines = [f"{'stage':<24}{'count':>7}{'wall (s)':>11}{'cpu (s)':>11}{'share':>8}"]
+    for stage in summary:
+        lines.append(
+            f"{stage['stage']:<24}{stage['count']:>7}{stage['wall_s']:>11.2f}"
+            f"{stage['cpu_s']:>11.2f}{stage['share']:>8.1%}"
+        )
+    logger.info("Time spent per stage:\n" + "\n".join(lines))
+    emit({"name": "summary", "time_unix_nano": time.time_ns(), "stages": summary})
+    return summary
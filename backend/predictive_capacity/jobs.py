@@ -0,0 +1,416 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Literal, Optional
+from uuid import uuid4
+
+from loguru import logger
+
+from predictive_capacity import (
+    HORIZON_PREDICTION_HOURS,
+    ML_JOBS_DB,
+    ML_JOBS_STALE_SECONDS,
+    ML_RUN_MAX_ATTEMPTS,
+    ML_RUN_RETRY_BACKOFF_SECONDS,
+)
+from predictive_capacity.schemas import Job, ResponseFindSetMetrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    organization TEXT NOT NULL,
+    status TEXT NOT NULL,
+    forecasting_horizon INTEGER NOT NULL,
+    retrain INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat_at REAL,
+    worker TEXT,
+    total INTEGER,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    -- Failed job whose forecasts already uploaded are not made again
+    resumes TEXT
+);
+-- At most one run per organization is queued or running
+CREATE UNIQUE INDEX IF NOT EXISTS active_job_of_organization
+    ON jobs (organization) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_by_organization ON jobs (organization, started_at);
+-- State of every metric of a job
+CREATE TABLE IF NOT EXISTS ledger (
+    job_id TEXT NOT NULL,
+    metric_key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, metric_key)
+);
+"""
+
+JOB_COLUMNS = (
+    "job_id, organization, status, forecasting_horizon, retrain, created_at, "
+    "started_at, finished_at, total, done, failed, error, resumes"
+)
+
+# Databases whose schema was created by the current process
+_initialized: set[str] = set()
+
+
+@contextmanager
+def connect(path: str, immediate: bool = False) -> Iterator[sqlite3.Connection]:
+    """
+    Open a connection to the jobs database in a transaction, committed when the
+    block exits.
+
+    With `immediate`, the database is locked for writing at the start of the
+    transaction, so that reads and writes of the block are atomic across processes.
+    """
+    if path not in _initialized:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    try:
+        if path not in _initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            _initialized.add(path)
+        connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+
+def _to_job(row: sqlite3.Row) -> Job:
+    return Job(**{key: row[key] for key in row.keys()})
+
+
+class JobQueue:
+    """
+    Durable queue of forecast runs stored in a SQLite database.
+
+    The API enqueues the runs and the workers (see `predictive_capacity.worker`)
+    claim and execute them. The database can be shared by several processes on the
+    same host.
+
+    Parameters
+    ----------
+    path: str
+        Path of the SQLite database, created if needed.
+    stale_after: float
+        Seconds without heartbeat after which a running job is considered dead.
+    """
+
+    def __init__(
+        self, path: str = ML_JOBS_DB, stale_after: float = ML_JOBS_STALE_SECONDS
+    ):
+        self.path = path
+        self.stale_after = stale_after
+
+    def connect(self, immediate: bool = False):
+        return connect(self.path, immediate)
+
+    def enqueue(
+        self,
+        organization: str,
+        forecasting_horizon: int = HORIZON_PREDICTION_HOURS,
+        retrain: bool = True,
+    ) -> tuple[Job, bool]:
+        """
+        Queue a forecast run of an organization.
+
+        When the last run of the organization failed, the new run resumes it: the
+        metrics it already uploaded are skipped (see `RunLedger`).
+
+        Returns
+        -------
+        tuple[Job, bool]
+            The job and whether it was created. When the organization already has a
+            queued or running job, that job is returned instead of a duplicate.
+        """
+        with self.connect(immediate=True) as connection:
+            row = connection.execute(
+                f"SELECT {JOB_COLUMNS} FROM jobs "
+                "WHERE organization = ? AND status IN ('queued', 'running')",
+                (organization,),
+            ).fetchone()
+            if row is not None:
+                return _to_job(row), False
+            last = connection.execute(
+                "SELECT job_id, status, resumes FROM jobs WHERE organization = ? "
+                "ORDER BY created_at DESC LIMIT 1",
+                (organization,),
+            ).fetchone()
+            resumes = None
+            if last is not None and last["status"] == "failed":
+                resumes = last["job_id"]
+            job_id = str(uuid4())
+            connection.execute(
+                "INSERT INTO jobs (job_id, organization, status, forecasting_horizon, "
+                "retrain, created_at, resumes) VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                (
+                    job_id,
+                    organization,
+                    forecasting_horizon,
+                    retrain,
+                    time.time(),
+                    resumes,
+                ),
+            )
+            row = connection.execute(
+                f"SELECT {JOB_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        logger.info(f"Queued forecast job {job_id} of {organization}.")
+        return _to_job(row), True
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.connect() as connection:
+            row = connection.execute(
+                f"SELECT {JOB_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return None if row is None else _to_job(row)
+
+    def count_by_status(self) -> dict[str, int]:
+        """Number of jobs of each status."""
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT status, COUNT(*) AS count FROM jobs GROUP BY status"
+            ).fetchall()
+        return {row["status"]: row["count"] for row in rows}
+
+    def results_version(self, organization: str) -> Optional[tuple]:
+        """
+        Version of the forecasts of an organization, which changes whenever one of
+        its runs uploads forecasts or ends. None if it was never run.
+        """
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT job_id, status, done, failed FROM jobs "
+                "WHERE organization = ? AND started_at IS NOT NULL "
+                "ORDER BY started_at DESC LIMIT 1",
+                (organization,),
+            ).fetchone()
+        return None if row is None else tuple(row)
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """
+        Start the oldest queued job, if any.
+
+        Running jobs whose worker stopped sending heartbeats are queued again
+        beforehand, so that a run killed with its worker is not lost.
+        """
+        now = time.time()
+        with self.connect(immediate=True) as connection:
+            stale = connection.execute(
+                "SELECT job_id FROM jobs WHERE status = 'running' AND heartbeat_at < ?",
+                (now - self.stale_after,),
+            ).fetchall()
+            for row in stale:
+                connection.execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL WHERE job_id = ?",
+                    (row["job_id"],),
+                )
+                logger.warning(f"Requeued job {row['job_id']} of a dead worker.")
+            row = connection.execute(
+                "SELECT job_id FROM jobs WHERE status = 'queued' "
+                "ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, "
+                "heartbeat_at = ?, total = NULL, done = 0, failed = 0 "
+                "WHERE job_id = ?",
+                (worker, now, now, row["job_id"]),
+            )
+            row = connection.execute(
+                f"SELECT {JOB_COLUMNS} FROM jobs WHERE job_id = ?", (row["job_id"],)
+            ).fetchone()
+        return _to_job(row)
+
+    def heartbeat(self, job_id: str) -> None:
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE job_id = ?",
+                (time.time(), job_id),
+            )
+
+    def update_progress(
+        self, job_id: str, done: int, failed: int, total: Optional[int] = None
+    ) -> None:
+        """Record the number of metrics forecast, and failed, by a running job."""
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET done = ?, failed = ?, total = COALESCE(?, total), "
+                "heartbeat_at = ? WHERE job_id = ?",
+                (done, failed, total, time.time(), job_id),
+            )
+
+    def finish(self, job_id: str, error: Optional[str] = None) -> None:
+        """Mark a job as succeeded, or failed with `error`."""
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? "
+                "WHERE job_id = ?",
+                ("failed" if error else "succeeded", error, time.time(), job_id),
+            )
+
+
+MetricState = Literal["pending", "fetched", "trained", "uploaded", "failed"]
+
+
+def metric_key(item: ResponseFindSetMetrics) -> str:
+    return f"{item.platform_uuid}#{item.host_id}#{item.service_id}#{item.metric}"
+
+
+@dataclass
+class RunLedger:
+    """
+    State of every metric of a forecast run, stored next to its job.
+
+    Metrics go through the states pending, fetched, trained and uploaded, or
+    failed with the reason. When a job is interrupted, e.g. by a restart of its
+    worker, and runs again, uploaded metrics are skipped. Failed metrics are
+    retried with an exponential backoff, up to `max_attempts` attempts.
+
+    The ledger only holds the path of the database, so that it can be sent to the
+    training worker processes. Updates are best effort: an error of the database
+    is logged and does not fail the forecast.
+
+    Parameters
+    ----------
+    path: str
+        Path of the SQLite database of the jobs.
+    job_id: str
+        Job of the run.
+    resumes: Optional[str]
+        Previous job of the run whose uploaded metrics are skipped.
+    max_attempts: int
+        Attempts of a metric before it is given up.
+    backoff: float
+        Seconds before the first retry of a failed metric, doubled after every
+        attempt.
+    """
+
+    path: str
+    job_id: str
+    resumes: Optional[str] = None
+    max_attempts: int = ML_RUN_MAX_ATTEMPTS
+    backoff: float = ML_RUN_RETRY_BACKOFF_SECONDS
+
+    def start(self, unique_labels: list[ResponseFindSetMetrics]) -> None:
+        """Register the metrics of the run, keeping the state of known ones."""
+        now = time.time()
+        with connect(self.path, immediate=True) as connection:
+            if self.resumes is not None:
+                connection.execute(
+                    "INSERT OR IGNORE INTO ledger (job_id, metric_key, state, "
+                    "updated_at) SELECT ?, metric_key, state, ? FROM ledger "
+                    "WHERE job_id = ? AND state = 'uploaded'",
+                    (self.job_id, now, self.resumes),
+                )
+            connection.executemany(
+                "INSERT OR IGNORE INTO ledger (job_id, metric_key, state, updated_at) "
+                "VALUES (?, ?, 'pending', ?)",
+                [(self.job_id, metric_key(item), now) for item in unique_labels],
+            )
+
+    def record(
+        self,
+        item: ResponseFindSetMetrics,
+        state: MetricState,
+        error: Optional[str] = None,
+    ) -> None:
+        """Record the new state of a metric."""
+        now = time.time()
+        try:
+            with connect(self.path) as connection:
+                if state == "failed":
+                    connection.execute(
+                        "UPDATE ledger SET state = 'failed', error = ?, "
+                        "attempts = attempts + 1, updated_at = ?, "
+                        "next_attempt_at = ? * (1 << attempts) + ? "
+                        "WHERE job_id = ? AND metric_key = ?",
+                        (error, now, self.backoff, now, self.job_id, metric_key(item)),
+                    )
+                else:
+                    connection.execute(
+                        "UPDATE ledger SET state = ?, updated_at = ? "
+                        "WHERE job_id = ? AND metric_key = ?",
+                        (state, now, self.job_id, metric_key(item)),
+                    )
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to record the state of {metric_key(item)}: {e}")
+
+    def states(self) -> dict[str, sqlite3.Row]:
+        with connect(self.path) as connection:
+            rows = connection.execute(
+                "SELECT * FROM ledger WHERE job_id = ?", (self.job_id,)
+            ).fetchall()
+        return {row["metric_key"]: row for row in rows}
+
+    def due(
+        self, unique_labels: list[ResponseFindSetMetrics]
+    ) -> tuple[list[ResponseFindSetMetrics], Optional[float]]:
+        """
+        Metrics to forecast now.
+
+        Returns
+        -------
+        tuple[list[ResponseFindSetMetrics], Optional[float]]
+            Metrics not uploaded yet whose next attempt is due, and the number of
+            seconds until the next attempt of the others, None if there is none.
+        """
+        now = time.time()
+        states = self.states()
+        due, wait = [], None
+        for item in unique_labels:
+            row = states.get(metric_key(item))
+            if row is None or row["state"] not in ("uploaded", "failed"):
+                due.append(item)
+            elif row["state"] == "failed" and row["attempts"] < self.max_attempts:
+                delay = row["next_attempt_at"] - now
+                if delay <= 0:
+                    due.append(item)
+                else:
+                    wait = delay if wait is None else min(wait, delay)
+        return due, wait
+
+    def progress(self) -> tuple[int, int]:
+        """Number of metrics uploaded or failed, and number of failed metrics."""
+        with connect(self.path) as connection:
+            row = connection.execute(
+                "SELECT COALESCE(SUM(state IN ('uploaded', 'failed')), 0) AS done, "
+                "COALESCE(SUM(state = 'failed'), 0) AS failed "
+                "FROM ledger WHERE job_id = ?",
+                (self.job_id,),
+            ).fetchone()
+        return row["done"], row["failed"]
@@ -0,0 +1,417 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Iterator, Optional
+
+from predictive_capacity.schemas import ForecastOutcome
+
+# Latency buckets in seconds, from fast API calls to long trainings
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+    600.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    labels = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return f"{{{labels}}}" if labels else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Registry:
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> None:
+        if any(m.name == metric.name for m in self.metrics):
+            raise ValueError(f"Metric {metric.name} is already registered.")
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        """Render all the metrics in the Prometheus text format 0.0.4."""
+        return "".join(metric.render() for metric in self.metrics)
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    """
+    Base class of the metrics, with a value per combination of labels.
+
+    Parameters
+    ----------
+    name: str
+        Name of the metric.
+    documentation: str
+        Help text of the metric.
+    labelnames: tuple[str, ...]
+        Names of the labels, whose values are given as keyword arguments.
+    registry: Optional[Registry]
+        Registry of the metric, None to not register it.
+    """
+
+    type: str
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: Optional[Registry] = REGISTRY,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: dict[str, object]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Expected labels {self.labelnames} for {self.name}, "
+                f"got {tuple(labels)}."
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        """Yield the suffix, label names, label values and value of each sample."""
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield "", self.labelnames, key, value  # type: ignore
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(names, values)} "
+                f"{_format_value(value)}"
+            )
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """Value that only goes up, e.g. a number of requests."""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only be incremented.")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount  # type: ignore
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)  # type: ignore
+
+
+class Gauge(Metric):
+    """Value that goes up and down, e.g. a number of pending forecasts."""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount  # type: ignore
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)  # type: ignore
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in cumulative buckets, e.g. latencies.
+
+    Parameters
+    ----------
+    buckets: tuple[float, ...]
+        Upper bounds of the buckets, in increasing order. The `+Inf` bucket is added.
+    """
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(  # type: ignore
+                key, ([0] * (len(self.buckets) + 1), 0.0)
+            )
+            # Copied so that samples can be rendered out of the lock
+            counts = list(counts)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the duration of the block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self._key(labels), ([0], 0.0))  # type: ignore
+        return sum(counts)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        names = self.labelnames + ("le",)
+        for key, (counts, total) in sorted(values.items()):  # type: ignore
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield "_bucket", names, key + (_format_value(bound),), cumulative
+            yield "_count", self.labelnames, key, cumulative
+            yield "_sum", self.labelnames, key, total
+
+
+# Forecasts
+FORECASTS = Counter(
+    "predictive_capacity_forecasts_total",
+    "Metrics forecast, by status.",
+    ("organization", "status"),
+)
+PENDING_FORECASTS = Gauge(
+    "predictive_capacity_pending_forecasts",
+    "Metrics waiting to be forecast in the running forecasts.",
+    ("organization",),
+)
+RUN_METRICS = Gauge(
+    "predictive_capacity_run_metrics",
+    "Metrics of the current or last run, by state (total, done or failed).",
+    ("organization", "state"),
+)
+RUN_START_TIME = Gauge(
+    "predictive_capacity_run_start_time_seconds",
+    "Start of the current or last run, in seconds since the epoch.",
+    ("organization",),
+)
+RUN_THROUGHPUT = Gauge(
+    "predictive_capacity_run_throughput_metrics_per_hour",
+    "Metrics forecast per hour during the current or last run.",
+    ("organization",),
+)
+STAGE_SECONDS = Histogram(
+    "predictive_capacity_stage_duration_seconds",
+    "Wall time of the stages of the forecasts, including Warp10 fetches.",
+    ("stage",),
+)
+STAGE_ERRORS = Counter(
+    "predictive_capacity_stage_errors_total",
+    "Stages of the forecasts that failed.",
+    ("stage",),
+)
+
+# Calls to AWS and HTTP requests served
+AWS_CALL_SECONDS = Histogram(
+    "predictive_capacity_aws_call_duration_seconds",
+    "Latency of the calls to S3 and DynamoDB.",
+    ("service", "operation"),
+)
+AWS_CALL_ERRORS = Counter(
+    "predictive_capacity_aws_call_errors_total",
+    "Calls to S3 and DynamoDB that failed.",
+    ("service", "operation"),
+)
+JOBS = Gauge(
+    "predictive_capacity_jobs",
+    "Forecast jobs in the queue, by status.",
+    ("status",),
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "predictive_capacity_http_request_duration_seconds",
+    "Latency of the requests served by the API.",
+    ("method", "route", "status"),
+)
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port: int) -> ThreadingHTTPServer:
+    """
+    Serve the metrics of the current process on `port` in a background thread.
+
+    Used by the processes that do not run the API, e.g. the forecast workers.
+    """
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def observe_spans(spans: Iterable[dict]) -> None:
+    """Observe the duration of spans recorded by `instrumentation.span`."""
+    for record in spans:
+        attributes = record["attributes"]
+        STAGE_SECONDS.observe(attributes["wall_s"], stage=record["name"])
+        if "error" in attributes:
+            STAGE_ERRORS.inc(stage=record["name"])
+
+
+class RunMonitor:
+    """
+    Progress of a run of forecasts of an organization.
+
+    Forecasts trained in worker processes are accounted for when their outcome, with
+    the spans of its stages, comes back to the process running `make_forecasts`.
+
+    Parameters
+    ----------
+    organization: str
+        Source of the metrics.
+    n_metrics: int
+        Number of metrics of the run.
+    """
+
+    def __init__(self, organization: str, n_metrics: int):
+        self.organization = organization
+        self.n_metrics = n_metrics
+        self.done = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        PENDING_FORECASTS.inc(n_metrics, organization=organization)
+        RUN_START_TIME.set(time.time(), organization=organization)
+        RUN_METRICS.set(n_metrics, organization=organization, state="total")
+        RUN_METRICS.set(0, organization=organization, state="done")
+        RUN_METRICS.set(0, organization=organization, state="failed")
+        RUN_THROUGHPUT.set(0, organization=organization)
+
+    def __enter__(self) -> RunMonitor:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        # Metrics never forecast, e.g. when the run crashed, are no longer pending
+        PENDING_FORECASTS.dec(
+            self.n_metrics - self.done, organization=self.organization
+        )
+
+    def record(self, outcome: ForecastOutcome) -> None:
+        """Account for a metric whose forecast is over."""
+        status = "failed" if outcome.error is not None else "succeeded"
+        self.done += 1
+        self.failed += outcome.error is not None
+        FORECASTS.inc(organization=self.organization, status=status)
+        PENDING_FORECASTS.dec(organization=self.organization)
+        RUN_METRICS.set(self.done, organization=self.organization, state="done")
+        RUN_METRICS.set(self.failed, organization=self.organization, state="failed")
+        elapsed = time.monotonic() - self.start
+        if elapsed > 0:
+            RUN_THROUGHPUT.set(
+                3600 * self.done / elapsed, organization=self.organization
+            )
+        observe_spans(outcome.spans)
+
+
+def instrument_client(client) -> None:
+    """Observe the latency and the errors of the calls made by a boto3 client."""
+    if getattr(client.meta, "_monitored", False):
+        return
+    events = client.meta.events
+
+    def before_call(model, context, **kwargs):
+        context["monitoring"] = (
+            model.service_model.service_name,
+            model.name,
+            time.perf_counter(),
+        )
+
+    def observe(context, failed: bool) -> None:
+        if "monitoring" not in context:
+            return
+        service, operation, start = context.pop("monitoring")
+        AWS_CALL_SECONDS.observe(
+            time.perf_counter() - start, service=service, operation=operation
+        )
+        if failed:
+            AWS_CALL_ERRORS.inc(service=service, operation=operation)
+
+    def after_call(http_response, context, **kwargs):
+        observe(context, failed=http_response.status_code >= 300)
+
+    def after_call_error(context, **kwargs):
+        observe(context, failed=True)
+
+    events.register("before-call", before_call)
+    events.register("after-call", after_call)
+    events.register("after-call-error", after_call_error)
+    client.meta._monitored = True
@@ -0,0 +1,465 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Generator, Literal, Optional
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+from predictive_capacity import ML_PREDICTIONS_CACHE_BYTES, ML_RESULTS_BUCKET, s3
+from predictive_capacity.schemas import Prediction
+
+# Media type of the compact format of predictions
+PREDICTION_MEDIA_TYPE = "application/vnd.predictive-capacity.prediction"
+MAGIC = b"PCP\x01"
+# Size of the chunks of the predictions streamed from S3
+CHUNK_SIZE = 64 * 1024
+
+VALUES = ("data_scaled", "forecast", "forecast_lower", "forecast_upper")
+# Dates of each series of values
+DATES = {
+    "data_scaled": "data_dates",
+    "forecast": "forecast_dates",
+    "forecast_lower": "forecast_dates",
+    "forecast_upper": "forecast_dates",
+}
+
+DownsamplingMethod = Literal["lttb", "minmax"]
+# Values as float32 and dates as seconds since the epoch, by field of `Prediction`
+PredictionArrays = dict[str, np.ndarray]
+
+
+def prediction_key(uuid: str) -> str:
+    return f"{uuid}.bin"
+
+
+def _parse_dates(dates: list[str]) -> np.ndarray:
+    return np.array(dates, dtype="datetime64[s]").astype(np.int64)
+
+
+def from_prediction(prediction: Prediction) -> PredictionArrays:
+    """Arrays of a prediction, the bounds only if it has prediction intervals."""
+    arrays = {
+        "data_scaled": np.asarray(prediction.data_scaled, dtype=np.float32),
+        "data_dates": _parse_dates(prediction.data_dates),
+        "forecast": np.asarray(prediction.forecast, dtype=np.float32),
+        "forecast_dates": _parse_dates(prediction.forecast_dates),
+    }
+    if prediction.forecast_lower is not None and prediction.forecast_upper is not None:
+        arrays["forecast_lower"] = np.asarray(prediction.forecast_lower, np.float32)
+        arrays["forecast_upper"] = np.asarray(prediction.forecast_upper, np.float32)
+    return arrays
+
+
+def shortest_floats(array: np.ndarray) -> list[float]:
+    """
+    Float32 values as the floats of their shortest decimal representation, e.g. 0.3
+    rather than 0.30000001192092896.
+
+    The values are rounded to an increasing number of significant digits until
+    they read back as the same float32, which 9 digits always do.
+    """
+    array = np.asarray(array, dtype=np.float32)
+    values = array.astype(np.float64)
+    result = values.copy()
+    pending = np.flatnonzero(np.isfinite(values) & (values != 0))
+    exponents = np.floor(np.log10(np.abs(values[pending])))
+    # Powers of ten are only exact up to 1e22, the values too small or too large to
+    # be scaled exactly are formatted one at a time
+    scalable = (exponents >= -14) & (exponents <= 22)
+    for index in pending[~scalable]:
+        result[index] = float(str(array[index]))
+    pending, exponents = pending[scalable], exponents[scalable]
+    for digits in range(1, 10):
+        # Scale by exact powers of ten so that the rounded values are the floats
+        # closest to their decimal representation
+        shift = digits - 1 - exponents
+        scale = 10.0 ** np.abs(shift)
+        rounded = np.where(
+            shift >= 0,
+            np.round(values[pending] * scale) / scale,
+            np.round(values[pending] / scale) * scale,
+        )
+        exact = rounded.astype(np.float32) == array[pending]
+        result[pending[exact]] = rounded[exact]
+        pending, exponents = pending[~exact], exponents[~exact]
+    return result.tolist()
+
+
+def to_json(arrays: PredictionArrays) -> dict:
+    """
+    Prediction in the JSON format of `Prediction`, with dates formatted as
+    "%Y-%m-%d %H:%M:%S".
+    """
+    prediction = {}
+    for name, array in arrays.items():
+        if name in VALUES:
+            prediction[name] = shortest_floats(array)
+        else:
+            dates = np.datetime_as_string(array.astype("datetime64[s]"))
+            prediction[name] = np.char.replace(dates, "T", " ").tolist()
+    return prediction
+
+
+def encode_prediction(arrays: PredictionArrays) -> bytes:
+    """
+    Compact binary representation of a prediction.
+
+    Values are stored as float32 and regular dates by their start and step rather
+    than as strings. The payload is a JSON header describing the arrays followed by
+    their little-endian content, compressed with zlib after a magic number.
+    """
+    header: dict = {"version": 1, "dates": {}, "arrays": []}
+    buffers = []
+    for name, array in arrays.items():
+        if name not in VALUES:
+            steps = np.diff(array)
+            if len(array) < 2 or np.all(steps == steps[0]):
+                header["dates"][name] = {
+                    "start": int(array[0]) if len(array) else 0,
+                    "step": int(steps[0]) if len(steps) else 0,
+                    "length": len(array),
+                }
+                continue
+            array = array.astype("<i8")
+        else:
+            array = array.astype("<f4")
+        header["arrays"].append(
+            {"name": name, "dtype": array.dtype.str, "length": len(array)}
+        )
+        buffers.append(array.tobytes())
+    encoded = json.dumps(header).encode()
+    payload = struct.pack("<I", len(encoded)) + encoded + b"".join(buffers)
+    return MAGIC + zlib.compress(payload)
+
+
+def decode_prediction(body: bytes) -> PredictionArrays:
+    """Arrays of a prediction encoded with `encode_prediction`."""
+    if not body.startswith(MAGIC):
+        raise ValueError("Not an encoded prediction")
+    payload = zlib.decompress(body[len(MAGIC) :])
+    (length,) = struct.unpack_from("<I", payload)
+    header = json.loads(payload[4 : 4 + length])
+    offset = 4 + length
+    arrays = {}
+    for name, dates in header["dates"].items():
+        arrays[name] = dates["start"] + dates["step"] * np.arange(
+            dates["length"], dtype=np.int64
+        )
+    for array in header["arrays"]:
+        dtype = np.dtype(array["dtype"])
+        arrays[array["name"]] = np.frombuffer(
+            payload, dtype=dtype, count=array["length"], offset=offset
+        )
+        offset += dtype.itemsize * array["length"]
+    return arrays
+
+
+class StoredPrediction:
+    """
+    Object of a prediction in S3, in the compact format or in JSON for predictions
+    uploaded before it.
+
+    The body is either cached or streamed from S3, in which case it is added to
+    the cache once it is fully read.
+
+    Parameters
+    ----------
+    uuid: str
+    key: str
+        Key of the object.
+    etag: str
+        ETag of the object.
+    body: Optional[bytes]
+        Content of the object, if already read.
+    stream: Any
+        Body of the response of S3, if the content is not read yet.
+    cache: Optional[PredictionCache]
+        Cache where the object is added once read.
+    """
+
+    def __init__(
+        self,
+        uuid: str,
+        key: str,
+        etag: str,
+        body: Optional[bytes] = None,
+        stream: Any = None,
+        cache: Optional["PredictionCache"] = None,
+    ):
+        self.uuid = uuid
+        self.key = key
+        self.etag = etag
+        self.body = body
+        self._stream = stream
+        self._cache = cache
+
+    @property
+    def media_type(self) -> str:
+        return (
+            PREDICTION_MEDIA_TYPE if self.key.endswith(".bin") else "application/json"
+        )
+
+    def variant_etag(self, *variant: Any) -> str:
+        """ETag of a representation of the prediction, e.g. downsampled."""
+        return '"' + "-".join([self.etag.strip('"'), *map(str, variant)]) + '"'
+
+    def iter_bytes(self) -> Generator[bytes, None, None]:
+        """Content of the object, streamed from S3 if it is not read yet."""
+        if self.body is not None:
+            yield self.body
+            return
+        chunks = []
+        try:
+            for chunk in self._stream.iter_chunks(CHUNK_SIZE):
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            self.close()
+        self.body = b"".join(chunks)
+        if self._cache is not None:
+            self._cache.put(self)
+
+    def read(self) -> bytes:
+        if self.body is None:
+            for _ in self.iter_bytes():
+                pass
+        return self.body  # type: ignore
+
+    def arrays(self) -> PredictionArrays:
+        if self.media_type == PREDICTION_MEDIA_TYPE:
+            return decode_prediction(self.read())
+        return from_prediction(Prediction.model_validate_json(self.read()))
+
+    def close(self) -> None:
+        """Release the connection of the stream, if the content is not read."""
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
+class PredictionCache:
+    """
+    In-memory LRU cache of the objects of the predictions, bounded by their size.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Total size of the objects kept. Larger objects are not cached.
+    """
+
+    def __init__(self, max_bytes: int = ML_PREDICTIONS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, StoredPrediction] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, uuid: str) -> Optional[StoredPrediction]:
+        with self._lock:
+            prediction = self._entries.get(uuid)
+            if prediction is not None:
+                self._entries.move_to_end(uuid)
+            return prediction
+
+    def put(self, prediction: StoredPrediction) -> None:
+        size = len(prediction.body or b"")
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(prediction.uuid)
+            self._entries[prediction.uuid] = prediction
+            self.size += size
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def discard(self, uuid: str) -> None:
+        with self._lock:
+            self._discard(uuid)
+
+    def _discard(self, uuid: str) -> None:
+        prediction = self._entries.pop(uuid, None)
+        if prediction is not None:
+            self.size -= len(prediction.body or b"")
+
+
+def open_prediction(
+    uuid: str,
+    bucket_name: str = ML_RESULTS_BUCKET,
+    cache: Optional[PredictionCache] = None,
+) -> StoredPrediction:
+    """
+    Open the object of a prediction in S3.
+
+    A cached object is revalidated with a conditional request, so that its content
+    is only transferred again if it changed. Predictions uploaded before the compact
+    format are read from their JSON object.
+
+    Raises
+    ------
+    botocore.exceptions.ClientError
+        With the code "NoSuchKey" if the prediction does not exist.
+    """
+    s3_client = s3.meta.client
+    cached = cache.get(uuid) if cache is not None else None
+    keys = [prediction_key(uuid), f"{uuid}.json"]
+    for key in keys:
+        kwargs = {}
+        if cached is not None and cached.key == key:
+            kwargs["IfNoneMatch"] = cached.etag
+        try:
+            obj = s3_client.get_object(Bucket=bucket_name, Key=key, **kwargs)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("304", "NotModified"):
+                return cached  # type: ignore
+            if code != "NoSuchKey":
+                raise
+            if key != keys[-1]:
+                continue
+            if cache is not None:
+                cache.discard(uuid)
+            raise
+        return StoredPrediction(uuid, key, obj["ETag"], stream=obj["Body"], cache=cache)
+    raise AssertionError("unreachable")
+
+
+def load_prediction(
+    uuid: str, bucket_name: str = ML_RESULTS_BUCKET
+) -> PredictionArrays:
+    """
+    Load a prediction from S3, see `open_prediction`.
+
+    Raises
+    ------
+    botocore.exceptions.ClientError
+        With the code "NoSuchKey" if the prediction does not exist.
+    """
+    return open_prediction(uuid, bucket_name).arrays()
+
+
+def _fill_missing(y: np.ndarray) -> np.ndarray:
+    # Missing values do not drive the selection of the points
+    y = y.astype(np.float64)
+    finite = np.isfinite(y)
+    return np.where(finite, y, y[finite].mean() if finite.any() else 0.0)
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Indices of the points kept by the Largest-Triangle-Three-Buckets algorithm.
+
+    The first and last points are kept and one point is kept in each of the
+    `points - 2` buckets in between: the one forming the largest triangle with the
+    point kept in the previous bucket and the average of the next bucket.
+    """
+    length = len(y)
+    if points >= length or points < 3:
+        return np.arange(length)
+    x, y = x.astype(np.float64), _fill_missing(y)
+    edges = np.floor(np.linspace(1, length - 1, points - 1)).astype(np.int64)
+    indices = np.empty(points, dtype=np.int64)
+    indices[0], indices[-1] = 0, length - 1
+    kept = 0
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start = end
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else length
+        mean_x = x[next_start:next_end].mean()
+        mean_y = y[next_start:next_end].mean()
+        area = np.abs(
+            (x[kept] - mean_x) * (y[start:end] - y[kept])
+            - (x[kept] - x[start:end]) * (mean_y - y[kept])
+        )
+        kept = start + int(np.argmax(area))
+        indices[bucket + 1] = kept
+    return indices
+
+
+def minmax_indices(y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Indices of the minimum and maximum of `points // 2` buckets, and of the first
+    and last points.
+    """
+    length = len(y)
+    if points >= length or points < 4:
+        return np.arange(length)
+    filled = _fill_missing(y)
+    edges = np.floor(np.linspace(0, length, points // 2 + 1)).astype(np.int64)
+    indices = {0, length - 1}
+    for start, end in zip(edges[:-1], edges[1:]):
+        indices.add(start + int(np.argmin(filled[start:end])))
+        indices.add(start + int(np.argmax(filled[start:end])))
+    return np.array(sorted(indices), dtype=np.int64)
+
+
+def align(arrays: PredictionArrays, step: int) -> PredictionArrays:
+    """
+    Average the history and the forecast of a prediction over buckets of `step`
+    seconds aligned on the epoch, so that predictions share the same dates.
+
+    Missing values are ignored. Buckets without a value for each of the series
+    sharing their dates are left out.
+    """
+    aligned = {}
+    for dates in ("data_dates", "forecast_dates"):
+        buckets, inverse = np.unique(arrays[dates] // step * step, return_inverse=True)
+        names = [name for name in VALUES if name in arrays and DATES[name] == dates]
+        means = {}
+        kept = np.ones(len(buckets), dtype=bool)
+        for name in names:
+            values = arrays[name].astype(np.float64)
+            finite = np.isfinite(values)
+            sums = np.bincount(inverse, np.where(finite, values, 0), len(buckets))
+            counts = np.bincount(inverse, finite, len(buckets))
+            kept &= counts > 0
+            means[name] = sums / np.maximum(counts, 1)
+        aligned[dates] = buckets[kept]
+        for name in names:
+            aligned[name] = means[name][kept].astype(np.float32)
+    return {name: aligned[name] for name in arrays}
+
+
+def downsample(
+    arrays: PredictionArrays, points: int, method: DownsamplingMethod = "lttb"
+) -> PredictionArrays:
+    """
+    Reduce the history and the forecast of a prediction to about `points` points
+    each.
+
+    The points are selected on the values of the history and of the forecast, the
+    bounds of the forecast are kept at the same dates.
+    """
+    downsampled = dict(arrays)
+    for values, dates in (
+        ("data_scaled", "data_dates"),
+        ("forecast", "forecast_dates"),
+    ):
+        y = arrays[values]
+        if method == "lttb":
+            indices = lttb_indices(arrays[dates], y, points)
+        else:
+            indices = minmax_indices(y, points)
+        for name, array in arrays.items():
+            if name == dates or DATES.get(name) == dates:
+                downsampled[name] = array[indices]
+    return downsampled
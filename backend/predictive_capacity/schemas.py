@@ -13,9 +13,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from typing import Optional
+from datetime import datetime
+from typing import Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, model_validator
+
+from predictive_capacity import ML_PREDICTIONS_BATCH_SIZE
 
 
 class SaturationForecast(BaseModel):
@@ -28,6 +31,22 @@ class Prediction(BaseModel):
     data_dates: list[str]
     forecast: list[float]
     forecast_dates: list[str]
+    forecast_lower: Optional[list[float]] = None
+    forecast_upper: Optional[list[float]] = None
+
+
+class PredictionsBatch(BaseModel):
+    uuids: list[str] = Field(min_length=1, max_length=ML_PREDICTIONS_BATCH_SIZE)
+    # Downsampled to about `points` points, or averaged over `step` seconds
+    points: Optional[int] = Field(None, ge=4)
+    downsampling: Literal["lttb", "minmax"] = "lttb"
+    step: Optional[int] = Field(None, ge=1)
+
+    @model_validator(mode="after")
+    def check_resampling(self) -> "PredictionsBatch":
+        if self.points is not None and self.step is not None:
+            raise ValueError("points and step cannot be combined")
+        return self
 
 
 class Dashboard(BaseModel):
@@ -46,7 +65,8 @@ class Dashboard(BaseModel):
 
 
 class MetricBase(Dashboard, Prediction):
-    pass
+    training_time: Optional[float] = None
+    history_length: Optional[int] = None
 
 
 class ResponseFindSetMetrics(BaseModel):
@@ -54,3 +74,33 @@ class ResponseFindSetMetrics(BaseModel):
     host_id: str
     service_id: str
     metric: str
+
+
+class ForecastOutcome(BaseModel):
+    metric: ResponseFindSetMetrics
+    uuid: Optional[str] = None
+    error: Optional[str] = None
+    # Records of the spans of the stages of the forecast
+    spans: list[dict] = []
+    # Prediction and DynamoDB item of the forecast, when uploading them is left to
+    # the caller
+    prediction: Optional[bytes] = None
+    metadata: Optional[dict] = None
+
+
+class Job(BaseModel):
+    job_id: str
+    organization: str
+    status: Literal["queued", "running", "succeeded", "failed"]
+    forecasting_horizon: int
+    retrain: bool
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    # Number of metrics of the run, known once it started
+    total: Optional[int] = None
+    done: int = 0
+    failed: int = 0
+    error: Optional[str] = None
+    # Failed job resumed by this one
+    resumes: Optional[str] = None
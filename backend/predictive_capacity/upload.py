@@ -13,15 +13,35 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from decimal import Decimal
+from typing import Any, Callable, Iterable, List, Optional, Tuple
 
 from loguru import logger
 from mypy_boto3_dynamodb.service_resource import Table
 
-from predictive_capacity import ML_RESULTS_BUCKET, ML_RESULTS_TABLE, dynamodb, s3
+from predictive_capacity import (
+    ML_METADATA_FLUSH_SECONDS,
+    ML_RESULTS_BUCKET,
+    ML_RESULTS_TABLE,
+    ML_UPLOAD_QUEUE_SIZE,
+    ML_UPLOAD_WORKERS,
+    dynamodb,
+    s3,
+)
+from predictive_capacity.instrumentation import collect_spans, span
+from predictive_capacity.predictions import (
+    PREDICTION_MEDIA_TYPE,
+    encode_prediction,
+    from_prediction,
+    prediction_key,
+)
 from predictive_capacity.schemas import MetricBase
 
+# Called once an item is written or uploaded, with the exception raised if it failed
+OnWritten = Callable[[Optional[Exception]], Any]
+
 
 def create_dynamodb_table(
     table_name: str = ML_RESULTS_TABLE,
@@ -44,6 +64,8 @@ def create_dynamodb_table(
       - "saturation_6_months" (map) - The saturation of the metric for the next 6 months.
       - "saturation_12_months" (map) - The saturation of the metric for the next 12 months.
       - "confidence_level" (number) - The confidence level of the prediction.
+      - "training_time" (number) - Duration of the last training in seconds.
+      - "history_length" (number) - Number of hourly points used for training.
 
     Parameters
     ----------
@@ -96,6 +118,41 @@ def create_s3_bucket(bucket_name: str = ML_RESULTS_BUCKET) -> None:
         logger.info(f"Bucket {bucket_name} already exists.")
 
 
+def metadata_item(source: str, metadata: MetricBase) -> dict:
+    """DynamoDB item holding the metadata of a forecast."""
+    item = {
+        "class": metadata.metric_name,
+        "source#host_id#service_id": f"{source}#{metadata.host_id}#{metadata.service_id}",  # noqa E501
+        "source": source,
+        "uuid": metadata.uuid,
+        "host_name": metadata.host_name,
+        "service_name": metadata.service_name,
+        "current_saturation": Decimal(str(metadata.current_saturation)),
+        "saturation_3_months": {
+            k: Decimal(str(v))
+            for k, v in metadata.saturation_3_months.dict().items()  # noqa E501
+        },
+        "saturation_6_months": {
+            k: Decimal(str(v))
+            for k, v in metadata.saturation_6_months.dict().items()  # noqa E501
+        },
+        "saturation_12_months": {
+            k: Decimal(str(v))
+            for k, v in metadata.saturation_12_months.dict().items()  # noqa E501
+        },
+        "days_to_full": metadata.days_to_full,
+        "confidence_level": metadata.confidence_level,
+        # Used to train first the metrics with the oldest forecasts
+        "forecast_at": int(time.time()),
+    }
+    # Used by the scheduler to share the training budget of the next run
+    if metadata.training_time is not None:
+        item["training_time"] = Decimal(str(round(metadata.training_time, 3)))
+    if metadata.history_length is not None:
+        item["history_length"] = metadata.history_length
+    return item
+
+
 def upload_prediction_metadata(
     source: str,
     metadata: MetricBase,
@@ -111,66 +168,39 @@ def upload_prediction_metadata(
     logger.info(f"Uploading metadata for {metadata.metric_name}...")
 
     table = dynamodb.Table(table_name)
+    item = metadata_item(source, metadata)
     try:
-        table.put_item(
-            Item={
-                "class": metadata.metric_name,
-                "source#host_id#service_id": f"{source}#{metadata.host_id}#{metadata.service_id}",  # noqa E501
-                "source": source,
-                "uuid": metadata.uuid,
-                "host_name": metadata.host_name,
-                "service_name": metadata.service_name,
-                "current_saturation": Decimal(str(metadata.current_saturation)),
-                "saturation_3_months": {
-                    k: Decimal(str(v))
-                    for k, v in metadata.saturation_3_months.dict().items()  # noqa E501
-                },
-                "saturation_6_months": {
-                    k: Decimal(str(v))
-                    for k, v in metadata.saturation_6_months.dict().items()  # noqa E501
-                },
-                "saturation_12_months": {
-                    k: Decimal(str(v))
-                    for k, v in metadata.saturation_12_months.dict().items()  # noqa E501
-                },
-                "days_to_full": metadata.days_to_full,
-                "confidence_level": metadata.confidence_level,
-            }
-        )
+        table.put_item(Item=item)
     except Exception as e:
         logger.error(f"error adding metadata item: {e}")
 
     logger.info(f"Metadata for {metadata.metric_name} uploaded successfully.")
 
 
+def prediction_body(metadata: MetricBase) -> bytes:
+    """Body of the prediction stored in S3.
+
+    Predictions are stored in the compact format of `encode_prediction`, at the
+    key `prediction_key(uuid)`. Decoded, they hold the fields of `Prediction`:
+    "data_scaled", "data_dates", "forecast" and "forecast_dates", and with the
+    prediction intervals "forecast_lower" and "forecast_upper", the 1% and 99%
+    quantiles of the forecast.
+    """
+    return encode_prediction(from_prediction(metadata))
+
+
 def upload_prediction(
     metadata: MetricBase,
     bucket_name: str = ML_RESULTS_BUCKET,
 ) -> None:
-    """Upload the prediction to S3.
-
-    Predictions are stored in json format with the following structure:
-    {
-        "data_scaled": [0.0, 0.0, 0.0, ...],
-        "data_dates": ["2021-01-01 00:00:00", "2021-01-01 01:00:00", ...],
-        "forecast": [0.0, 0.0, 0.0, ...],
-        "forecast_dates": ["2021-01-01 00:00:00", "2021-01-01 01:00:00", ...]
-    }
-    """
+    """Upload the prediction to S3, see `prediction_body`."""
     logger.info(f"Uploading prediction for {metadata.uuid}...")
 
     bucket = s3.Bucket(bucket_name)
-    body = json.dumps(
-        {
-            "data_scaled": metadata.data_scaled,
-            "data_dates": metadata.data_dates,
-            "forecast": metadata.forecast,
-            "forecast_dates": metadata.forecast_dates,
-        },
-    )
     bucket.put_object(
-        Body=body,
-        Key=f"{metadata.uuid}.json",
+        Body=prediction_body(metadata),
+        Key=prediction_key(metadata.uuid),
+        ContentType=PREDICTION_MEDIA_TYPE,
     )
     logger.info(f"Prediction for {metadata.uuid} uploaded successfully.")
 
@@ -183,20 +213,216 @@ def upload_all(
 ) -> None:
     """Upload all the results to DynamoDB and S3."""
     try:
-        upload_prediction_metadata(
-            source=source,
-            metadata=metric,
-            table_name=table_name,
-        )
+        with span("dynamodb_put"):
+            upload_prediction_metadata(
+                source=source,
+                metadata=metric,
+                table_name=table_name,
+            )
     except Exception as e:
         logger.error(f"upload prediction metadata error: {e}")
         raise e
 
     try:
-        upload_prediction(
-            metadata=metric,
-            bucket_name=bucket_name,
-        )
+        with span("s3_upload"):
+            upload_prediction(
+                metadata=metric,
+                bucket_name=bucket_name,
+            )
     except Exception as e:
         logger.error(f"upload prediction error for uuid {metric.uuid}: {e}")
         raise e
+
+
+class MetadataWriter:
+    """
+    Write the metadata of forecasts to DynamoDB in batches.
+
+    Items are buffered and written with the `batch_writer` of the table, which
+    retries the items left unprocessed, when `flush_size` items are buffered or the
+    oldest one has waited `max_delay` seconds. The remaining items are written when
+    the context exits.
+
+    Parameters
+    ----------
+    table_name: str
+        Name of the DynamoDB table.
+    flush_size: int
+        Number of items written at once, at most the 25 items of a BatchWriteItem
+        request.
+    max_delay: float
+        Longest time in seconds an item waits for the next ones, checked when an
+        item is added.
+    spans: Optional[List[dict]]
+        List where the spans of the writes are appended.
+    """
+
+    def __init__(
+        self,
+        table_name: str = ML_RESULTS_TABLE,
+        flush_size: int = 25,
+        max_delay: float = ML_METADATA_FLUSH_SECONDS,
+        spans: Optional[List[dict]] = None,
+    ):
+        self.table_name = table_name
+        self.flush_size = flush_size
+        self.max_delay = max_delay
+        self.spans = spans
+        self._buffer: List[Tuple[dict, Optional[OnWritten]]] = []
+        self._oldest = 0.0
+
+    def __enter__(self) -> "MetadataWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+    def put(
+        self,
+        item: dict,
+        on_written: Optional[OnWritten] = None,
+    ) -> None:
+        """
+        Buffer an item.
+
+        Parameters
+        ----------
+        item: dict
+            Item to write, see `metadata_item`.
+        on_written: Optional[OnWritten]
+            Called once the item is written, with the exception raised if the write
+            failed.
+        """
+        if not self._buffer:
+            self._oldest = time.monotonic()
+        self._buffer.append((item, on_written))
+        if (
+            len(self._buffer) >= self.flush_size
+            or time.monotonic() - self._oldest >= self.max_delay
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered items."""
+        if not self._buffer:
+            return
+        buffer, self._buffer = self._buffer, []
+        error = None
+        try:
+            with collect_spans(spans=self.spans), span(
+                "dynamodb_batch_write", items=len(buffer)
+            ):
+                table = dynamodb.Table(self.table_name)
+                with table.batch_writer(
+                    overwrite_by_pkeys=["class", "source#host_id#service_id"]
+                ) as writer:
+                    for item, _ in buffer:
+                        writer.put_item(Item=item)
+            logger.info(f"Metadata of {len(buffer)} forecasts uploaded successfully.")
+        except Exception as e:
+            logger.error(f"error writing {len(buffer)} metadata items: {e}")
+            error = e
+        for _, on_written in buffer:
+            if on_written is not None:
+                on_written(error)
+
+
+class UploadPipeline:
+    """
+    Upload predictions to S3 in a pool of threads, e.g. while the next metrics train.
+
+    The threads share the connection pool of the S3 client, see `aws_config`.
+    Completed uploads are reported in the thread submitting the next ones, or when
+    the context exits, which waits for all of them. When `max_pending` uploads are
+    in progress, submitting another one blocks until one of them completes.
+
+    Parameters
+    ----------
+    bucket_name: str
+        Name of the S3 bucket.
+    max_workers: int
+        Number of upload threads.
+    max_pending: int
+        Number of uploads in progress or waiting for a thread.
+    """
+
+    def __init__(
+        self,
+        bucket_name: str = ML_RESULTS_BUCKET,
+        max_workers: int = ML_UPLOAD_WORKERS,
+        max_pending: int = ML_UPLOAD_QUEUE_SIZE,
+    ):
+        self.bucket_name = bucket_name
+        self.max_pending = max(1, max_pending)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers), thread_name_prefix="upload"
+        )
+        self._pending: dict[Future, Optional[OnWritten]] = {}
+
+    def __enter__(self) -> "UploadPipeline":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def submit(
+        self,
+        uuid: str,
+        body: bytes,
+        on_uploaded: Optional[OnWritten] = None,
+        spans: Optional[List[dict]] = None,
+        **attributes,
+    ) -> None:
+        """
+        Upload a prediction in the background.
+
+        Parameters
+        ----------
+        uuid: str
+            uuid of the forecast, the prediction is stored in `prediction_key(uuid)`.
+        body: bytes
+            Prediction, see `prediction_body`.
+        on_uploaded: Optional[OnWritten]
+            Called once the prediction is uploaded, with the exception raised if the
+            upload failed.
+        spans: Optional[List[dict]]
+            List where the span of the upload is appended.
+        **attributes
+            Attributes of the span, e.g. the name of the metric.
+        """
+        self.poll()
+        while len(self._pending) >= self.max_pending:
+            self._report(wait(self._pending, return_when=FIRST_COMPLETED).done)
+        future = self._executor.submit(self._upload, uuid, body, spans, attributes)
+        self._pending[future] = on_uploaded
+
+    def poll(self) -> None:
+        """Report the uploads completed so far."""
+        self._report([future for future in self._pending if future.done()])
+
+    def close(self) -> None:
+        """Wait for all the uploads and report them."""
+        self._report(wait(self._pending).done)
+        self._executor.shutdown()
+
+    def _upload(
+        self, uuid: str, body: bytes, spans: Optional[List[dict]], attributes: dict
+    ) -> None:
+        # Clients are thread-safe, unlike the resources
+        with collect_spans(spans=spans, **attributes), span("s3_upload"):
+            s3.meta.client.put_object(
+                Bucket=self.bucket_name,
+                Key=prediction_key(uuid),
+                Body=body,
+                ContentType=PREDICTION_MEDIA_TYPE,
+            )
+        logger.info(f"Prediction for {uuid} uploaded successfully.")
+
+    def _report(self, done: Iterable[Future]) -> None:
+        for future in done:
+            on_uploaded = self._pending.pop(future)
+            error = future.exception()
+            if error is not None:
+                logger.error(f"upload prediction error: {error}")
+            if on_uploaded is not None:
+                on_uploaded(error)  # type: ignore
@@ -16,11 +16,17 @@
 import datetime
 import decimal
 import json
+import time
+from typing import List, Optional
 from uuid import uuid4
 
 from loguru import logger
 
 from predictive_capacity import ML_RESULTS_TABLE, dynamodb
+from predictive_capacity.schemas import ResponseFindSetMetrics
+
+# Most keys read by a single BatchGetItem request
+BATCH_GET_SIZE = 100
 
 
 class JSONEcoder(json.JSONEncoder):
@@ -76,3 +82,74 @@ def get_uuid(
             f"Metadata for {metric_name} does not exist. Creating a new one: {uuid}."
         )
     return uuid
+
+
+def batch_get_metadata(
+    source: str,
+    unique_labels: List[ResponseFindSetMetrics],
+    table_name: str = ML_RESULTS_TABLE,
+    max_attempts: int = 5,
+    backoff: float = 0.1,
+) -> List[Optional[dict]]:
+    """Retrieve the metadata of the last forecast of many metrics at once.
+
+    Keys are read with `BatchGetItem` by chunks of `BATCH_GET_SIZE`. Keys left
+    unprocessed by DynamoDB, e.g. when the table is throttled, are read again after
+    an exponential backoff.
+
+    Parameters
+    ----------
+    source: str
+    unique_labels: List[ResponseFindSetMetrics]
+        Metrics whose metadata is retrieved.
+    table_name: str
+    max_attempts: int
+        Number of requests made for a chunk before giving up.
+    backoff: float
+        Seconds waited before the first retry of unprocessed keys, doubled at every
+        retry.
+
+    Returns
+    -------
+    metadata: List[Optional[dict]]
+        Item stored in dynamodb for each metric, in the order of `unique_labels`,
+        None if the metric has never been forecast.
+
+    Raises
+    ------
+    RuntimeError
+        If some keys are still unprocessed after `max_attempts` requests, so that a
+        metric is never mistaken for a new one.
+    """
+
+    def key(item: ResponseFindSetMetrics) -> tuple[str, str]:
+        return item.metric, f"{source}#{item.host_id}#{item.service_id}"
+
+    # BatchGetItem rejects duplicated keys
+    keys = list(dict.fromkeys(key(item) for item in unique_labels))
+    found: dict[tuple[str, str], dict] = {}
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {
+            table_name: {
+                "Keys": [
+                    {"class": metric_name, "source#host_id#service_id": sort_key}
+                    for metric_name, sort_key in keys[start : start + BATCH_GET_SIZE]
+                ]
+            }
+        }
+        for attempt in range(max_attempts):
+            if attempt > 0:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response["Responses"].get(table_name, []):
+                found[(item["class"], item["source#host_id#service_id"])] = item
+            request = response.get("UnprocessedKeys") or {}
+            if not request:
+                break
+        else:
+            unprocessed = len(request[table_name]["Keys"])
+            raise RuntimeError(
+                f"{unprocessed} keys still unprocessed after {max_attempts} attempts"
+            )
+    logger.info(f"Metadata of {len(found)}/{len(keys)} metrics found.")
+    return [found.get(key(item)) for item in unique_labels]
@@ -5,10 +5,17 @@ from pywarp10 import Warpscript
 from predictive_capacity import ML_WARP10_URL, WARP10_SSL_VERIFY
 
 
-def fetch_metric(token: str, name: str, labels: dict[str, str]) -> pd.DataFrame:
+def fetch_metric(
+    token: str, name: str, labels: dict[str, str], start: int = 0
+) -> pd.DataFrame:
     """
     Function that gets the gts from the Warp10 database.
 
+    Parameters
+    ----------
+    start: int
+        Timestamp, in microseconds, of the first point to fetch.
+
     Returns
     -------
     pd.DataFrame
@@ -21,7 +28,7 @@ def fetch_metric(token: str, name: str, labels: dict[str, str]) -> pd.DataFrame:
             "token": token,
             "class": name,
             "labels": labels,
-            "start": 0,
+            "start": start,
             "end": "NOW",
         },
         fun="FETCH",
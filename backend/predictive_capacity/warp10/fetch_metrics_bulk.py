@@ -0,0 +1,98 @@
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+import pandas as pd
+from loguru import logger
+from pywarp10 import Warpscript
+
+from predictive_capacity import (
+    ML_WARP10_URL,
+    WARP10_FETCH_BATCH_SIZE,
+    WARP10_SSL_VERIFY,
+)
+from predictive_capacity.schemas import ResponseFindSetMetrics
+from predictive_capacity.warp10.utils import path_warpscript
+
+
+@dataclass
+class MetricData:
+    """Values, saturation and names of a series fetched from Warp10."""
+
+    metric: str
+    labels: dict[str, str]
+    data: pd.DataFrame
+    maximum_allowed: Optional[float]
+    host_name: str
+    service_name: str
+
+
+def _parse_metric_data(item: ResponseFindSetMetrics, result: dict) -> MetricData:
+    labels = {
+        "host_id": item.host_id,
+        "service_id": item.service_id,
+        "platform_uuid": item.platform_uuid,
+    }
+    data = pd.DataFrame(
+        {item.metric: pd.Series(result["values"], dtype="float64").values},
+        index=pd.to_datetime(result["ticks"], unit="us"),
+    )
+    host_names = result.get("host_name") or [item.host_id]
+    service_names = result.get("service_name") or [item.service_id]
+    saturation = result.get("saturation")
+    return MetricData(
+        metric=item.metric,
+        labels=labels,
+        data=data,
+        maximum_allowed=None if saturation is None else float(saturation),
+        host_name=host_names[0],
+        service_name=service_names[0],
+    )
+
+
+def fetch_metrics_bulk(
+    token: str,
+    metrics: list[ResponseFindSetMetrics],
+    batch_size: int = WARP10_FETCH_BATCH_SIZE,
+) -> Iterator[MetricData]:
+    """
+    Fetch the values, the saturation and the names of many metrics.
+
+    Metrics are fetched by batches of `batch_size`, each batch in a single WarpScript
+    execution, and yielded one by one in the order of `metrics` so that the caller
+    can start working on the first series while the next batch is fetched.
+
+    Parameters
+    ----------
+    token: str
+        Token to read the metrics from Warp10.
+    metrics: list[ResponseFindSetMetrics]
+        Metrics to fetch.
+    batch_size: int
+        Number of metrics fetched per WarpScript execution.
+
+    Returns
+    -------
+    Iterator[MetricData]
+        Data of each metric, in the same order as `metrics`.
+    """
+    batch_size = max(1, batch_size)
+    for start in range(0, len(metrics), batch_size):
+        batch = metrics[start : start + batch_size]
+        selectors = [
+            {
+                "metric": item.metric,
+                "host_id": item.host_id,
+                "service_id": item.service_id,
+                "platform_uuid": item.platform_uuid,
+            }
+            for item in batch
+        ]
+        ws = Warpscript(host=ML_WARP10_URL, connection="http", verify=WARP10_SSL_VERIFY)
+        ws.load(
+            path_warpscript("fetch_metrics_bulk"), read_token=token, selectors=selectors
+        )
+        results = ws.exec(raw=True)[0]
+        assert len(results) == len(batch), "One result is expected per selector."
+        logger.debug(f"Fetched {len(batch)} metrics from Warp10.")
+        for item, result in zip(batch, results):
+            yield _parse_metric_data(item, result)
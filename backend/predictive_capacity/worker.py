@@ -0,0 +1,174 @@
+# Copyright (C) 2024  Centreon
+# This file is part of Predictive Capacity.
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+
+import predictive_capacity.monitoring as monitoring
+from predictive_capacity import (
+    ML_JOBS_DB,
+    ML_JOBS_POLL_SECONDS,
+    ML_WORKER_METRICS_PORT,
+    WARP10_READ_TOKEN,
+    dynamodb,
+    s3,
+)
+from predictive_capacity.forecast.forecast import make_forecasts
+from predictive_capacity.jobs import JobQueue, RunLedger, metric_key
+from predictive_capacity.schemas import ForecastOutcome, Job
+from predictive_capacity.warp10.find_set_metrics import find_set_metrics
+
+
+def run_job(job: Job, queue: JobQueue, read_token: str = WARP10_READ_TOKEN) -> None:
+    """
+    Forecast all the metrics of the organization of a claimed job.
+
+    A heartbeat is sent while the job runs so that it is requeued if the worker
+    dies, and the progress is recorded as metrics are forecast. The state of every
+    metric is recorded in the `RunLedger` of the job: when the job runs again, or
+    resumes a failed job, uploaded metrics are skipped. Failed metrics are retried
+    with backoff until they succeed or run out of attempts.
+    """
+    stopped = threading.Event()
+
+    def send_heartbeats() -> None:
+        while not stopped.wait(queue.stale_after / 10):
+            try:
+                queue.heartbeat(job.job_id)
+            except Exception as e:
+                logger.warning(f"Failed to send the heartbeat of {job.job_id}: {e}")
+
+    heartbeat = threading.Thread(target=send_heartbeats, daemon=True)
+    heartbeat.start()
+    ledger = RunLedger(queue.path, job.job_id, resumes=job.resumes)
+
+    def record(outcome: ForecastOutcome) -> None:
+        queue.update_progress(job.job_id, *ledger.progress())
+
+    try:
+        with monitoring.STAGE_SECONDS.time(stage="find_set_metrics"):
+            unique_labels = find_set_metrics(token=read_token)
+        if len(unique_labels) == 0:
+            raise ValueError("No metrics found")
+        ledger.start(unique_labels)
+        queue.update_progress(job.job_id, *ledger.progress(), total=len(unique_labels))
+        # Bounds the attempts of this run even if the ledger cannot be updated
+        attempts: dict[str, int] = {}
+        while True:
+            due, wait = ledger.due(unique_labels)
+            due = [
+                item
+                for item in due
+                if attempts.get(metric_key(item), 0) < ledger.max_attempts
+            ]
+            if len(due) == 0:
+                if wait is None:
+                    break
+                logger.info(f"Retrying failed metrics in {wait:.0f}s")
+                time.sleep(wait)
+                continue
+            for item in due:
+                attempts[metric_key(item)] = attempts.get(metric_key(item), 0) + 1
+            make_forecasts(
+                unique_labels=due,
+                read_token=read_token,
+                organization=job.organization,
+                forecasting_horizon=job.forecasting_horizon,
+                retrain=job.retrain,
+                on_outcome=record,
+                ledger=ledger,
+            )
+    except Exception as e:
+        logger.error(f"Forecast job {job.job_id} failed: {e}")
+        queue.finish(job.job_id, error=str(e))
+        return
+    finally:
+        stopped.set()
+        heartbeat.join()
+    queue.finish(job.job_id)
+    done, failed = ledger.progress()
+    logger.info(f"Forecast job {job.job_id} done: {done - failed}/{done} succeeded.")
+
+
+def work(
+    queue: JobQueue,
+    poll_interval: float = ML_JOBS_POLL_SECONDS,
+    stop: Optional[threading.Event] = None,
+    once: bool = False,
+) -> None:
+    """
+    Execute the queued jobs one at a time until `stop` is set.
+
+    Parameters
+    ----------
+    queue: JobQueue
+        Queue of the jobs.
+    poll_interval: float
+        Seconds to wait before polling again an empty queue.
+    stop: Optional[threading.Event]
+        Stops the worker once the running job, if any, is done.
+    once: bool
+        Stop as soon as the queue is empty.
+    """
+    stop = stop or threading.Event()
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    logger.info(f"Worker {worker} polling jobs from {queue.path}")
+    while not stop.is_set():
+        job = queue.claim(worker)
+        if job is None:
+            if once:
+                return
+            stop.wait(poll_interval)
+            continue
+        logger.info(f"Running forecast job {job.job_id} of {job.organization}")
+        run_job(job, queue)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Execute the forecast runs queued by the API."
+    )
+    parser.add_argument("--db", default=ML_JOBS_DB, help="SQLite database of jobs")
+    parser.add_argument("--once", action="store_true", help="Exit when idle")
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=ML_WORKER_METRICS_PORT,
+        help="Port where the internal metrics are served (0 disables)",
+    )
+    args = parser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level=os.environ.get("LOG_LEVEL", "INFO").upper())
+    if args.metrics_port > 0:
+        monitoring.serve(args.metrics_port)
+    monitoring.instrument_client(dynamodb.meta.client)
+    monitoring.instrument_client(s3.meta.client)
+    stop = threading.Event()
+    # The running job finishes, or is requeued once its heartbeat stops
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    work(JobQueue(args.db), stop=stop, once=args.once)
+
+
+if __name__ == "__main__":
+    main()
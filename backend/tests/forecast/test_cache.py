@@ -0,0 +1,110 @@
+import os
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+LABELS = {"host_id": "1", "service_id": "2", "platform_uuid": "p"}
+
+
+@pytest.fixture
+def raw_data() -> pd.DataFrame:
+    """Three days of 5 minutes data."""
+    index = pd.date_range("2024-01-01", periods=3 * 24 * 12, freq="5min")
+    return pd.DataFrame({"metric": np.arange(len(index), dtype=float)}, index=index)
+
+
+def test_store_and_load(tmp_path, raw_data):
+    from predictive_capacity.forecast.cache import SeriesCache
+
+    cache = SeriesCache(str(tmp_path))
+    assert cache.load("metric", LABELS) is None
+
+    cache.store("metric", LABELS, raw_data, maximum_allowed=1000)
+    cached = cache.load("metric", LABELS)
+
+    assert cached is not None
+    expected = raw_data["metric"].resample("H").mean().iloc[:-1]
+    np.testing.assert_array_equal(cached.data["metric"].values, expected.values)
+    assert cached.high_water_mark == pd.Timestamp("2024-01-03 23:00:00")
+    assert cached.last_value == raw_data["metric"].values[-1]
+    assert cached.maximum_allowed == 1000
+
+    cache.invalidate("metric", LABELS)
+    assert cache.load("metric", LABELS) is None
+
+
+def test_evict_least_recently_used(tmp_path, raw_data):
+    from predictive_capacity.forecast.cache import SeriesCache
+
+    cache = SeriesCache(str(tmp_path))
+    for i in range(3):
+        cache.store(f"metric{i}", LABELS, raw_data, maximum_allowed=1000)
+        os.utime(cache.path(f"metric{i}", LABELS), (i, i))
+    size = os.path.getsize(cache.path("metric0", LABELS))
+
+    cache.max_bytes = 2 * size
+    cache.evict()
+
+    assert not os.path.exists(cache.path("metric0", LABELS))
+    assert os.path.exists(cache.path("metric1", LABELS))
+    assert os.path.exists(cache.path("metric2", LABELS))
+
+
+def test_size_is_tracked_without_scanning(tmp_path, raw_data):
+    from predictive_capacity.forecast.cache import SeriesCache
+
+    SeriesCache(str(tmp_path)).store("metric0", LABELS, raw_data, 1000)
+    cache = SeriesCache(str(tmp_path))
+    size = os.path.getsize(cache.path("metric0", LABELS))
+    assert cache.size == size
+
+    with patch("predictive_capacity.forecast.cache.os.scandir") as mock_scandir:
+        cache.store("metric0", LABELS, raw_data, 1000)
+        cache.store("metric1", LABELS, raw_data, 1000)
+        mock_scandir.assert_not_called()
+    assert cache.size == 2 * size
+    cache.invalidate("metric0", LABELS)
+    assert cache.size == size
+
+    # Evicted only once the total goes over the limit
+    cache.max_bytes = size
+    cache.store("metric0", LABELS, raw_data, 1000)
+    assert cache.size == size
+    assert len(os.listdir(tmp_path)) == 1
+
+
+@patch("predictive_capacity.forecast.metric.get_metric_saturation")
+@patch("predictive_capacity.forecast.metric.fetch_metric")
+def test_metric_training_fetches_delta(
+    mock_fetch_metric, mock_get_metric_saturation, tmp_path, raw_data
+):
+    from predictive_capacity.forecast.cache import SeriesCache
+    from predictive_capacity.forecast.metric import MetricTraining
+
+    cache = SeriesCache(str(tmp_path))
+    history, new = raw_data.iloc[:500], raw_data.iloc[500:]
+    mock_get_metric_saturation.return_value = 1000
+    mock_fetch_metric.return_value = history
+    MetricTraining("token", "metric", LABELS, cache=cache)
+
+    cached = cache.load("metric", LABELS)
+    assert cached is not None
+    mock_fetch_metric.return_value = raw_data[raw_data.index >= cached.high_water_mark]
+    training = MetricTraining("token", "metric", LABELS, cache=cache)
+
+    start = mock_fetch_metric.call_args.kwargs["start"]
+    assert pd.Timestamp(start, unit="us") == cached.high_water_mark
+    assert training.current_saturation == new["metric"].values[-1] / 1000
+    pd.testing.assert_frame_equal(
+        training.interpolate().data,
+        raw_data.resample("H").mean().interpolate(method="linear"),
+        check_freq=False,
+    )
+
+    # A new saturation invalidates the cache and fetches the whole history
+    mock_get_metric_saturation.return_value = 2000
+    mock_fetch_metric.return_value = raw_data
+    MetricTraining("token", "metric", LABELS, cache=cache)
+    assert "start" not in mock_fetch_metric.call_args.kwargs
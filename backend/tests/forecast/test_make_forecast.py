@@ -5,21 +5,21 @@ import pandas as pd
 import pytest
 
 
-def upload_all(metric, source):
-    """Mock upload_gts function
+def prediction_body(result):
+    """Mock prediction_body function
 
-    This function is used to mock the upload_gts function in the metric module.
-    At this time, this function does nothing.
+    This function is used to plot the prediction before it is uploaded.
 
     TODO: Add forecast results and make sure forecast goes in the right direction.
     """
     from predictive_capacity import __version__
+    from predictive_capacity.upload import prediction_body
 
-    metric_name = metric.metric_name
-    data_scaled = metric.data_scaled
-    data_dates = metric.data_dates
-    forecast = metric.forecast
-    forecast_dates = metric.forecast_dates
+    metric_name = result.metric_name
+    data_scaled = result.data_scaled
+    data_dates = result.data_dates
+    forecast = result.forecast
+    forecast_dates = result.forecast_dates
     metric = pd.DataFrame(
         {metric_name: data_scaled},
         index=pd.to_datetime(data_dates),
@@ -31,6 +31,7 @@ def upload_all(metric, source):
     df = pd.concat([metric, forecast])
     df.plot()
     plt.savefig(f"tests/forecast/{metric_name}_{__version__}.png")
+    return prediction_body(result)
 
 
 @pytest.fixture
@@ -44,6 +45,15 @@ def data():
     return df
 
 
+@patch("predictive_capacity.upload.s3")
+@patch("predictive_capacity.upload.dynamodb")
+@patch(
+    "predictive_capacity.forecast.forecast.batch_get_metadata",
+    return_value=[{"uuid": "uuid"}],
+)
+@patch("predictive_capacity.forecast.forecast.save_model")
+@patch("predictive_capacity.forecast.forecast.save_trials")
+@patch("predictive_capacity.forecast.forecast.load_trials", return_value=[])
 @patch("predictive_capacity.forecast.forecast.s3")
 @patch("predictive_capacity.forecast.forecast.bucket_exists", return_value=False)
 @patch("predictive_capacity.forecast.forecast.list_all_tables")
@@ -54,11 +64,11 @@ def data():
 )
 @patch("predictive_capacity.forecast.metric.fetch_metric")
 @patch("predictive_capacity.forecast.metric.get_metric_saturation", return_value=1000)
-@patch("predictive_capacity.forecast.forecast.upload_all")
+@patch("predictive_capacity.forecast.forecast.prediction_body")
 @patch("predictive_capacity.forecast.forecast.get_uuid", return_value="uuid")
 def test_make_forecast(
     mock_get_uuid,
-    mock_upload_all,
+    mock_prediction_body,
     mock_get_metric_saturation,
     mock_fetch_metric,
     mock_get_label_name,
@@ -66,6 +76,12 @@ def test_make_forecast(
     mock_list_all_tables,
     mock_bucket_exists,
     mock_s3,
+    mock_load_trials,
+    mock_save_trials,
+    mock_save_model,
+    mock_batch_get_metadata,
+    mock_dynamodb,
+    mock_upload_s3,
     data,
 ):
     from predictive_capacity.forecast.forecast import (
@@ -74,7 +90,7 @@ def test_make_forecast(
     )
 
     mock_fetch_metric.return_value = data
-    mock_upload_all.side_effect = upload_all
+    mock_prediction_body.side_effect = prediction_body
 
     unique_labels = ResponseFindSetMetrics(
         metric="#Passengers",
@@ -92,7 +108,25 @@ def test_make_forecast(
         timeout=100,
         unique_labels=[unique_labels],
     )
-    assert forecast is None
+    assert len(forecast) == 1
+    assert forecast[0].uuid == "uuid"
+    assert forecast[0].error is None
+    stages = {span["name"] for span in forecast[0].spans}
+    assert {
+        "label_lookup",
+        "saturation_fetch",
+        "warp10_fetch",
+        "training.resample",
+        "training.scale",
+        "search",
+        "final_fit",
+        "predict",
+        "days_to_full",
+        "s3_upload",
+    } <= stages
+    assert all(
+        span["attributes"]["metric"] == "#Passengers" for span in forecast[0].spans
+    )
     mock_get_label_name.assert_called_once()
     mock_fetch_metric.assert_called_once()
     mock_get_metric_saturation.assert_called_once()
@@ -100,5 +134,226 @@ def test_make_forecast(
     mock_list_all_tables.assert_called_once()
     mock_bucket_exists.assert_called_once()
     mock_s3.meta.client.create_bucket.assert_called_once()
-    mock_upload_all.assert_called_once()
-    mock_get_uuid.assert_called_once()
+    mock_upload_s3.meta.client.put_object.assert_called_once()
+    assert mock_upload_s3.meta.client.put_object.call_args.kwargs["Key"] == "uuid.bin"
+    writer = mock_dynamodb.Table.return_value.batch_writer.return_value.__enter__
+    writer.return_value.put_item.assert_called_once()
+    mock_batch_get_metadata.assert_called_once()
+    mock_get_uuid.assert_not_called()
+    mock_load_trials.assert_called_once_with("uuid")
+    mock_save_trials.assert_called_once()
+    # The model is saved even though ML_MODEL_REUSE is not set
+    mock_save_model.assert_called_once()
+    assert mock_save_model.call_args.args[0] == "uuid"
+
+
+@patch("predictive_capacity.upload.s3")
+@patch("predictive_capacity.upload.dynamodb")
+@patch("predictive_capacity.forecast.forecast.batch_get_metadata")
+@patch("predictive_capacity.forecast.forecast.metadata_item", return_value={})
+@patch("predictive_capacity.forecast.forecast.save_trials")
+@patch("predictive_capacity.forecast.forecast.load_trials", return_value=[])
+@patch("predictive_capacity.forecast.forecast.bucket_exists", return_value=True)
+@patch("predictive_capacity.forecast.forecast.list_all_tables")
+@patch("predictive_capacity.forecast.forecast.Metric")
+@patch("predictive_capacity.forecast.forecast.prediction_body", return_value=b"{}")
+@patch("predictive_capacity.forecast.forecast.get_uuid", return_value="uuid")
+def test_make_forecast_failure_does_not_stop_run(
+    mock_get_uuid,
+    mock_prediction_body,
+    mock_metric,
+    mock_list_all_tables,
+    mock_bucket_exists,
+    mock_load_trials,
+    mock_save_trials,
+    mock_metadata_item,
+    mock_batch_get_metadata,
+    mock_dynamodb,
+    mock_upload_s3,
+    tmp_path,
+):
+    from predictive_capacity import ML_RESULTS_TABLE
+    from predictive_capacity.forecast.forecast import (
+        ResponseFindSetMetrics,
+        make_forecasts,
+    )
+    from predictive_capacity.jobs import RunLedger
+
+    mock_list_all_tables.return_value = [ML_RESULTS_TABLE]
+    # metric1 was never forecast, so it is trained first
+    mock_batch_get_metadata.return_value = [{"uuid": "uuid0", "days_to_full": 10}, None]
+    mock_metric.side_effect = [mock_metric.return_value, Exception("Warp10 timeout")]
+    unique_labels = [
+        ResponseFindSetMetrics(
+            metric=f"metric{i}",
+            host_id="123",
+            service_id="123",
+            platform_uuid="0000-0000-0000-0000",
+        )
+        for i in range(2)
+    ]
+
+    ledger = RunLedger(str(tmp_path / "jobs.sqlite"), "job")
+    ledger.start(unique_labels)
+    outcomes = make_forecasts(
+        forecasting_horizon=356 * 24,
+        read_token="read",
+        organization="firm",
+        unique_labels=unique_labels,
+        ledger=ledger,
+    )
+
+    assert [call.kwargs["metric"] for call in mock_metric.call_args_list] == [
+        "metric1",
+        "metric0",
+    ]
+    # Outcomes are in the order of the metrics given
+    assert [outcome.metric.metric for outcome in outcomes] == ["metric0", "metric1"]
+    assert [outcome.error for outcome in outcomes] == ["Warp10 timeout", None]
+    assert outcomes[0].uuid == "uuid0"
+    assert outcomes[1].uuid not in (None, "uuid0")
+    assert all(outcome.prediction is None for outcome in outcomes)
+    assert all(outcome.metadata is None for outcome in outcomes)
+    states = ledger.states()
+    assert states["0000-0000-0000-0000#123#123#metric0"]["state"] == "failed"
+    assert states["0000-0000-0000-0000#123#123#metric0"]["error"] == "Warp10 timeout"
+    assert states["0000-0000-0000-0000#123#123#metric1"]["state"] == "uploaded"
+    mock_upload_s3.meta.client.put_object.assert_called_once()
+    mock_get_uuid.assert_not_called()
+
+
+@patch("predictive_capacity.upload.s3")
+@patch("predictive_capacity.upload.dynamodb")
+@patch("predictive_capacity.forecast.forecast.batch_get_metadata")
+@patch("predictive_capacity.forecast.forecast.bucket_exists", return_value=True)
+@patch("predictive_capacity.forecast.forecast.list_all_tables")
+@patch("predictive_capacity.forecast.forecast.forecast_metric")
+def test_make_forecast_metadata_write_failure(
+    mock_forecast_metric,
+    mock_list_all_tables,
+    mock_bucket_exists,
+    mock_batch_get_metadata,
+    mock_dynamodb,
+    mock_upload_s3,
+    tmp_path,
+):
+    from predictive_capacity import ML_RESULTS_TABLE
+    from predictive_capacity.forecast.forecast import (
+        ResponseFindSetMetrics,
+        make_forecasts,
+    )
+    from predictive_capacity.jobs import RunLedger
+    from predictive_capacity.schemas import ForecastOutcome
+
+    mock_list_all_tables.return_value = [ML_RESULTS_TABLE]
+    item = ResponseFindSetMetrics(
+        metric="metric", host_id="123", service_id="123", platform_uuid="0000"
+    )
+    mock_batch_get_metadata.side_effect = Exception("throttled")
+    mock_forecast_metric.return_value = ForecastOutcome(
+        metric=item, uuid="uuid", prediction=b"{}", metadata={"uuid": "uuid"}
+    )
+    mock_dynamodb.Table.return_value.batch_writer.side_effect = Exception("denied")
+    ledger = RunLedger(str(tmp_path / "jobs.sqlite"), "job")
+    ledger.start([item])
+    reported = []
+
+    outcomes = make_forecasts(
+        forecasting_horizon=356 * 24,
+        read_token="read",
+        organization="firm",
+        unique_labels=[item],
+        ledger=ledger,
+        on_outcome=reported.append,
+    )
+
+    # uuids are retrieved one by one when the batch lookup fails
+    assert mock_forecast_metric.call_args.kwargs["uuid"] is None
+    assert outcomes[0].error == "denied"
+    assert reported == outcomes
+    assert ledger.states()["0000#123#123#metric"]["state"] == "failed"
+
+
+def train_in_worker(item, uuid=None, **kwargs):
+    """Stand-in of forecast_metric run by the worker processes"""
+    from predictive_capacity.schemas import ForecastOutcome
+
+    return ForecastOutcome(
+        metric=item, uuid=uuid, prediction=b"{}", metadata={"uuid": uuid}
+    )
+
+
+@patch("predictive_capacity.upload.s3")
+@patch("predictive_capacity.upload.dynamodb")
+@patch("predictive_capacity.forecast.forecast.batch_get_metadata")
+@patch("predictive_capacity.forecast.forecast.bucket_exists", return_value=True)
+@patch("predictive_capacity.forecast.forecast.list_all_tables")
+@patch("predictive_capacity.forecast.forecast.forecast_metric", train_in_worker)
+@pytest.mark.parametrize("budget", [0, 600])
+def test_make_forecast_workers(
+    mock_list_all_tables,
+    mock_bucket_exists,
+    mock_batch_get_metadata,
+    mock_dynamodb,
+    mock_upload_s3,
+    budget,
+    tmp_path,
+):
+    from predictive_capacity import ML_RESULTS_TABLE
+    from predictive_capacity.forecast.forecast import (
+        ResponseFindSetMetrics,
+        make_forecasts,
+        wait,
+    )
+    from predictive_capacity.jobs import RunLedger
+
+    mock_list_all_tables.return_value = [ML_RESULTS_TABLE]
+    mock_batch_get_metadata.return_value = [{"uuid": f"uuid{i}"} for i in range(4)]
+    unique_labels = [
+        ResponseFindSetMetrics(
+            metric=f"metric{i}", host_id="123", service_id="123", platform_uuid="0000"
+        )
+        for i in range(4)
+    ]
+    ledger = RunLedger(str(tmp_path / "jobs.sqlite"), "job")
+    ledger.start(unique_labels)
+    queued = []
+
+    def wait_spy(pending, *args, **kwargs):
+        queued.append(len(pending))
+        return wait(pending, *args, **kwargs)
+
+    with patch("predictive_capacity.forecast.forecast.wait", wait_spy):
+        outcomes = make_forecasts(
+            forecasting_horizon=356 * 24,
+            read_token="read",
+            organization="firm",
+            unique_labels=unique_labels,
+            ledger=ledger,
+            n_workers=2,
+            fetch_batch_size=0,
+            prioritize=False,
+            budget=budget,
+        )
+
+    assert [outcome.metric.metric for outcome in outcomes] == [
+        f"metric{i}" for i in range(4)
+    ]
+    assert [outcome.error for outcome in outcomes] == [None] * 4
+    assert [outcome.uuid for outcome in outcomes] == [f"uuid{i}" for i in range(4)]
+    assert all(outcome.prediction is None for outcome in outcomes)
+    states = ledger.states()
+    assert [state["state"] for state in states.values()] == ["uploaded"] * 4
+    assert mock_upload_s3.meta.client.put_object.call_count == 4
+    mock_dynamodb.Table.return_value.batch_writer.assert_called()
+    # With a budget, metrics do not wait for a worker, their timeout would be stale
+    assert max(queued) == (2 if budget else 4)
+
+
+@pytest.mark.parametrize("n_workers", [1, 2, 3, 1000])
+def test_split_cpus(n_workers):
+    from predictive_capacity.forecast.forecast import split_cpus
+
+    cpu_sets = split_cpus(n_workers)
+    assert len(cpu_sets) == n_workers
+    assert all(len(cpus) > 0 for cpus in cpu_sets)
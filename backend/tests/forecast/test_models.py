@@ -0,0 +1,265 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def xy():
+    rng = np.random.default_rng(0)
+    n = 300
+    timestamp = np.linspace(0, 1, n)
+    hour = np.tile(np.arange(24), n // 24 + 1)[:n] / 23
+    X = np.column_stack([timestamp, hour])
+    y = 0.5 * timestamp + 0.1 * np.sin(2 * np.pi * hour) + rng.normal(0, 0.01, n)
+    return X, y
+
+
+def lgbm_regressor(n_estimators):
+    """LightGBM regressor as built by the trials of the search."""
+    from lightgbm import LGBMRegressor
+
+    return LGBMRegressor(
+        objective="quantile",
+        alpha=0.5,
+        learning_rate=0.1,
+        n_estimators=n_estimators,
+        reg_alpha=1.0,
+        reg_lambda=1.0,
+        random_state=0,
+        verbose=-1,
+    )
+
+
+def test_warm_start_enqueues_previous_trials(xy):
+    from predictive_capacity.forecast.models import MutliGBMTunedDetrended
+
+    params = {
+        "gbm_type": "hgbr",
+        "learning_rate": 0.1,
+        "max_iter": 50,
+        "quantile": 0.5,
+        "loss": "quantile",
+        "poly_degree": 1,
+        "trend_model": "huber",
+        "huber_eps": 1.35,
+        "damped": 1.0,
+    }
+    reg = MutliGBMTunedDetrended(
+        n_trials=1000,
+        timeout=60,
+        n_splits=3,
+        warm_start_trials=[{"params": params, "value": 0.0}],
+        patience=3,
+    ).fit(*xy)
+
+    first_trial = reg.study.trials[0]
+    assert first_trial.params == params
+    # The search stops once no trial improved on the best one for `patience` trials
+    assert len(reg.study.trials) - 1 - reg.study.best_trial.number == 3
+    assert reg.predict(xy[0]).shape == (300,)
+
+
+def test_fold_trend_is_fitted_once(xy):
+    from predictive_capacity.forecast.models import (
+        MutliGBMTunedDetrended,
+        make_trend_forecaster,
+    )
+
+    X, y = xy
+    reg = MutliGBMTunedDetrended(n_trials=1, n_splits=3).fit(X, y)
+    train_end, valid_end = reg.folds[1]
+    trend_train, trend_valid = reg.fold_trend(1, 1, "huber", 123.4)
+    assert len(reg.trend_cache) == 1
+    reg.fold_trend(1, 1, "huber", 119.9)
+    assert len(reg.trend_cache) == 1
+
+    trend_forecaster = make_trend_forecaster(1, "huber", 120)
+    trend_forecaster.fit(X[:train_end, :1], y[:train_end])
+    np.testing.assert_allclose(trend_train, trend_forecaster.predict(X[:train_end, :1]))
+    np.testing.assert_allclose(
+        trend_valid, trend_forecaster.predict(X[train_end:valid_end, :1])
+    )
+
+
+def test_fit_predict_fold_matches_lgbm_regressor(xy):
+    from predictive_capacity.forecast.models import MutliGBMTunedDetrended
+
+    X, y = xy
+    reg = MutliGBMTunedDetrended(n_trials=1, n_splits=3).fit(X, y)
+    gbm = lgbm_regressor(n_estimators=50)
+    train_end, valid_end = reg.folds[2]
+    for target in (y, 2 * y):
+        preds = reg.fit_predict_fold(gbm, 2, target[:train_end])
+        expected = gbm.fit(X[:train_end], target[:train_end]).predict(
+            X[train_end:valid_end]
+        )
+        np.testing.assert_allclose(preds, expected)
+    assert list(reg.lgb_datasets) == [2]
+
+
+@pytest.mark.parametrize("gbm_type", ["lgbm", "gbr", "hgbr"])
+def test_fit_predict_fold_reports_while_boosting(xy, gbm_type):
+    from sklearn.ensemble import (
+        GradientBoostingRegressor,
+        HistGradientBoostingRegressor,
+    )
+
+    from predictive_capacity.forecast.models import MutliGBMTunedDetrended
+
+    X, y = xy
+    reg = MutliGBMTunedDetrended(n_trials=1, n_splits=3).fit(X, y)
+    gbm = {
+        "lgbm": lgbm_regressor(n_estimators=250),
+        "gbr": GradientBoostingRegressor(n_estimators=250, random_state=0),
+        "hgbr": HistGradientBoostingRegressor(max_iter=250, random_state=0),
+    }[gbm_type]
+    train_end, valid_end = reg.folds[2]
+    reports = []
+
+    preds = reg.fit_predict_fold(
+        gbm,
+        2,
+        y[:train_end],
+        valid_target=y[train_end:valid_end],
+        report=lambda rounds, mae: reports.append((rounds, mae)),
+    )
+
+    assert [rounds for rounds, _ in reports] == [100, 200]
+    assert all(mae > 0 for _, mae in reports)
+    np.testing.assert_allclose(preds, reg.fit_predict_fold(gbm, 2, y[:train_end]))
+
+
+def test_pruned_trial_stops_boosting(xy):
+    import optuna
+
+    from predictive_capacity.forecast.models import MutliGBMTunedDetrended
+
+    X, y = xy
+    reg = MutliGBMTunedDetrended(n_trials=1, n_splits=3).fit(X, y)
+    train_end, valid_end = reg.folds[2]
+    reports = []
+
+    def report(rounds, mae):
+        reports.append(rounds)
+        raise optuna.TrialPruned()
+
+    with pytest.raises(optuna.TrialPruned):
+        reg.fit_predict_fold(
+            lgbm_regressor(n_estimators=3000),
+            2,
+            y[:train_end],
+            valid_target=y[train_end:valid_end],
+            report=report,
+        )
+    assert reports == [100]
+
+
+@pytest.mark.parametrize("name", ["asha", "hyperband", "none"])
+def test_make_pruner(name):
+    from predictive_capacity.forecast.models import make_pruner
+
+    assert make_pruner(name, n_splits=5) is not None
+
+
+def test_make_pruner_unknown():
+    from predictive_capacity.forecast.models import make_pruner
+
+    with pytest.raises(ValueError):
+        make_pruner("median", n_splits=5)
+
+
+def test_parallel_trials(xy):
+    from predictive_capacity.forecast.models import MutliGBMTunedDetrended
+
+    reg = MutliGBMTunedDetrended(n_trials=8, n_splits=3, n_jobs=2).fit(*xy)
+
+    assert len(reg.study.trials) == 8
+    assert reg.predict(xy[0]).shape == (300,)
+
+
+def test_trial_jobs_are_capped_at_available_cpus(xy):
+    from unittest.mock import patch
+
+    import optuna
+
+    from predictive_capacity.forecast.models import MutliGBMTunedDetrended
+
+    optimize = optuna.Study.optimize
+    with patch(
+        "predictive_capacity.forecast.models.available_cpus", return_value=2
+    ), patch.object(
+        optuna.Study, "optimize", autospec=True, side_effect=optimize
+    ) as mock_optimize:
+        reg = MutliGBMTunedDetrended(n_trials=4, n_splits=3, n_jobs=8).fit(*xy)
+
+    assert mock_optimize.call_args.kwargs["n_jobs"] == 2
+    assert reg.threads_per_trial == 1
+
+
+def test_parallel_trials_fit_sklearn_models_one_at_a_time(xy):
+    import threading
+    import time
+    from unittest.mock import patch
+
+    from sklearn.ensemble import (
+        GradientBoostingRegressor,
+        HistGradientBoostingRegressor,
+    )
+
+    from predictive_capacity.forecast.models import MutliGBMTunedDetrended
+
+    lock = threading.Lock()
+    running, most_running, fits = 0, 0, 0
+
+    def counting(fit):
+        def wrapper(self, *args, **kwargs):
+            nonlocal running, most_running, fits
+            with lock:
+                running += 1
+                fits += 1
+                most_running = max(most_running, running)
+            try:
+                time.sleep(0.01)
+                return fit(self, *args, **kwargs)
+            finally:
+                with lock:
+                    running -= 1
+
+        return wrapper
+
+    with patch.object(
+        GradientBoostingRegressor, "fit", counting(GradientBoostingRegressor.fit)
+    ), patch.object(
+        HistGradientBoostingRegressor,
+        "fit",
+        counting(HistGradientBoostingRegressor.fit),
+    ), patch(
+        "predictive_capacity.forecast.models.available_cpus", return_value=4
+    ):
+        MutliGBMTunedDetrended(n_trials=12, n_splits=3, n_jobs=4).fit(*xy)
+
+    assert fits > 0
+    assert most_running == 1
+
+
+def test_lgb_datasets_are_per_thread(xy):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from predictive_capacity.forecast.models import MutliGBMTunedDetrended
+
+    reg = MutliGBMTunedDetrended(n_trials=1, n_splits=3).fit(*xy)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        datasets = list(executor.map(lambda _: reg.fold_datasets(0), range(2)))
+    assert datasets[0][0] is not reg.fold_datasets(0)[0]
+    assert reg.fold_datasets(0)[0] is reg.fold_datasets(0)[0]
+
+
+def test_intervals_are_fitted_on_demand(xy):
+    from predictive_capacity.forecast.models import MutliGBMTunedDetrended
+
+    X, y = xy
+    reg = MutliGBMTunedDetrended(n_trials=2, n_splits=3).fit(X, y)
+    assert reg.best_gbm_low is None and reg.best_gbm_high is None
+
+    low, high = reg.predict_low(X), reg.predict_high(X)
+    assert reg.best_gbm_low is not None and reg.best_gbm_high is not None
+    assert np.mean(low <= high) > 0.9
@@ -0,0 +1,144 @@
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+from moto import mock_aws
+
+
+@pytest.fixture
+def prefetched():
+    from predictive_capacity.warp10.fetch_metrics_bulk import MetricData
+
+    index = pd.date_range("2024-01-01", periods=24 * 30, freq="H")
+    rng = np.random.default_rng(0)
+    values = (
+        100
+        + 0.1 * np.arange(len(index))
+        + 10 * np.sin(2 * np.pi * index.hour / 24)
+        + rng.normal(0, 1, len(index))
+    )
+    return MetricData(
+        metric="metric",
+        labels={"host_id": "1", "service_id": "2", "platform_uuid": "p"},
+        data=pd.DataFrame({"metric": values}, index=index),
+        maximum_allowed=1000.0,
+        host_name="host",
+        service_name="service",
+    )
+
+
+def make_metric(prefetched, hours: int):
+    from dataclasses import replace
+
+    from predictive_capacity.forecast.metric import Metric
+
+    return Metric(
+        metric="metric",
+        host_id="1",
+        service_id="2",
+        platform_uuid="p",
+        token="token",
+        prefetched=replace(prefetched, data=prefetched.data.iloc[:hours]),
+    )
+
+
+def test_reuse_model(prefetched):
+    metric = make_metric(prefetched, 24 * 29).forecast(timeout=10)
+    artifact = metric.model_artifact()
+    assert metric.reused is False
+
+    # Data that follows the same pattern
+    reused = make_metric(prefetched, 24 * 30).forecast(previous_model=artifact)
+    assert reused.reused is True
+    assert reused.reg is artifact.model
+    assert len(reused.forecast_values) > 0
+
+    # Too old model
+    with patch("predictive_capacity.forecast.metric.auto_ml") as mock_auto_ml:
+        mock_auto_ml.return_value = (artifact.model, 0)
+        retrained = make_metric(prefetched, 24 * 30).forecast(
+            previous_model=artifact, max_age=pd.Timedelta(0)
+        )
+    assert retrained.reused is False
+    mock_auto_ml.assert_called_once()
+
+    # Prediction intervals fitted on the new data for the reused model
+    with patch("predictive_capacity.forecast.metric.ML_PREDICTION_INTERVALS", True):
+        reused = make_metric(prefetched, 24 * 30).forecast(previous_model=artifact)
+    result = reused.calculate_days_until_full().to_dict(uuid="uuid")
+    assert result.forecast_lower is not None and result.forecast_upper is not None
+    assert len(result.forecast_lower) == len(result.forecast) > 0
+
+
+@pytest.mark.parametrize("gbm_type", ["lgbm", "hgbr"])
+@pytest.mark.parametrize("directory", [False, True], ids=["s3", "local"])
+@mock_aws
+def test_save_and_load_model(gbm_type, directory, tmp_path):
+    from sklearn.preprocessing import MinMaxScaler
+
+    from predictive_capacity import ML_RESULTS_BUCKET, s3
+    from predictive_capacity.forecast.models import MutliGBMTunedDetrended
+    from predictive_capacity.forecast.registry import (
+        ModelArtifact,
+        load_model,
+        save_model,
+    )
+
+    directory = str(tmp_path) if directory else ""
+    s3.meta.client.create_bucket(Bucket=ML_RESULTS_BUCKET)
+    assert load_model("uuid", directory=directory) is None
+
+    params = {
+        "lgbm": {
+            "objective": "quantile",
+            "alpha": 0.5,
+            "learning_rate": 0.1,
+            "n_estimators": 50,
+            "reg_alpha": 0.0,
+            "reg_lambda": 0.0,
+        },
+        "hgbr": {
+            "learning_rate": 0.1,
+            "max_iter": 50,
+            "quantile": 0.5,
+            "loss": "quantile",
+        },
+    }[gbm_type]
+    trial = {
+        "gbm_type": gbm_type,
+        **params,
+        "poly_degree": 1,
+        "trend_model": "huber",
+        "huber_eps": 1.35,
+        "damped": 0.5,
+    }
+    X = np.column_stack([np.linspace(0, 1, 200), np.tile(np.arange(24), 9)[:200]])
+    y = X[:, 0] + 0.1 * np.sin(X[:, 1])
+    model = MutliGBMTunedDetrended(
+        n_trials=1, n_splits=2, warm_start_trials=[{"params": trial}]
+    ).fit(X, y)
+    assert model.best_gbm_low is None
+    model.fit_intervals()
+    artifact = ModelArtifact(
+        model=model,
+        features=["timestamp", "hour"],
+        time_scaler=MinMaxScaler().fit(X),
+        maximum_allowed=1.0,
+        best_value=model.study.best_value,
+        trained_until=pd.Timestamp("2024-01-01"),
+        trained_at=pd.Timestamp.now(tz="UTC"),
+    )
+    save_model("uuid", artifact, directory=directory)
+
+    loaded = load_model("uuid", directory=directory)
+    assert loaded is not None
+    assert loaded.features == ["timestamp", "hour"]
+    assert loaded.trained_until == artifact.trained_until
+    assert loaded.model.confidence_level == model.confidence_level
+    np.testing.assert_allclose(loaded.model.predict(X), model.predict(X))
+    np.testing.assert_allclose(loaded.model.predict_low(X), model.predict_low(X))
+    np.testing.assert_allclose(loaded.time_scaler.transform(X), X / X.max(axis=0))
+
+    with patch("predictive_capacity.forecast.registry.__version__", "0.0.0"):
+        assert load_model("uuid", directory=directory) is None
@@ -0,0 +1,101 @@
+from decimal import Decimal
+from unittest.mock import patch
+
+import pytest
+
+
+def test_training_history_from_metadata():
+    from predictive_capacity.forecast.scheduler import TrainingHistory
+
+    assert TrainingHistory.from_metadata(None) == TrainingHistory()
+    history = TrainingHistory.from_metadata(
+        {
+            "confidence_level": Decimal(1),
+            "history_length": Decimal(2000),
+            "training_time": Decimal("12.5"),
+            "saturation_3_months": {
+                "current_saturation": Decimal("0.5"),
+                "forecast": Decimal("0.75"),
+            },
+        }
+    )
+    assert history == TrainingHistory(
+        history_length=2000,
+        confidence_level=1,
+        training_time=12.5,
+        growth=0.25,
+        forecast=True,
+    )
+    history = TrainingHistory.from_metadata(
+        {
+            "days_to_full": Decimal(12),
+            "current_saturation": Decimal("0.8"),
+            "forecast_at": Decimal(1700000000),
+        }
+    )
+    assert (history.days_to_full, history.current_saturation) == (12, 0.8)
+    assert history.forecast_at == 1700000000
+
+
+def test_priority_order():
+    from predictive_capacity.forecast.scheduler import (
+        TrainingHistory,
+        priority_order,
+        training_priority,
+    )
+
+    now = 1700000000
+    day = 86400
+    histories = [
+        # Fresh forecasts, far from saturation
+        TrainingHistory(forecast=True, days_to_full=300, forecast_at=now),
+        TrainingHistory(forecast=True, current_saturation=0.2, forecast_at=now),
+        # Full in 5 days
+        TrainingHistory(forecast=True, days_to_full=5, forecast_at=now - day),
+        # Never forecast
+        TrainingHistory(),
+        # Not forecast for a week
+        TrainingHistory(forecast=True, days_to_full=300, forecast_at=now - 7 * day),
+    ]
+    priorities = [training_priority(history, now) for history in histories]
+    assert priorities[1] < priorities[0] < priorities[4] < priorities[3]
+    assert priorities[0] < priorities[2]
+    with patch("predictive_capacity.forecast.scheduler.time.time", return_value=now):
+        assert priority_order(histories) == [3, 4, 2, 0, 1]
+
+
+def test_training_weight():
+    from predictive_capacity.forecast.scheduler import TrainingHistory, training_weight
+
+    confident = training_weight(TrainingHistory(1000, 2), 1000)
+    assert training_weight(TrainingHistory(1000, 0), 1000) > confident
+    assert training_weight(TrainingHistory(100, 2), 1000) < confident
+    assert training_weight(TrainingHistory(1000, 2, growth=0.5), 1000) > confident
+
+
+def test_allocate_budget():
+    from predictive_capacity.forecast.scheduler import allocate_budget
+
+    timeouts = allocate_budget(
+        [1, 1, 2], capacity=400, max_timeouts=[50, 600, 600], min_timeout=10
+    )
+    assert timeouts == pytest.approx([50, 350 / 3, 700 / 3])
+    assert allocate_budget([1, 2], 10, [600, 600], min_timeout=30) == [30, 30]
+
+
+def test_scheduler_rescales_to_time_left():
+    from predictive_capacity.forecast.scheduler import (
+        TrainingHistory,
+        TrainingScheduler,
+    )
+
+    histories = [TrainingHistory(), TrainingHistory(training_time=5), TrainingHistory()]
+    scheduler = TrainingScheduler(
+        histories, budget=300, n_workers=2, max_timeout=600, min_timeout=10
+    )
+    assert scheduler.max_timeouts == [600, 10, 600]
+    assert scheduler.timeout(0) == pytest.approx(295, abs=1)
+    # Half of the budget was spent on the first metric
+    scheduler.deadline -= 150
+    assert scheduler.timeout(1) == 10
+    assert scheduler.timeout(2) == pytest.approx(150 * 2, abs=1)
@@ -0,0 +1,46 @@
+import json
+
+import optuna
+from moto import mock_aws
+
+
+@mock_aws
+def test_save_and_load_trials():
+    from predictive_capacity import ML_RESULTS_BUCKET, s3
+    from predictive_capacity.forecast.trials import load_trials, save_trials
+
+    s3.meta.client.create_bucket(Bucket=ML_RESULTS_BUCKET)
+    assert load_trials("uuid") == []
+
+    study = optuna.create_study()
+    for x, value in [(1, 0.3), (2, 0.1), (3, 0.2)]:
+        study.add_trial(
+            optuna.trial.create_trial(
+                params={"x": x},
+                distributions={"x": optuna.distributions.IntDistribution(0, 10)},
+                value=value,
+            )
+        )
+    save_trials("uuid", study, top_k=2)
+
+    assert load_trials("uuid") == [
+        {"params": {"x": 2}, "value": 0.1},
+        {"params": {"x": 3}, "value": 0.2},
+    ]
+
+
+@mock_aws
+def test_load_trials_of_incompatible_version():
+    from predictive_capacity import ML_RESULTS_BUCKET, s3
+    from predictive_capacity.forecast.trials import load_trials, trials_key
+
+    s3.meta.client.create_bucket(Bucket=ML_RESULTS_BUCKET)
+    s3.meta.client.put_object(
+        Bucket=ML_RESULTS_BUCKET,
+        Key=trials_key("uuid"),
+        Body=json.dumps(
+            {"version": "0.0.1", "trials": [{"params": {"x": 2}, "value": 0.1}]}
+        ),
+    )
+
+    assert load_trials("uuid") == []
@@ -56,6 +56,15 @@ DASHBOARD_EXPECTED = [
 ]
 
 
+@pytest.fixture
+def dashboard_cache():
+    from predictive_capacity.dashboard import DashboardCache
+
+    cache = DashboardCache()
+    with patch("predictive_capacity.api.dashboard_cache", cache):
+        yield cache
+
+
 @pytest.mark.parametrize(
     ids=["Success", "Missing data"],
     argnames=["status_code", "items", "expected"],
@@ -65,7 +74,9 @@ DASHBOARD_EXPECTED = [
     ],
 )
 @mock_aws
-def test_read_dashboard(status_code: int, items: dict, expected: dict, client):
+def test_read_dashboard(
+    status_code: int, items: dict, expected: dict, dashboard_cache, client
+):
     from predictive_capacity.upload import ML_RESULTS_TABLE, create_dynamodb_table
 
     create_dynamodb_table(ML_RESULTS_TABLE)
@@ -78,19 +89,95 @@ def test_read_dashboard(status_code: int, items: dict, expected: dict, client):
     assert result.json() == expected
 
 
+def put_dashboard_items(days_to_full: list) -> None:
+    from predictive_capacity.upload import ML_RESULTS_TABLE
+
+    table = boto3.resource("dynamodb").Table(ML_RESULTS_TABLE)
+    for i, days in enumerate(days_to_full):
+        item = {
+            **DYNAMODB_ITEM,
+            "source#host_id#service_id": f"source#{i}#1",
+            "host_name": f"host{i}",
+            "days_to_full": days,
+            "uuid": f"uuid{i}",
+        }
+        table.put_item(Item=json.loads(json.dumps(item), parse_float=Decimal))
+
+
+@mock_aws
+def test_read_dashboard_pages(job_queue, dashboard_cache, client):
+    from predictive_capacity.upload import ML_RESULTS_TABLE, create_dynamodb_table
+
+    create_dynamodb_table(ML_RESULTS_TABLE)
+    put_dashboard_items([30, None, 10, 20, 10])
+
+    uuids, cursor = [], None
+    while True:
+        params = {"limit": 2, "sort": "days_to_full", "order": "desc"}
+        if cursor is not None:
+            params["cursor"] = cursor
+        result = client.get("/metrics", params=params)
+        assert result.status_code == 200
+        assert result.headers["X-Total-Count"] == "5"
+        uuids.extend(row["uuid"] for row in result.json())
+        cursor = result.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert uuids == ["uuid1", "uuid0", "uuid3", "uuid4", "uuid2"]
+
+    result = client.get(
+        "/metrics", params={"max_days_to_full": 20, "sort": "days_to_full"}
+    )
+    assert [row["uuid"] for row in result.json()] == ["uuid2", "uuid4", "uuid3"]
+    assert "X-Next-Cursor" not in result.headers
+    result = client.get("/metrics", params={"search": "HOST1"})
+    assert [row["uuid"] for row in result.json()] == ["uuid1"]
+
+    result = client.get("/metrics", params={"limit": 2, "cursor": "invalid"})
+    assert result.status_code == 400
+    assert result.json() == {"detail": "Invalid cursor"}
+
+
+@mock_aws
+def test_read_dashboard_cache(job_queue, dashboard_cache, client):
+    from predictive_capacity.upload import ML_RESULTS_TABLE, create_dynamodb_table
+
+    create_dynamodb_table(ML_RESULTS_TABLE)
+    put_dashboard_items([10])
+    assert len(client.get("/metrics").json()) == 1
+
+    # Served from the cache until a run uploads forecasts
+    put_dashboard_items([10, 20])
+    assert len(client.get("/metrics").json()) == 1
+    job, _ = job_queue.enqueue("test")
+    job_queue.claim("worker")
+    job_queue.update_progress(job.job_id, done=1, failed=0)
+    assert len(client.get("/metrics").json()) == 2
+
+
 S3_OBJECT = {
     "data_scaled": [1, 2, 3],
-    "data_dates": ["2021-01-01", "2021-01-02", "2021-01-03"],
+    "data_dates": ["2021-01-01 00:00:00", "2021-01-02 00:00:00", "2021-01-03 00:00:00"],
     "forecast": [4, 5, 6],
-    "forecast_dates": ["2021-01-04", "2021-01-05", "2021-01-06"],
+    "forecast_dates": [
+        "2021-01-04 00:00:00",
+        "2021-01-05 00:00:00",
+        "2021-01-06 00:00:00",
+    ],
+}
+S3_OBJECT_INTERVALS = {
+    **S3_OBJECT,
+    "forecast_lower": [3, 4, 5],
+    "forecast_upper": [5, 6, 7],
 }
 
 
 @pytest.mark.parametrize(
-    ids=["Success", "No such key"],
+    ids=["Success", "With intervals", "No such key"],
     argnames=["status_code", "uuid", "detail"],
     argvalues=[
         (200, "test_uuid", S3_OBJECT),
+        (200, "test_uuid_intervals", S3_OBJECT_INTERVALS),
         (404, "wrong_uuid", {"detail": "No prediction found"}),
     ],
 )
@@ -103,81 +190,209 @@ def test_read_predictions(status_code: int, uuid: str, detail: dict, client):
     s3.put_object(
         Bucket=ML_RESULTS_BUCKET, Key="test_uuid.json", Body=json.dumps(S3_OBJECT)
     )
+    s3.put_object(
+        Bucket=ML_RESULTS_BUCKET,
+        Key="test_uuid_intervals.json",
+        Body=json.dumps(S3_OBJECT_INTERVALS),
+    )
     result = client.get(f"/predictions/{uuid}")
     assert result.status_code == status_code
     assert result.json() == detail
 
 
-@pytest.fixture
-def dict_metric() -> dict:
-    """Create a fake response to retrieve forecast
-
-    Since we use BaseModel to validate the response, we need to ensure that the
-    response is valid. Unfortunately, we cannot use the MetricBase as a yield"""
-    response = {
-        "metric_name": "test:forecast",
-        "host_name": "host_name",
-        "host_id": "123",
-        "service_id": "123",
-        "service_name": "service_name",
-        "data_scaled": [],
-        "data_dates": [],
-        "forecast": [],
-        "forecast_dates": [],
-        "days_to_full": None,
-        "current_saturation": 0.0,
-        "saturation_3_months": {"current_saturation": 0.0, "forecast": 0.0},
-        "saturation_6_months": {"current_saturation": 0.0, "forecast": 0.0},
-        "saturation_12_months": {"current_saturation": 0.0, "forecast": 0.0},
-        "confidence_level": 0,
-        "uuid": "00000000-0000-0000-0000-000000000000",
+@mock_aws
+def test_read_predictions_compact(client):
+    from predictive_capacity.predictions import (
+        PREDICTION_MEDIA_TYPE,
+        decode_prediction,
+        encode_prediction,
+        from_prediction,
+    )
+    from predictive_capacity.schemas import Prediction
+    from predictive_capacity.upload import ML_RESULTS_BUCKET, create_s3_bucket
+
+    create_s3_bucket(ML_RESULTS_BUCKET)
+    dates = [f"2021-01-{day:02} 00:00:00" for day in range(1, 31)]
+    prediction = Prediction(
+        data_scaled=[float(day % 7) for day in range(30)],
+        data_dates=dates,
+        forecast=[float(day) for day in range(30)],
+        forecast_dates=dates,
+    )
+    boto3.client("s3").put_object(
+        Bucket=ML_RESULTS_BUCKET,
+        Key="test_uuid.bin",
+        Body=encode_prediction(from_prediction(prediction)),
+    )
+
+    result = client.get("/predictions/test_uuid")
+    assert result.status_code == 200
+    assert result.json() == prediction.model_dump(exclude_none=True)
+
+    result = client.get("/predictions/test_uuid", params={"points": 10})
+    assert len(result.json()["data_scaled"]) == len(result.json()["data_dates"]) == 10
+    assert result.json()["forecast_dates"][-1] == dates[-1]
+
+    result = client.get(
+        "/predictions/test_uuid", headers={"Accept": PREDICTION_MEDIA_TYPE}
+    )
+    assert result.headers["content-type"] == PREDICTION_MEDIA_TYPE
+    arrays = decode_prediction(result.content)
+    assert arrays.keys() == from_prediction(prediction).keys()
+
+
+@mock_aws
+def test_read_predictions_etag(client):
+    from predictive_capacity.predictions import (
+        PREDICTION_MEDIA_TYPE,
+        PredictionCache,
+        encode_prediction,
+        from_prediction,
+    )
+    from predictive_capacity.schemas import Prediction
+    from predictive_capacity.upload import ML_RESULTS_BUCKET, create_s3_bucket
+
+    create_s3_bucket(ML_RESULTS_BUCKET)
+    body = encode_prediction(from_prediction(Prediction(**S3_OBJECT)))
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=ML_RESULTS_BUCKET, Key="test_uuid.bin", Body=body)
+    binary = {"Accept": PREDICTION_MEDIA_TYPE}
+
+    with patch("predictive_capacity.api.prediction_cache", PredictionCache()):
+        # Streamed from S3 as stored, then served from the cache
+        for _ in range(2):
+            result = client.get("/predictions/test_uuid", headers=binary)
+            assert result.status_code == 200
+            assert result.content == body
+            assert result.headers["cache-control"] == "no-cache"
+        etag = result.headers["etag"]
+
+        result = client.get(
+            "/predictions/test_uuid", headers={**binary, "If-None-Match": etag}
+        )
+        assert result.status_code == 304
+        assert result.content == b""
+        assert result.headers["etag"] == etag
+
+        # Each representation has its own ETag
+        result = client.get("/predictions/test_uuid", headers={"If-None-Match": etag})
+        assert result.status_code == 200
+        assert result.headers["etag"] != etag
+        result = client.get(
+            "/predictions/test_uuid",
+            params={"points": 4},
+            headers={"If-None-Match": result.headers["etag"]},
+        )
+        assert result.status_code == 200
+
+        s3.put_object(Bucket=ML_RESULTS_BUCKET, Key="test_uuid.bin", Body=body[:-1])
+        result = client.get(
+            "/predictions/test_uuid", headers={**binary, "If-None-Match": etag}
+        )
+        assert result.status_code == 200
+        assert result.content == body[:-1]
+
+
+@mock_aws
+def test_read_predictions_batch(client):
+    from predictive_capacity.predictions import encode_prediction, from_prediction
+    from predictive_capacity.schemas import Prediction
+    from predictive_capacity.upload import ML_RESULTS_BUCKET, create_s3_bucket
+
+    create_s3_bucket(ML_RESULTS_BUCKET)
+    s3 = boto3.client("s3")
+    s3.put_object(
+        Bucket=ML_RESULTS_BUCKET,
+        Key="test_uuid.bin",
+        Body=encode_prediction(from_prediction(Prediction(**S3_OBJECT))),
+    )
+    s3.put_object(
+        Bucket=ML_RESULTS_BUCKET,
+        Key="test_uuid_intervals.json",
+        Body=json.dumps(S3_OBJECT_INTERVALS),
+    )
+    uuids = ["test_uuid", "test_uuid_intervals", "wrong_uuid", "test_uuid"]
+
+    result = client.post("/predictions:batch", json={"uuids": uuids})
+    assert result.status_code == 200
+    assert result.headers["content-type"] == "application/x-ndjson"
+    lines = {line["uuid"]: line for line in map(json.loads, result.iter_lines())}
+    assert lines == {
+        "test_uuid": {"uuid": "test_uuid", **S3_OBJECT},
+        "test_uuid_intervals": {"uuid": "test_uuid_intervals", **S3_OBJECT_INTERVALS},
+        "wrong_uuid": {"uuid": "wrong_uuid", "error": "No prediction found"},
     }
-    return response
 
+    result = client.post(
+        "/predictions:batch", json={"uuids": uuids[:2], "step": 2 * 86400}
+    )
+    for line in map(json.loads, result.iter_lines()):
+        assert line["data_dates"] == ["2021-01-01 00:00:00", "2021-01-03 00:00:00"]
+        assert line["data_scaled"] == [1.5, 3]
+        assert line["forecast_dates"] == ["2021-01-03 00:00:00", "2021-01-05 00:00:00"]
+        assert line["forecast"] == [4, 5.5]
 
-@pytest.fixture
-def failure(*args, **kwargs):
-    raise Exception("Failure")
+    result = client.post(
+        "/predictions:batch", json={"uuids": uuids, "points": 4, "step": 3600}
+    )
+    assert result.status_code == 422
+    result = client.post("/predictions:batch", json={"uuids": []})
+    assert result.status_code == 422
 
 
 @pytest.fixture
-def find_set_metrics_empty():
-    yield []
+def job_queue(tmp_path):
+    from predictive_capacity.jobs import JobQueue
 
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    with patch("predictive_capacity.api.job_queue", queue):
+        yield queue
 
-@pytest.fixture
-def find_set_metrics(dict_metric):
-    yield [dict_metric]
+
+def test_forecast(job_queue, client):
+    response = client.post("/forecast", params={"forecasting_horizon": 24})
+    assert response.status_code == 202
+    job = response.json()
+    assert job["status"] == "queued"
+    assert job["organization"] == "test"
+    assert job["forecasting_horizon"] == 24
+
+    # Only one run per organization
+    duplicate = client.post("/forecast")
+    assert duplicate.status_code == 200
+    assert duplicate.json()["job_id"] == job["job_id"]
+    other = client.post("/forecast", params={"organization": "other"})
+    assert other.status_code == 202
+    assert other.json()["job_id"] != job["job_id"]
+
+
+def test_read_forecast_job(job_queue, client):
+    job, _ = job_queue.enqueue("test")
+    job_queue.claim("worker")
+    job_queue.update_progress(job.job_id, done=2, failed=1, total=10)
+
+    response = client.get(f"/forecast/{job.job_id}")
+    assert response.status_code == 200
+    assert response.json()["status"] == "running"
+    assert (response.json()["done"], response.json()["total"]) == (2, 10)
+    assert client.get("/forecast/wrong_id").status_code == 404
 
 
-@pytest.mark.parametrize(
-    "set_metrics, status, expected",
-    [
-        ("failure", 500, "Failed to get Warp10 data with error Failure"),
-        ("find_set_metrics_empty", 404, "No metrics found"),
-        ("find_set_metrics", 202, None),
-    ],
-    ids=["warp10_error", "no_metrics", "metrics"],
-)
-@patch("predictive_capacity.api.make_forecasts")
-@patch("predictive_capacity.api.find_set_metrics")
 @mock_aws
-def test_forecast(
-    mock_find_set_metrics,
-    mock_make_forecasts,
-    set_metrics,
-    status,
-    expected,
-    request,
-    client,
-):
-    mock_find_set_metrics.side_effect = lambda *args, **kwargs: request.getfixturevalue(
-        set_metrics
-    )
-    response = client.post("/forecast")
-    assert response.status_code == status
-    if status == 202:
-        assert mock_make_forecasts.called
-        assert response.text == ""
-    else:
-        assert response.text == f'{{"detail":"{expected}"}}'
+def test_read_internal_metrics(job_queue, client):
+    from predictive_capacity.upload import ML_RESULTS_BUCKET, create_s3_bucket
+
+    create_s3_bucket(ML_RESULTS_BUCKET)
+    client.get("/predictions/wrong_uuid")
+    response = client.get("/metrics_internal")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert (
+        'predictive_capacity_http_request_duration_seconds_count{method="GET",'
+        'route="/predictions/{uuid}",status="404"}'
+    ) in response.text
+    assert (
+        'predictive_capacity_aws_call_errors_total{service="s3",'
+        'operation="GetObject"}'
+    ) in response.text
+    assert 'predictive_capacity_jobs{status="queued"} 0.0' in response.text
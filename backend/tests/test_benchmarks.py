@@ -0,0 +1,17 @@
+import json
+
+
+def test_benchmarks(tmp_path, capsys):
+    from benchmarks.run import BENCHMARKS, main
+
+    output = tmp_path / "results.jsonl"
+    args = ["--lengths", "1000", "--trials", "1", "--repeat", "1", "--horizon", "9000"]
+    main([*args, "--output", str(output)])
+    main([*args, "--benchmarks", "to_dict", "--baseline", str(output)])
+
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [r["benchmark"] for r in results] == [b.name for b in BENCHMARKS]
+    assert all(r["length"] == 1000 and r["wall_median_s"] > 0 for r in results)
+    out, err = capsys.readouterr()
+    assert json.loads(out)["benchmark"] == "to_dict"
+    assert "to_dict" in err.splitlines()[-1]
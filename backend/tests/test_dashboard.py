@@ -0,0 +1,111 @@
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from predictive_capacity.dashboard import (
+    DashboardCache,
+    dashboard_item,
+    load_dashboard,
+    paginate,
+    to_native,
+)
+
+ITEM = {
+    "class": "metric",
+    "source#host_id#service_id": "source#1#2",
+    "uuid": "uuid",
+    "host_name": "host",
+    "service_name": "service",
+    "days_to_full": Decimal("10"),
+    "current_saturation": Decimal("0.5"),
+    "saturation_3_months": {
+        "current_saturation": Decimal("0.5"),
+        "forecast": Decimal("0.7"),
+    },
+    "saturation_6_months": {
+        "current_saturation": Decimal("0.5"),
+        "forecast": Decimal("0.7"),
+    },
+    "saturation_12_months": {
+        "current_saturation": Decimal("0.5"),
+        "forecast": Decimal("0.7"),
+    },
+    "confidence_level": Decimal("2"),
+}
+
+
+def test_to_native():
+    converted = to_native({"a": [Decimal("1"), Decimal("1.5")], "b": "c"})
+    assert converted == {"a": [1, 1.5], "b": "c"}
+    assert isinstance(converted["a"][0], int)
+
+
+def test_dashboard_item():
+    row = dashboard_item(ITEM)
+    assert (row.metric_name, row.host_id, row.service_id) == ("metric", "1", "2")
+    assert row.days_to_full == 10
+    assert row.current_saturation == 0.5
+
+
+@patch("predictive_capacity.dashboard.dynamodb")
+def test_load_dashboard_follows_pages(mock_dynamodb: MagicMock):
+    table = mock_dynamodb.Table.return_value
+    table.query.side_effect = [
+        {"Items": [ITEM], "LastEvaluatedKey": {"uuid": "uuid"}},
+        {"Items": [{**ITEM, "uuid": "uuid2"}]},
+    ]
+    dashboard = load_dashboard("source")
+    assert [row.uuid for row in dashboard] == ["uuid", "uuid2"]
+    assert table.query.call_args.kwargs["ExclusiveStartKey"] == {"uuid": "uuid"}
+
+
+def test_dashboard_cache():
+    loader = MagicMock(return_value=[])
+    cache = DashboardCache(loader, ttl=60)
+    cache.get("org", version=1)
+    cache.get("org", version=1)
+    assert loader.call_count == 1
+    cache.get("org", version=2)
+    assert loader.call_count == 2
+    assert cache.peek("org", version=2) == []
+    assert cache.peek("org", version=1) is None
+    cache.invalidate("org")
+    assert cache.peek("org", version=2) is None
+    cache.get("org", version=2)
+    assert loader.call_count == 3
+    DashboardCache(loader, ttl=0).get("org")
+    assert loader.call_count == 4
+
+
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_paginate(order):
+    dashboard = [
+        dashboard_item({**ITEM, "uuid": f"uuid{i}", "days_to_full": days})
+        for i, days in enumerate([3, None, 1, 2, 1])
+    ]
+    expected = ["uuid2", "uuid4", "uuid3", "uuid0", "uuid1"]
+    if order == "desc":
+        expected = expected[::-1]
+
+    page, cursor = paginate(dashboard, "days_to_full", order)
+    assert [row.uuid for row in page] == expected
+    assert cursor is None
+
+    uuids, cursor = [], None
+    while True:
+        page, cursor = paginate(dashboard, "days_to_full", order, 2, cursor)
+        uuids.extend(row.uuid for row in page)
+        if cursor is None:
+            break
+    assert uuids == expected
+
+    # Rows added between two pages do not shift the next ones
+    page, cursor = paginate(dashboard, "days_to_full", order, 2)
+    dashboard.append(dashboard_item({**ITEM, "uuid": "new", "days_to_full": 0}))
+    page, _ = paginate(dashboard, "days_to_full", order, 10, cursor)
+    remaining = expected[2:] if order == "asc" else expected[2:] + ["new"]
+    assert [row.uuid for row in page] == remaining
+
+    with pytest.raises(ValueError):
+        paginate(dashboard, "host_name", order, 2, cursor)
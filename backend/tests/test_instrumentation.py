@@ -0,0 +1,63 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from predictive_capacity.instrumentation import collect_spans, span, summarize_spans
+
+
+def test_span_is_collected_with_context():
+    with collect_spans(metric="cpu") as spans:
+        with span("search", n_jobs=2) as attributes:
+            attributes["trials"] = 10
+    # Spans outside of a collector are not collected
+    with span("outside"):
+        pass
+
+    assert len(spans) == 1
+    record = spans[0]
+    assert record["name"] == "search"
+    assert record["end_time_unix_nano"] >= record["start_time_unix_nano"]
+    attributes = record["attributes"]
+    assert attributes["metric"] == "cpu"
+    assert attributes["n_jobs"] == 2
+    assert attributes["trials"] == 10
+    assert attributes["wall_s"] >= 0
+    assert attributes["cpu_s"] >= 0
+    assert attributes["max_rss_mb"] > 0
+
+
+def test_span_records_errors():
+    with collect_spans() as spans:
+        with pytest.raises(ValueError):
+            with span("predict"):
+                raise ValueError("boom")
+    assert spans[0]["attributes"]["error"] == "ValueError"
+
+
+def test_spans_are_written_as_json_lines(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    with patch("predictive_capacity.instrumentation.ML_SPANS_FILE", str(path)):
+        with span("s3_upload"), span("dynamodb_put"):
+            pass
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [record["name"] for record in records] == ["dynamodb_put", "s3_upload"]
+
+
+def test_summarize_spans():
+    def record(name, wall_s):
+        return {
+            "name": name,
+            "attributes": {"wall_s": wall_s, "cpu_s": wall_s, "max_rss_mb": 100},
+        }
+
+    summary = summarize_spans(
+        [record("search", 8.0), record("predict", 1.0), record("search", 1.0)]
+    )
+    assert [stage["stage"] for stage in summary] == ["search", "predict"]
+    assert summary[0]["count"] == 2
+    assert summary[0]["wall_s"] == 9.0
+    assert summary[0]["mean_wall_s"] == 4.5
+    assert summary[0]["max_wall_s"] == 8.0
+    assert summary[0]["share"] == pytest.approx(0.9)
+    assert summarize_spans([]) == []
@@ -0,0 +1,110 @@
+from unittest.mock import patch
+
+import pytest
+
+
+@pytest.fixture
+def queue(tmp_path):
+    from predictive_capacity.jobs import JobQueue
+
+    return JobQueue(str(tmp_path / "jobs" / "jobs.sqlite"), stale_after=60)
+
+
+def test_enqueue_one_job_per_organization(queue):
+    job, created = queue.enqueue("firm", forecasting_horizon=24, retrain=False)
+    assert created
+    assert (job.status, job.forecasting_horizon, job.retrain) == ("queued", 24, False)
+
+    duplicate, created = queue.enqueue("firm")
+    assert not created
+    assert duplicate.job_id == job.job_id
+
+    # Still a single job once it runs
+    queue.claim("worker")
+    assert queue.enqueue("firm")[0].job_id == job.job_id
+
+    # A new run can be queued once the previous one is over
+    queue.finish(job.job_id)
+    new_job, created = queue.enqueue("firm")
+    assert created
+    assert new_job.job_id != job.job_id
+
+
+def test_claim_oldest_job(queue):
+    first, _ = queue.enqueue("first")
+    second, _ = queue.enqueue("second")
+
+    claimed = queue.claim("worker")
+    assert claimed.job_id == first.job_id
+    assert claimed.status == "running"
+    assert claimed.started_at is not None
+    assert queue.claim("worker").job_id == second.job_id
+    assert queue.claim("worker") is None
+    assert queue.count_by_status() == {"running": 2}
+
+
+def test_progress_and_finish(queue):
+    job, _ = queue.enqueue("firm")
+    queue.claim("worker")
+    queue.update_progress(job.job_id, 0, 0, total=3)
+    queue.update_progress(job.job_id, 2, 1)
+    job = queue.get(job.job_id)
+    assert (job.total, job.done, job.failed) == (3, 2, 1)
+
+    queue.finish(job.job_id, error="Warp10 timeout")
+    job = queue.get(job.job_id)
+    assert (job.status, job.error) == ("failed", "Warp10 timeout")
+    assert job.finished_at is not None
+    assert queue.get("wrong_id") is None
+
+
+def test_requeue_stale_job(queue):
+    job, _ = queue.enqueue("firm")
+    with patch("predictive_capacity.jobs.time.time", return_value=0):
+        queue.claim("dead worker")
+    # No heartbeat since, the job is claimed again by another worker
+    claimed = queue.claim("worker")
+    assert claimed.job_id == job.job_id
+    assert claimed.status == "running"
+
+
+def test_run_ledger(queue):
+    from predictive_capacity.jobs import RunLedger
+    from predictive_capacity.schemas import ResponseFindSetMetrics
+
+    items = [
+        ResponseFindSetMetrics(
+            metric=f"metric{i}", host_id="1", service_id="1", platform_uuid="0000"
+        )
+        for i in range(3)
+    ]
+    job, _ = queue.enqueue("firm")
+    ledger = RunLedger(queue.path, job.job_id, max_attempts=2, backoff=60)
+    ledger.start(items)
+    assert ledger.due(items) == (items, None)
+
+    ledger.record(items[0], "uploaded")
+    ledger.record(items[1], "trained")
+    with patch("predictive_capacity.jobs.time.time", return_value=1000):
+        ledger.record(items[2], "failed", "Warp10 timeout")
+    assert ledger.states()["0000#1#1#metric2"]["error"] == "Warp10 timeout"
+    assert ledger.progress() == (2, 1)
+
+    # The failed metric is retried once its backoff is over
+    with patch("predictive_capacity.jobs.time.time", return_value=1030):
+        assert ledger.due(items) == ([items[1]], 30)
+    with patch("predictive_capacity.jobs.time.time", return_value=1060):
+        assert ledger.due(items) == ([items[1], items[2]], None)
+        ledger.record(items[2], "failed", "Warp10 timeout")
+    # Backoff doubled, but no attempt left
+    assert ledger.states()["0000#1#1#metric2"]["next_attempt_at"] == 1060 + 120
+    assert ledger.due(items) == ([items[1]], None)
+
+    # A run following a failed run skips its uploaded metrics
+    queue.claim("worker")
+    queue.finish(job.job_id, error="Crashed")
+    new_job, _ = queue.enqueue("firm")
+    assert new_job.resumes == job.job_id
+    new_ledger = RunLedger(queue.path, new_job.job_id, resumes=new_job.resumes)
+    new_ledger.start(items)
+    assert new_ledger.due(items) == (items[1:], None)
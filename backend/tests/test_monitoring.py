@@ -0,0 +1,90 @@
+import pytest
+
+from predictive_capacity.monitoring import Counter, Gauge, Histogram, Registry
+
+
+def test_render_counter_and_gauge():
+    registry = Registry()
+    counter = Counter("requests_total", "Requests.", ("route",), registry=registry)
+    gauge = Gauge("pending", "Pending.", registry=registry)
+    counter.inc(route='/a"b')
+    counter.inc(2, route='/a"b')
+    gauge.inc(5)
+    gauge.dec(2)
+
+    assert registry.render() == (
+        "# HELP requests_total Requests.\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{route="/a\\"b"} 3.0\n'
+        "# HELP pending Pending.\n"
+        "# TYPE pending gauge\n"
+        "pending 3.0\n"
+    )
+    with pytest.raises(ValueError):
+        counter.inc(-1, route="/a")
+    with pytest.raises(ValueError):
+        counter.inc(stage="/a")
+    with pytest.raises(ValueError):
+        registry.register(Gauge("pending", "Pending.", registry=None))
+
+
+def test_render_histogram():
+    registry = Registry()
+    histogram = Histogram(
+        "latency_seconds", "Latency.", ("stage",), buckets=(1.0, 0.1), registry=registry
+    )
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, stage="search")
+
+    assert histogram.count(stage="search") == 4
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{stage="search",le="0.1"} 2.0',
+        'latency_seconds_bucket{stage="search",le="1.0"} 3.0',
+        'latency_seconds_bucket{stage="search",le="+Inf"} 4.0',
+        'latency_seconds_count{stage="search"} 4.0',
+        'latency_seconds_sum{stage="search"} 3.65',
+    ]
+
+
+def test_run_monitor():
+    from predictive_capacity.monitoring import (
+        FORECASTS,
+        PENDING_FORECASTS,
+        RUN_METRICS,
+        STAGE_ERRORS,
+        STAGE_SECONDS,
+        RunMonitor,
+    )
+    from predictive_capacity.schemas import ForecastOutcome, ResponseFindSetMetrics
+
+    metric = ResponseFindSetMetrics(
+        metric="cpu", host_id="1", service_id="1", platform_uuid="0000"
+    )
+    span = {"name": "monitor_test", "attributes": {"wall_s": 0.5, "error": "KeyError"}}
+    with RunMonitor("monitor_test", 3) as monitor:
+        assert PENDING_FORECASTS.value(organization="monitor_test") == 3
+        monitor.record(ForecastOutcome(metric=metric, uuid="uuid", spans=[span]))
+        monitor.record(ForecastOutcome(metric=metric, error="boom"))
+        assert PENDING_FORECASTS.value(organization="monitor_test") == 1
+    # The run stopped before the last metric
+    assert PENDING_FORECASTS.value(organization="monitor_test") == 0
+    assert FORECASTS.value(organization="monitor_test", status="succeeded") == 1
+    assert FORECASTS.value(organization="monitor_test", status="failed") == 1
+    assert RUN_METRICS.value(organization="monitor_test", state="done") == 2
+    assert RUN_METRICS.value(organization="monitor_test", state="failed") == 1
+    assert STAGE_SECONDS.count(stage="monitor_test") == 1
+    assert STAGE_ERRORS.value(stage="monitor_test") == 1
+
+
+def test_serve():
+    from urllib.request import urlopen
+
+    from predictive_capacity.monitoring import serve
+
+    server = serve(0)
+    try:
+        with urlopen(f"http://localhost:{server.server_port}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert "predictive_capacity_pending_forecasts" in response.read().decode()
+    finally:
+        server.shutdown()
@@ -0,0 +1,215 @@
+import json
+
+import boto3
+import numpy as np
+import pytest
+from moto import mock_aws
+
+from predictive_capacity.predictions import (
+    align,
+    decode_prediction,
+    downsample,
+    encode_prediction,
+    from_prediction,
+    lttb_indices,
+    minmax_indices,
+    shortest_floats,
+    to_json,
+)
+from predictive_capacity.schemas import Prediction
+
+
+@pytest.fixture
+def prediction() -> Prediction:
+    dates = np.arange("2024-01-01", "2024-04-01", dtype="datetime64[h]")
+    history = np.sin(np.arange(len(dates)) / 24)
+    return Prediction(
+        data_scaled=history.tolist(),
+        data_dates=[str(d).replace("T", " ") + ":00:00" for d in dates],
+        forecast=(history + 1).tolist(),
+        forecast_dates=[
+            str(d + np.timedelta64(len(dates), "h")).replace("T", " ") + ":00:00"
+            for d in dates
+        ],
+        forecast_lower=history.tolist(),
+        forecast_upper=(history + 2).tolist(),
+    )
+
+
+def test_encode_prediction(prediction):
+    body = encode_prediction(from_prediction(prediction))
+    decoded = to_json(decode_prediction(body))
+
+    assert decoded["data_dates"] == prediction.data_dates
+    assert decoded["forecast_dates"] == prediction.forecast_dates
+    for name in ("data_scaled", "forecast", "forecast_lower", "forecast_upper"):
+        np.testing.assert_allclose(decoded[name], getattr(prediction, name), atol=1e-6)
+    assert len(body) < len(prediction.model_dump_json()) / 10
+
+
+def test_encode_prediction_irregular_dates():
+    prediction = Prediction(
+        data_scaled=[0.3, float("nan")],
+        data_dates=["2024-01-01 00:00:00", "2024-01-01 01:00:00"],
+        forecast=[1.0, 2.0, 3.0],
+        forecast_dates=[
+            "2024-01-01 02:00:00",
+            "2024-01-01 03:00:00",
+            "2024-01-02 00:00:00",
+        ],
+    )
+    decoded = to_json(decode_prediction(encode_prediction(from_prediction(prediction))))
+
+    assert decoded["data_scaled"][0] == 0.3
+    assert np.isnan(decoded["data_scaled"][1])
+    assert decoded["forecast_dates"] == prediction.forecast_dates
+    assert "forecast_lower" not in decoded
+    with pytest.raises(ValueError):
+        decode_prediction(b"{}")
+
+
+def test_shortest_floats():
+    rng = np.random.default_rng(0)
+    values = np.concatenate(
+        [
+            rng.random(1000),
+            rng.normal(size=1000) * 10.0 ** rng.integers(-40, 38, 1000),
+            [0.3, -0.0, 1e-45, 3.4e38, 1e22, 1e23, np.nan, np.inf],
+        ]
+    ).astype(np.float32)
+
+    expected = [float(value) for value in values.astype(str)]
+    assert list(map(repr, shortest_floats(values))) == list(map(repr, expected))
+
+
+def test_lttb_indices():
+    y = np.zeros(1000)
+    y[500] = 10
+    indices = lttb_indices(np.arange(1000), y, 50)
+    assert len(indices) == 50
+    assert (indices[0], indices[-1]) == (0, 999)
+    assert 500 in indices
+    assert np.all(np.diff(indices) > 0)
+    assert len(lttb_indices(np.arange(10), np.zeros(10), 20)) == 10
+
+
+def test_minmax_indices():
+    y = np.random.default_rng(0).normal(size=1000)
+    indices = minmax_indices(y, 100)
+    assert len(indices) <= 102
+    assert {0, 999, int(np.argmin(y)), int(np.argmax(y))} <= set(indices)
+
+
+@pytest.mark.parametrize("method", ["lttb", "minmax"])
+def test_downsample(prediction, method):
+    arrays = downsample(from_prediction(prediction), 100, method)
+
+    assert len(arrays["data_scaled"]) == len(arrays["data_dates"]) <= 102
+    assert len(arrays["forecast"]) == len(arrays["forecast_upper"]) <= 102
+    # The bounds are kept at the dates of the forecast
+    np.testing.assert_allclose(
+        arrays["forecast_upper"] - arrays["forecast"], 1, atol=1e-6
+    )
+
+
+def test_align(prediction):
+    arrays = from_prediction(prediction)
+    arrays["data_scaled"][1] = np.nan
+    aligned = align(arrays, 86400)
+
+    assert aligned.keys() == arrays.keys()
+    assert np.all(aligned["data_dates"] % 86400 == 0)
+    assert np.all(np.diff(aligned["data_dates"]) == 86400)
+    days = arrays["data_dates"] // 86400
+    first = arrays["data_scaled"][days == days[0]]
+    assert aligned["data_scaled"][0] == pytest.approx(np.nanmean(first))
+    assert len(aligned["forecast_upper"]) == len(aligned["forecast_dates"])
+
+
+def test_align_drops_buckets_without_values(prediction):
+    arrays = from_prediction(prediction)
+    days = arrays["data_dates"] // 86400
+    arrays["data_scaled"][days == days[1]] = np.nan
+    aligned = align(arrays, 86400)
+
+    assert days[1] * 86400 not in aligned["data_dates"]
+    assert len(aligned["data_dates"]) == len(np.unique(days)) - 1
+    assert len(aligned["data_scaled"]) == len(aligned["data_dates"])
+    assert np.all(np.isfinite(aligned["data_scaled"]))
+    # The aligned prediction is valid JSON
+    json.dumps(to_json(aligned), allow_nan=False)
+
+
+@mock_aws
+def test_load_prediction_legacy_json(prediction):
+    from predictive_capacity.predictions import (
+        ML_RESULTS_BUCKET,
+        load_prediction,
+    )
+
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.create_bucket(Bucket=ML_RESULTS_BUCKET)
+    s3.put_object(
+        Bucket=ML_RESULTS_BUCKET,
+        Key="uuid.json",
+        Body=json.dumps(prediction.model_dump()),
+    )
+
+    assert to_json(load_prediction("uuid"))["data_dates"] == prediction.data_dates
+
+
+def test_prediction_cache():
+    from predictive_capacity.predictions import PredictionCache, StoredPrediction
+
+    cache = PredictionCache(max_bytes=10)
+    for uuid in "abc":
+        cache.put(StoredPrediction(uuid, f"{uuid}.bin", '"etag"', body=b"1234"))
+    # The least recently used is evicted
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    cache.put(StoredPrediction("d", "d.bin", '"etag"', body=b"1234"))
+    assert cache.get("c") is None
+    assert cache.get("b") is not None
+    assert len(cache) == 2 and cache.size == 8
+
+    cache.put(StoredPrediction("e", "e.bin", '"etag"', body=b"0" * 11))
+    assert cache.get("e") is None
+    assert len(cache) == 2
+
+
+@mock_aws
+def test_open_prediction_cache(prediction):
+    from predictive_capacity.predictions import (
+        ML_RESULTS_BUCKET,
+        PredictionCache,
+        open_prediction,
+    )
+
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.create_bucket(Bucket=ML_RESULTS_BUCKET)
+    s3.put_object(
+        Bucket=ML_RESULTS_BUCKET,
+        Key="uuid.json",
+        Body=json.dumps(prediction.model_dump()),
+    )
+    cache = PredictionCache()
+
+    stored = open_prediction("uuid", cache=cache)
+    assert stored.media_type == "application/json"
+    assert cache.get("uuid") is None
+    body = stored.read()
+    assert cache.get("uuid") is stored
+    assert open_prediction("uuid", cache=cache) is stored
+
+    # A newer prediction in the compact format replaces the legacy one
+    compact = encode_prediction(from_prediction(prediction))
+    s3.put_object(Bucket=ML_RESULTS_BUCKET, Key="uuid.bin", Body=compact)
+    stored = open_prediction("uuid", cache=cache)
+    assert stored.read() == compact != body
+    assert open_prediction("uuid", cache=cache) is stored
+
+    s3.delete_object(Bucket=ML_RESULTS_BUCKET, Key="uuid.bin")
+    s3.delete_object(Bucket=ML_RESULTS_BUCKET, Key="uuid.json")
+    with pytest.raises(s3.exceptions.ClientError):
+        open_prediction("uuid", cache=cache)
+    assert cache.get("uuid") is None
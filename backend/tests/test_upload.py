@@ -1,5 +1,3 @@
-import json
-
 import boto3
 import pytest
 from moto import mock_aws
@@ -64,9 +62,11 @@ def metric_dict():
 @mock_aws
 def test_upload_prediction_metadata(metric_dict):
     from predictive_capacity.schemas import MetricBase
-    from predictive_capacity.upload import (ML_RESULTS_TABLE,
-                                            create_dynamodb_table,
-                                            upload_prediction_metadata)
+    from predictive_capacity.upload import (
+        ML_RESULTS_TABLE,
+        create_dynamodb_table,
+        upload_prediction_metadata,
+    )
 
     dynamodb = boto3.resource("dynamodb")
     create_dynamodb_table()
@@ -90,6 +90,7 @@ def test_upload_prediction_metadata(metric_dict):
 
 @mock_aws
 def test_upload_prediction(metric_dict):
+    from predictive_capacity.predictions import load_prediction, to_json
     from predictive_capacity.schemas import MetricBase
     from predictive_capacity.upload import ML_RESULTS_BUCKET, upload_prediction
 
@@ -103,18 +104,21 @@ def test_upload_prediction(metric_dict):
     upload_prediction(metadata=metric)
 
     # Then
-    response = s3.get_object(Bucket=ML_RESULTS_BUCKET, Key=f"{uuid}.json")
-    data = json.loads(response["Body"].read().decode())
+    data = to_json(load_prediction(uuid))
     assert data["data_scaled"] == [0.0, 0.1, 0.2]
     assert data["forecast"] == [0.3, 0.4, 0.5]
 
 
 @mock_aws
 def test_upload_all(metric_dict):
+    from predictive_capacity.predictions import load_prediction, to_json
     from predictive_capacity.schemas import MetricBase
-    from predictive_capacity.upload import (ML_RESULTS_BUCKET,
-                                            ML_RESULTS_TABLE,
-                                            create_dynamodb_table, upload_all)
+    from predictive_capacity.upload import (
+        ML_RESULTS_BUCKET,
+        ML_RESULTS_TABLE,
+        create_dynamodb_table,
+        upload_all,
+    )
 
     # Given
     dynamodb = boto3.resource("dynamodb")
@@ -138,7 +142,105 @@ def test_upload_all(metric_dict):
     assert "Item" in response
     uuid = response["Item"]["uuid"]
 
-    response = s3.get_object(Bucket=ML_RESULTS_BUCKET, Key=f"{uuid}.json")
-    data = json.loads(response["Body"].read().decode())
+    data = to_json(load_prediction(uuid))
     assert data["data_scaled"] == [0.0, 0.1, 0.2]
     assert data["forecast"] == [0.3, 0.4, 0.5]
+
+
+@mock_aws
+def test_metadata_writer(metric_dict):
+    from predictive_capacity.schemas import MetricBase
+    from predictive_capacity.upload import (
+        ML_RESULTS_TABLE,
+        MetadataWriter,
+        create_dynamodb_table,
+        metadata_item,
+    )
+
+    # Given
+    dynamodb = boto3.resource("dynamodb")
+    create_dynamodb_table()
+    table = dynamodb.Table(ML_RESULTS_TABLE)
+    written = []
+
+    # When
+    with MetadataWriter(flush_size=2, max_delay=3600) as writer:
+        for i in range(3):
+            metric = MetricBase.parse_obj({**metric_dict, "host_id": f"host_{i}"})
+            writer.put(metadata_item("source", metric), written.append)
+        # Then: the first two items are written together, the third one waits
+        assert written == [None, None]
+        assert table.scan()["Count"] == 2
+    assert written == [None, None, None]
+    assert table.scan()["Count"] == 3
+
+
+@mock_aws
+def test_metadata_writer_failure(metric_dict):
+    from predictive_capacity.schemas import MetricBase
+    from predictive_capacity.upload import MetadataWriter, metadata_item
+
+    # Given: the table does not exist
+    written = []
+
+    # When
+    metric = MetricBase.parse_obj(metric_dict)
+    with MetadataWriter(max_delay=0) as writer:
+        writer.put(metadata_item("source", metric), written.append)
+
+    # Then
+    assert len(written) == 1
+    assert isinstance(written[0], Exception)
+
+
+@mock_aws
+def test_upload_pipeline(metric_dict):
+    from predictive_capacity.predictions import load_prediction, to_json
+    from predictive_capacity.schemas import MetricBase
+    from predictive_capacity.upload import (
+        ML_RESULTS_BUCKET,
+        UploadPipeline,
+        prediction_body,
+    )
+
+    # Given
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.create_bucket(Bucket=ML_RESULTS_BUCKET)
+    metric = MetricBase.parse_obj(metric_dict)
+    uploaded, spans = [], []
+
+    # When: more uploads than the pipeline holds at once
+    with UploadPipeline(max_workers=2, max_pending=1) as uploads:
+        for i in range(3):
+            uploads.submit(
+                f"uuid{i}",
+                prediction_body(metric),
+                uploaded.append,
+                spans=spans,
+                metric="metric_name",
+            )
+        assert len(uploaded) >= 2
+
+    # Then
+    assert uploaded == [None, None, None]
+    for i in range(3):
+        data = to_json(load_prediction(f"uuid{i}"))
+        assert data["forecast"] == [0.3, 0.4, 0.5]
+    assert [span["name"] for span in spans] == ["s3_upload"] * 3
+    assert spans[0]["attributes"]["metric"] == "metric_name"
+
+
+@mock_aws
+def test_upload_pipeline_failure():
+    from predictive_capacity.upload import UploadPipeline
+
+    # Given: the bucket does not exist
+    uploaded = []
+
+    # When
+    with UploadPipeline() as uploads:
+        uploads.submit("uuid", b"{}", uploaded.append)
+
+    # Then
+    assert len(uploaded) == 1
+    assert isinstance(uploaded[0], Exception)
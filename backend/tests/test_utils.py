@@ -1,6 +1,11 @@
 from unittest.mock import MagicMock, patch
 
-from predictive_capacity.utils import get_uuid
+import pytest
+from moto import mock_aws
+
+from predictive_capacity import ML_RESULTS_TABLE
+from predictive_capacity.schemas import ResponseFindSetMetrics
+from predictive_capacity.utils import batch_get_metadata, get_uuid
 
 
 @patch("predictive_capacity.utils.dynamodb")
@@ -8,3 +13,68 @@ from predictive_capacity.utils import get_uuid
 def test_get_uuid(mock_uuid4: MagicMock, mock_dynamodb: MagicMock):
     assert get_uuid("source_test", "class_test", "host_test", "service_test") == "1234"
     mock_uuid4.assert_called_once()
+
+
+@mock_aws
+def test_batch_get_metadata():
+    from predictive_capacity.upload import create_dynamodb_table
+
+    table = create_dynamodb_table()
+    unique_labels = [
+        ResponseFindSetMetrics(
+            metric=f"metric{i}", host_id="1", service_id="2", platform_uuid="p"
+        )
+        for i in range(250)
+    ]
+    with table.batch_writer() as writer:
+        for item in unique_labels[1:]:
+            writer.put_item(
+                Item={
+                    "class": item.metric,
+                    "source#host_id#service_id": "source#1#2",
+                    "uuid": f"uuid-{item.metric}",
+                }
+            )
+
+    # More keys than a single request and a duplicated one
+    metadata = batch_get_metadata("source", unique_labels + unique_labels[-1:])
+
+    assert len(metadata) == 251
+    assert metadata[0] is None
+    assert [m["uuid"] for m in metadata[1:]] == [
+        f"uuid-{item.metric}" for item in unique_labels[1:] + unique_labels[-1:]
+    ]
+
+
+@patch("predictive_capacity.utils.dynamodb")
+def test_batch_get_metadata_retries_unprocessed_keys(mock_dynamodb: MagicMock):
+    unique_labels = [
+        ResponseFindSetMetrics(metric=m, host_id="1", service_id="2", platform_uuid="p")
+        for m in ("a", "b")
+    ]
+    key_b = {"class": "b", "source#host_id#service_id": "source#1#2"}
+    mock_dynamodb.batch_get_item.side_effect = [
+        {
+            "Responses": {
+                ML_RESULTS_TABLE: [
+                    {"class": "a", "source#host_id#service_id": "source#1#2"}
+                ]
+            },
+            "UnprocessedKeys": {ML_RESULTS_TABLE: {"Keys": [key_b]}},
+        },
+        {"Responses": {ML_RESULTS_TABLE: [{**key_b, "uuid": "uuid-b"}]}},
+    ]
+
+    metadata = batch_get_metadata("source", unique_labels, backoff=0)
+
+    assert metadata[1]["uuid"] == "uuid-b"
+    retry = mock_dynamodb.batch_get_item.call_args_list[1]
+    assert retry.kwargs["RequestItems"] == {ML_RESULTS_TABLE: {"Keys": [key_b]}}
+
+    mock_dynamodb.batch_get_item.side_effect = None
+    mock_dynamodb.batch_get_item.return_value = {
+        "Responses": {},
+        "UnprocessedKeys": {ML_RESULTS_TABLE: {"Keys": [key_b]}},
+    }
+    with pytest.raises(RuntimeError):
+        batch_get_metadata("source", unique_labels, max_attempts=2, backoff=0)
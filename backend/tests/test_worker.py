@@ -0,0 +1,155 @@
+from unittest.mock import patch
+
+import boto3
+import pytest
+from moto import mock_aws
+
+
+@pytest.fixture
+def queue(tmp_path):
+    from predictive_capacity.jobs import JobQueue
+
+    return JobQueue(str(tmp_path / "jobs.sqlite"))
+
+
+@pytest.fixture
+def unique_labels():
+    from predictive_capacity.schemas import ResponseFindSetMetrics
+
+    return [
+        ResponseFindSetMetrics(
+            metric=f"metric{i}",
+            host_id="123",
+            service_id="123",
+            platform_uuid="0000-0000-0000-0000",
+        )
+        for i in range(3)
+    ]
+
+
+@pytest.fixture
+def no_backoff():
+    from functools import partial
+
+    from predictive_capacity.jobs import RunLedger
+
+    with patch("predictive_capacity.worker.RunLedger", partial(RunLedger, backoff=0)):
+        yield
+
+
+@patch("predictive_capacity.worker.make_forecasts")
+@patch("predictive_capacity.worker.find_set_metrics")
+def test_work(
+    mock_find_set_metrics, mock_make_forecasts, queue, unique_labels, no_backoff
+):
+    from predictive_capacity.schemas import ForecastOutcome
+    from predictive_capacity.worker import work
+
+    def make_forecasts(unique_labels, on_outcome, ledger, **kwargs):
+        for item in unique_labels:
+            # metric0 always fails, metric1 fails once
+            error = None
+            if item.metric == "metric0" or (
+                item.metric == "metric1" and mock_make_forecasts.call_count == 1
+            ):
+                error = "Warp10 timeout"
+            ledger.record(item, "failed" if error else "uploaded", error)
+            on_outcome(ForecastOutcome(metric=item, error=error))
+
+    mock_find_set_metrics.return_value = unique_labels
+    mock_make_forecasts.side_effect = make_forecasts
+    job, _ = queue.enqueue("firm", forecasting_horizon=24, retrain=False)
+
+    work(queue, once=True)
+
+    job = queue.get(job.job_id)
+    assert job.status == "succeeded"
+    assert (job.total, job.done, job.failed) == (3, 3, 1)
+    # Failed metrics are retried until they run out of attempts
+    forecast = [
+        [item.metric for item in call.kwargs["unique_labels"]]
+        for call in mock_make_forecasts.call_args_list
+    ]
+    assert forecast == [
+        ["metric0", "metric1", "metric2"],
+        ["metric0", "metric1"],
+        ["metric0"],
+    ]
+    kwargs = mock_make_forecasts.call_args.kwargs
+    assert kwargs["organization"] == "firm"
+    assert kwargs["forecasting_horizon"] == 24
+    assert kwargs["retrain"] is False
+
+
+@patch("predictive_capacity.worker.make_forecasts")
+@patch("predictive_capacity.worker.find_set_metrics")
+def test_work_resumes_interrupted_job(
+    mock_find_set_metrics, mock_make_forecasts, queue, unique_labels, no_backoff
+):
+    from predictive_capacity.jobs import RunLedger
+    from predictive_capacity.worker import work
+
+    mock_find_set_metrics.return_value = unique_labels
+    job, _ = queue.enqueue("firm")
+    # The worker died after uploading the first metric
+    queue.claim("dead worker")
+    ledger = RunLedger(queue.path, job.job_id)
+    ledger.start(unique_labels)
+    ledger.record(unique_labels[0], "uploaded")
+    ledger.record(unique_labels[1], "trained")
+    queue.stale_after = -1
+
+    work(queue, once=True)
+
+    forecast = mock_make_forecasts.call_args.kwargs["unique_labels"]
+    assert [item.metric for item in forecast] == ["metric1", "metric2"]
+
+
+@pytest.mark.parametrize(
+    "side_effect, error",
+    [(Exception("Failure"), "Failure"), ([[]], "No metrics found")],
+    ids=["warp10_error", "no_metrics"],
+)
+@patch("predictive_capacity.worker.make_forecasts")
+@patch("predictive_capacity.worker.find_set_metrics")
+def test_work_failure(
+    mock_find_set_metrics, mock_make_forecasts, side_effect, error, queue
+):
+    from predictive_capacity.worker import work
+
+    mock_find_set_metrics.side_effect = side_effect
+    job, _ = queue.enqueue("firm")
+
+    work(queue, once=True)
+
+    job = queue.get(job.job_id)
+    assert (job.status, job.error) == ("failed", error)
+    mock_make_forecasts.assert_not_called()
+
+
+@mock_aws
+@patch("predictive_capacity.worker.signal")
+@patch("predictive_capacity.worker.logger")
+@patch("predictive_capacity.worker.work")
+def test_main_instruments_aws_clients(mock_work, mock_logger, mock_signal, tmp_path):
+    from predictive_capacity import ML_RESULTS_BUCKET
+    from predictive_capacity.monitoring import AWS_CALL_SECONDS
+    from predictive_capacity.worker import main
+
+    # Clients not instrumented yet by the API
+    s3 = boto3.resource("s3", region_name="us-east-1")
+    dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
+    s3.meta.client.create_bucket(Bucket=ML_RESULTS_BUCKET)
+
+    def work(queue, stop, once):
+        s3.meta.client.put_object(Bucket=ML_RESULTS_BUCKET, Key="uuid.bin", Body=b"")
+
+    mock_work.side_effect = work
+    count = AWS_CALL_SECONDS.count(service="s3", operation="PutObject")
+    with patch("predictive_capacity.worker.s3", s3), patch(
+        "predictive_capacity.worker.dynamodb", dynamodb
+    ):
+        main(["--db", str(tmp_path / "jobs.sqlite"), "--once", "--metrics-port", "0"])
+
+    mock_work.assert_called_once()
+    assert AWS_CALL_SECONDS.count(service="s3", operation="PutObject") == count + 1
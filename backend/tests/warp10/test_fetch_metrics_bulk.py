@@ -0,0 +1,60 @@
+from unittest.mock import patch
+
+import pandas as pd
+
+from predictive_capacity.schemas import ResponseFindSetMetrics
+from predictive_capacity.warp10.fetch_metrics_bulk import fetch_metrics_bulk
+
+
+def warp10_result(metric: str, saturation, names: dict) -> dict:
+    return {
+        "metric": metric,
+        "ticks": [1609459200000000, 1609462800000000],
+        "values": [1, 2.5],
+        "saturation": saturation,
+        **names,
+    }
+
+
+@patch("predictive_capacity.warp10.fetch_metrics_bulk.Warpscript.exec")
+def test_fetch_metrics_bulk(mock_warpscript_exec):
+    metrics = [
+        ResponseFindSetMetrics(
+            metric=f"metric{i}", host_id="1", service_id="2", platform_uuid="p"
+        )
+        for i in range(3)
+    ]
+    mock_warpscript_exec.side_effect = [
+        (
+            [
+                warp10_result(
+                    "metric0",
+                    100,
+                    {"host_name": ["host"], "service_name": ["service"]},
+                ),
+                warp10_result("metric1", None, {"host_name": None}),
+            ],
+        ),
+        ([warp10_result("metric2", 10.0, {})],),
+    ]
+
+    results = list(fetch_metrics_bulk("token", metrics, batch_size=2))
+
+    assert mock_warpscript_exec.call_count == 2
+    assert [r.metric for r in results] == ["metric0", "metric1", "metric2"]
+    assert results[0].maximum_allowed == 100.0
+    assert (results[0].host_name, results[0].service_name) == ("host", "service")
+    assert results[1].maximum_allowed is None
+    assert (results[1].host_name, results[1].service_name) == ("1", "2")
+    assert results[2].labels == {
+        "host_id": "1",
+        "service_id": "2",
+        "platform_uuid": "p",
+    }
+    pd.testing.assert_frame_equal(
+        results[0].data,
+        pd.DataFrame(
+            {"metric0": [1.0, 2.5]},
+            index=pd.to_datetime(["2021-01-01 00:00:00", "2021-01-01 01:00:00"]),
+        ),
+    )